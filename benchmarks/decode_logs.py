@@ -0,0 +1,81 @@
+""" Compare per-log event decoding with the precompiled decoder registry
+
+    python benchmarks/decode_logs.py [log_count]
+"""
+import sys
+import time
+from hexbytes import HexBytes
+from eth_abi import encode_abi, encode_single
+from scatter_daemon.common.contracts import (
+    load_abi,
+    events_from_abi,
+    event_from_log,
+    get_event_decoders,
+    decode_logs,
+)
+
+
+def synthetic_logs(count: int):
+    """ BidSuccessful and Pinned logs, alternating """
+    abi = load_abi('IScatter.abi')
+    topics = {ent['name']: HexBytes(sig) for sig, ent in events_from_abi(abi).items()}
+    logs = []
+    for i in range(count):
+        tx_hash = HexBytes(i.to_bytes(32, 'big'))
+        file_hash = (i + 1).to_bytes(32, 'big')
+        hoster = '0x' + '{:040x}'.format(i + 1)
+        if i % 2 == 0:
+            logs.append({
+                'topics': [
+                    topics['BidSuccessful'],
+                    HexBytes(encode_single('int256', i)),
+                    HexBytes(encode_single('address', hoster)),
+                    HexBytes(encode_single('uint256', i * 1000)),
+                ],
+                'data': HexBytes(encode_abi(['uint256', 'bytes32', 'int64'],
+                                            [i * 10, file_hash, i * 100])),
+                'transactionHash': tx_hash,
+                'blockNumber': i,
+            })
+        else:
+            logs.append({
+                'topics': [
+                    topics['Pinned'],
+                    HexBytes(encode_single('int256', i - 1)),
+                    HexBytes(encode_single('address', hoster)),
+                ],
+                'data': HexBytes(encode_abi(['bytes32'], [file_hash])),
+                'transactionHash': tx_hash,
+                'blockNumber': i,
+            })
+    return abi, logs
+
+
+def per_log(abi, logs):
+    """ The original path: rebuild the lookup per poll and decode each log on its own """
+    event_lookup = events_from_abi(abi)
+    events = []
+    for event_log in logs:
+        topic_sig = event_log['topics'][0].hex()
+        if topic_sig in event_lookup:
+            events.append(event_from_log(event_lookup[topic_sig], event_log))
+    return events
+
+
+def batched(abi, logs):
+    return decode_logs(get_event_decoders(abi), logs)
+
+
+def run(name, func, abi, logs):
+    start = time.perf_counter()
+    events = func(abi, logs)
+    elapsed = time.perf_counter() - start
+    assert len(events) == len(logs)
+    print('{:>10}: {:>10.0f} logs/s ({:.3f}s)'.format(name, len(logs) / elapsed, elapsed))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    abi, logs = synthetic_logs(count)
+    run('per-log', per_log, abi, logs)
+    run('batched', batched, abi, logs)
@@ -0,0 +1,50 @@
+""" Measure how long PortfolioOptimizer takes to re-solve as bids arrive
+
+    python benchmarks/portfolio.py [candidate_count ...]
+
+Candidates are loaded once, then one bid is added and the selection re-solved, the way the
+hoster does after each sync.  Capacity is a quarter of the candidates' total size.
+"""
+import sys
+import time
+import random
+from scatter_daemon.hoster.portfolio import PortfolioOptimizer
+
+ROUNDS = 100
+
+
+def synthetic_bids(count: int, seed: int = 1):
+    rnd = random.Random(seed)
+    return [{
+        'bid_id': bid_id,
+        'file_size': rnd.randint(1024, 1073741824),
+        'bid_value': rnd.randint(10 ** 15, 10 ** 18),
+        'duration': rnd.randint(86400, 31536000),
+    } for bid_id in range(count)]
+
+
+def run(count: int):
+    bids = synthetic_bids(count + ROUNDS)
+    capacity = sum(bid['file_size'] for bid in bids[:count]) // 4
+
+    optimizer = PortfolioOptimizer()
+    began = time.perf_counter()
+    optimizer.update(bids[:count])
+    optimizer.select(capacity)
+    initial = time.perf_counter() - began
+
+    began = time.perf_counter()
+    for bid in bids[count:]:
+        optimizer.add(bid['bid_id'], bid['file_size'], bid['bid_value'], bid['duration'])
+        optimizer.select(capacity)
+    resolve = (time.perf_counter() - began) / ROUNDS
+
+    print('{:>9} bids: initial solve {:.4f}s, incremental re-solve {:.5f}s'.format(
+        count, initial, resolve
+    ))
+
+
+if __name__ == '__main__':
+    counts = [int(a) for a in sys.argv[1:]] or [50, 1000, 100000]
+    for count in counts:
+        run(count)
@@ -0,0 +1,70 @@
+""" Measure event ingestion throughput of store_events
+
+    python benchmarks/store_events.py [event_count ...]
+
+Events are written to a temporary on-disk database in batches, the way fetch_events hands them
+over one block window at a time.
+"""
+import sys
+import time
+import sqlite3
+import tempfile
+from pathlib import Path
+from attrdict import AttrDict
+from scatter_daemon.storage import store_events
+from scatter_daemon.storage.db import migrate
+
+BATCH_SIZE = 10000
+
+
+def synthetic_events(start: int, count: int):
+    """ A BidSuccessful, Pinned and Accepted event for each bid """
+    events = []
+    for i in range(start, start + count):
+        bid_id = i // 3
+        hoster = '0x' + '{:040x}'.format(bid_id % 50 + 1)
+        kind = i % 3
+        if kind == 0:
+            name = 'BidSuccessful'
+            args = AttrDict({
+                'bidId': bid_id,
+                'bidder': '0x' + '{:040x}'.format(bid_id + 1000),
+                'bidValue': bid_id * 1000,
+                'validationPool': bid_id * 10,
+                'fileHash': '{:064x}'.format(bid_id),
+                'fileSize': bid_id * 100,
+            })
+        elif kind == 1:
+            name = 'Pinned'
+            args = AttrDict({'bidId': bid_id, 'hoster': hoster,
+                             'fileHash': '{:064x}'.format(bid_id)})
+        else:
+            name = 'Accepted'
+            args = AttrDict({'bidId': bid_id, 'when': 1500000000 + bid_id, 'hoster': hoster})
+        events.append(AttrDict({
+            'name': name,
+            'args': args,
+            'txhash': '0x{:064x}'.format(i),
+            'block_number': i,
+        }))
+    return events
+
+
+def run(count: int):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn = sqlite3.connect(str(Path(tmpdir).joinpath('bench.db')))
+        migrate(conn)
+        elapsed = 0.0
+        for start in range(0, count, BATCH_SIZE):
+            events = synthetic_events(start, min(BATCH_SIZE, count - start))
+            began = time.perf_counter()
+            store_events(conn, events)
+            elapsed += time.perf_counter() - began
+        conn.close()
+    print('{:>9} events: {:>10.0f} events/s ({:.2f}s)'.format(count, count / elapsed, elapsed))
+
+
+if __name__ == '__main__':
+    counts = [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]
+    for count in counts:
+        run(count)
@@ -0,0 +1,40 @@
+""" Run the hoster daemon
+"""
+from ..hoster import hoster_run
+from ..common.config import load_config
+from ..common.const import DEFAULT_CONFIG_PATH
+from ..common.logging import getLogger
+
+log = getLogger(__name__)
+
+
+def add_parser_arguments(parser):
+    """ Add additional subcommands onto this command """
+
+    config_args = ('-c', '--config')
+    config_kwargs = {
+        'type': str,
+        'dest': 'config',
+        'default': DEFAULT_CONFIG_PATH,
+        'help': 'The location of the configuration file'
+    }
+
+    parser.add_argument(*config_args, **config_kwargs)
+
+    subparsers = parser.add_subparsers(title='Submcommands', dest='subcommand',
+                                       help='Hoster commands')
+
+    run_parser = subparsers.add_parser('run', help="Run the hoster")
+    run_parser.add_argument(*config_args, **config_kwargs)
+
+    return parser
+
+
+def main(args):
+    """ Execute hoster """
+    log.info("Starting hoster daemon...")
+
+    if args.subcommand == 'run':
+        hoster_run(load_config(args.config), args.keystore)
+    else:
+        log.error("Unknown hoster command.  Try `scatter hoster run`.")
@@ -8,6 +8,7 @@ log = getLogger(__name__)
 MODULES = [
     'init',
     'validator',
+    'hoster',
     'accounts',
 ]
 IMPORTED_MODULES = {}
@@ -3,7 +3,7 @@
 import sys
 from pathlib import Path
 from eth_utils import is_address, to_checksum_address
-from ..validator import validate_run
+from ..validator import validate_run, validate_run_async
 from ..accounts import get_available_accounts
 from ..common.config import init_config, load_config
 from ..common.const import DEFAULT_CONFIG_PATH
@@ -38,6 +38,8 @@ def add_parser_arguments(parser):
 
     run_parser = subparsers.add_parser('run', help="Run the validator")
     run_parser.add_argument(*config_args, **config_kwargs)
+    run_parser.add_argument('--async', action='store_true', dest='use_async',
+                            help='Run on an asyncio event loop.  Requires aiohttp.')
 
     return parser
 
@@ -70,4 +72,8 @@ def main(args):
     else:
 
         conf = load_config(args.config)
-        validate_run(conf)
+
+        if args.use_async:
+            validate_run_async(conf)
+        else:
+            validate_run(conf)
@@ -0,0 +1,304 @@
+""" asyncio clients for the Ethereum JSON-RPC and IPFS HTTP APIs.
+
+These need aiohttp, which is optional.  Install it with `pip install scatter_daemon[async]`.
+"""
+import time
+import asyncio
+import itertools
+from .const import RPC_BATCH_SIZE, IPFS_JSON_MAX_BYTES, LOG_FETCH_RETRIES, LOG_FETCH_RETRY_DELAY
+from .exceptions import ScatterError
+from .ipfs import IPFSRouter, IPFSEndpoint, json_from_buffer
+from .web3 import encode_call, decode_call_result, is_log_range_error
+from .typing import Any, Dict, List, Optional, Tuple, Union
+from .logging import getLogger
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+log = getLogger(__name__)
+
+rpc_ids = itertools.count(1)
+
+
+def require_aiohttp() -> None:
+    """ Raise if aiohttp is not installed """
+    if aiohttp is None:
+        raise ScatterError("Async mode requires aiohttp.  Install it with "
+                           "`pip install scatter_daemon[async]`.")
+
+
+def block_param(block_identifier: Union[int, str]) -> str:
+    """ Format a block number or tag for a JSON-RPC request """
+    if isinstance(block_identifier, int):
+        return hex(block_identifier)
+    return block_identifier
+
+
+class AsyncJSONRPC:
+    """ Ethereum JSON-RPC over HTTP.  Requests share the session's connection pool. """
+    def __init__(self, session: 'aiohttp.ClientSession', endpoint_uri: str,
+                 batch_size: int = RPC_BATCH_SIZE):
+        self.session = session
+        self.endpoint_uri = endpoint_uri
+        self.batch_size = batch_size
+        self.supports_batch = True
+
+    async def _post(self, payload: Any) -> Any:
+        async with self.session.post(self.endpoint_uri, json=payload) as resp:
+            resp.raise_for_status()
+            return await resp.json(content_type=None)
+
+    async def _post_batch(self, payload: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+        """ web3._post_batch() for aiohttp """
+        async with self.session.post(self.endpoint_uri, json=payload) as resp:
+            if 400 <= resp.status < 500:
+                log.debug("Batch rejected with HTTP {}".format(resp.status))
+                return None
+            resp.raise_for_status()
+            try:
+                results = await resp.json(content_type=None)
+            except ValueError:
+                return None
+        if not isinstance(results, list) or len(results) != len(payload):
+            return None
+        by_id = {r.get('id'): r for r in results}
+        return [by_id.get(req['id'], {'error': 'Missing response'}) for req in payload]
+
+    async def request(self, method: str, params: Optional[List] = None) -> Any:
+        """ Make a single request and return its result """
+        resp = await self._post({
+            'jsonrpc': '2.0',
+            'id': next(rpc_ids),
+            'method': method,
+            'params': params or [],
+        })
+        if 'error' in resp:
+            raise ScatterError("JSON-RPC error from {}: {}".format(method, resp['error']))
+        return resp['result']
+
+    async def batch(self, calls: List[Tuple[str, List]]) -> List[Any]:
+        """ Make many requests, as JSON-RPC batches of up to batch_size, and return their results
+        in order.  Nodes that refuse batches get the requests one at a time. """
+        results: List[Any] = []
+
+        for i in range(0, len(calls), self.batch_size):
+            chunk = calls[i:i + self.batch_size]
+
+            if self.supports_batch:
+                payload = [{
+                    'jsonrpc': '2.0',
+                    'id': next(rpc_ids),
+                    'method': method,
+                    'params': params,
+                } for method, params in chunk]
+                responses = await self._post_batch(payload)
+
+                if responses is not None:
+                    for req, resp in zip(payload, responses):
+                        if 'error' in resp:
+                            raise ScatterError("JSON-RPC error from {}: {}".format(
+                                req['method'], resp['error']
+                            ))
+                        results.append(resp['result'])
+                    continue
+
+                log.warning("Node does not support JSON-RPC batches.  Using single requests.")
+                self.supports_batch = False
+
+            for method, params in chunk:
+                results.append(await self.request(method, params))
+
+        return results
+
+    async def block_number(self) -> int:
+        """ eth_blockNumber """
+        return int(await self.request('eth_blockNumber'), 16)
+
+    async def get_logs(self, address: str, from_block: int, to_block: int,
+                       topics: Optional[List] = None) -> List[Dict[str, Any]]:
+        """ eth_getLogs, with block numbers and log indexes converted to int like web3 does """
+        logs = await self.request('eth_getLogs', [{
+            'fromBlock': hex(from_block),
+            'toBlock': hex(to_block),
+            'address': address,
+            'topics': topics or [],
+        }])
+        for event_log in logs:
+            event_log['blockNumber'] = int(event_log['blockNumber'], 16)
+            event_log['logIndex'] = int(event_log['logIndex'], 16)
+        return logs
+
+    async def get_logs_retrying(self, address: str, from_block: int, to_block: int,
+                                topics: Optional[List] = None,
+                                retries: int = LOG_FETCH_RETRIES) -> List[Dict[str, Any]]:
+        """ web3.get_logs_retrying() for async clients """
+        delay = LOG_FETCH_RETRY_DELAY
+        while True:
+            try:
+                return await self.get_logs(address, from_block, to_block, topics)
+            except Exception as err:
+                if is_log_range_error(err) or retries < 1:
+                    raise
+                log.warning("Fetching logs for {}-{} failed ({}).  Retrying in {}s.".format(
+                    from_block, to_block, err, delay
+                ))
+                await asyncio.sleep(delay)
+                delay *= 2
+                retries -= 1
+
+    async def call(self, fn: Any, block_identifier: Union[int, str] = 'latest') -> Any:
+        """ Run a prepared contract function, e.g. contract.functions.getBid(1) """
+        result = await self.request('eth_call', [encode_call(fn), block_param(block_identifier)])
+        return decode_call_result(fn, result)
+
+    async def call_many(self, fns: List[Any],
+                        block_identifier: Union[int, str] = 'latest') -> List[Any]:
+        """ Run many prepared contract functions in batches """
+        block = block_param(block_identifier)
+        results = await self.batch([('eth_call', [encode_call(fn), block]) for fn in fns])
+        return [decode_call_result(fn, result) for fn, result in zip(fns, results)]
+
+
+class AsyncIPFS:
+    """ The parts of the IPFS HTTP API the daemon uses.  Requests are spread over the router's
+    endpoints, unless the client is bound to one with checkout(). """
+    def __init__(self, session: 'aiohttp.ClientSession', router: IPFSRouter,
+                 endpoint: Optional[IPFSEndpoint] = None):
+        self.session = session
+        self.router = router
+        self.endpoint = endpoint
+        self.timeout = aiohttp.ClientTimeout(total=router.timeout) if router.timeout else None
+
+    @property
+    def name(self) -> Optional[str]:
+        return self.endpoint.name if self.endpoint is not None else None
+
+    def checkout(self) -> 'AsyncIPFSCheckout':
+        """ Use a single endpoint for a block of work, e.g. `async with ipfs.checkout() as node` """
+        return AsyncIPFSCheckout(self)
+
+    async def _post_to(self, endpoint: IPFSEndpoint, path: str,
+                       params: List[Tuple[str, Any]]) -> 'aiohttp.ClientResponse':
+        return await self.session.post(
+            'http://{}:{}/api/v0/{}'.format(endpoint.host, endpoint.port, path),
+            params=params,
+            timeout=self.timeout
+        )
+
+    async def _post(self, path: str, params: List[Tuple[str, Any]]) -> 'aiohttp.ClientResponse':
+        if self.endpoint is not None:
+            start = time.monotonic()
+            try:
+                resp = await self._post_to(self.endpoint, path, params)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self.router.record(self.endpoint, False, time.monotonic() - start)
+                raise
+            self.router.record(self.endpoint, True, time.monotonic() - start)
+        else:
+            if len(self.router.endpoints) < 1:
+                raise ScatterError("No IPFS endpoints configured")
+
+            # Like IPFSPool, refused connections are tried on the next endpoint
+            for attempt in range(len(self.router.endpoints)):
+                endpoint = self.router.acquire()
+                start = time.monotonic()
+                ok = True
+                try:
+                    resp = await self._post_to(endpoint, path, params)
+                    break
+                except aiohttp.ClientConnectorError:
+                    ok = False
+                    if attempt + 1 >= len(self.router.endpoints):
+                        raise
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    ok = False
+                    raise
+                finally:
+                    self.router.release(endpoint, ok, time.monotonic() - start)
+
+        if resp.status != 200:
+            text = await resp.text()
+            resp.release()
+            raise ScatterError("IPFS {} failed: {}".format(path, text))
+        return resp
+
+    async def _json(self, path: str, *args: str, **kwargs: Any) -> Dict[str, Any]:
+        params = [('arg', a) for a in args] + [(k, str(v)) for k, v in kwargs.items()]
+        resp = await self._post(path, params)
+        async with resp:
+            return await resp.json(content_type=None)
+
+    async def cat(self, cid: str, length: Optional[int] = None) -> bytes:
+        """ Read a file, or at most length bytes of it """
+        params = [('arg', cid)]
+        if length is not None:
+            params.append(('length', str(length)))
+        resp = await self._post('cat', params)
+        async with resp:
+            return await resp.read()
+
+    async def cat_json(self, cid: str, max_bytes: int = IPFS_JSON_MAX_BYTES) -> Any:
+        """ Read and parse a JSON file, rejecting files larger than max_bytes without reading
+        the rest """
+        resp = await self._post('cat', [('arg', cid), ('length', str(max_bytes + 1))])
+        buf = bytearray()
+        async with resp:
+            async for chunk in resp.content.iter_chunked(65536):
+                buf.extend(chunk)
+                if len(buf) > max_bytes:
+                    raise ScatterError("{} is larger than {} bytes".format(cid, max_bytes))
+        return json_from_buffer(bytes(buf), cid)
+
+    async def swarm_connect(self, multiaddr: str) -> Dict[str, Any]:
+        """ Connect to a peer """
+        return await self._json('swarm/connect', multiaddr)
+
+    async def swarm_disconnect(self, multiaddr: str) -> Dict[str, Any]:
+        """ Disconnect from a peer """
+        return await self._json('swarm/disconnect', multiaddr)
+
+    async def swarm_peers(self) -> Dict[str, Any]:
+        """ List connected peers """
+        return await self._json('swarm/peers')
+
+    async def block_stat(self, cid: str, **options: Any) -> Dict[str, Any]:
+        """ Get the size of a block.  options are passed to the API, e.g. offline='true'. """
+        return await self._json('block/stat', cid, **options)
+
+    async def object_links(self, cid: str, **options: Any) -> Dict[str, Any]:
+        """ List the links of a DAG node """
+        return await self._json('object/links', cid, **options)
+
+    async def object_data(self, cid: str, **options: Any) -> bytes:
+        """ The raw Data field of a DAG node """
+        params = [('arg', cid)] + [(k, str(v)) for k, v in options.items()]
+        resp = await self._post('object/data', params)
+        async with resp:
+            return await resp.read()
+
+    async def block_rm(self, *cids: str) -> None:
+        """ Remove blocks from the node's repo.  The daemon refuses to remove pinned ones. """
+        resp = await self._post('block/rm', [('arg', cid) for cid in cids])
+        async with resp:
+            await resp.read()
+
+    async def id(self) -> Dict[str, Any]:
+        """ Get this node's identity """
+        return await self._json('id')
+
+
+class AsyncIPFSCheckout:
+    """ Async context manager for AsyncIPFS.checkout() """
+    def __init__(self, ipfs: AsyncIPFS):
+        self.ipfs = ipfs
+        self.endpoint: Optional[IPFSEndpoint] = None
+
+    async def __aenter__(self) -> AsyncIPFS:
+        self.endpoint = self.ipfs.router.acquire()
+        return AsyncIPFS(self.ipfs.session, self.ipfs.router, self.endpoint)
+
+    async def __aexit__(self, *exc_info) -> None:
+        with self.ipfs.router.lock:
+            self.endpoint.in_flight -= 1
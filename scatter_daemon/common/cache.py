@@ -0,0 +1,74 @@
+""" In-memory caching """
+import time
+import threading
+from collections import OrderedDict
+from .typing import Any, Callable, Dict, Hashable
+
+
+class TTLCache:
+    """ Thread-safe mapping with a maximum size and a time to live for each entry.  When full,
+    the least recently used entry is evicted. """
+    def __init__(self, maxsize: int, ttl: float, timer: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > self.timer()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """ Get a value, counting the hit or miss """
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            if entry[0] <= self.timer():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """ Add or replace a value """
+        with self._lock:
+            self._data[key] = (self.timer() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """ Remove a value and return it """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            return entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """ Hit and miss counts, and the current size """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+            }
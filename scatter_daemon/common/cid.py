@@ -0,0 +1,55 @@
+""" Conversion between the sha2-256 digests stored on-chain and IPFS hashes (CIDv0) """
+from functools import lru_cache
+from base58 import b58encode, b58decode
+from .const import CID_CACHE_SIZE
+from .typing import Iterable, List, Optional, StrOrBytes
+
+# Multihash header for a 32 byte sha2-256 digest
+SHA2_256_PREFIX = b'\x12\x20'
+
+
+@lru_cache(maxsize=CID_CACHE_SIZE)
+def digest_to_cid(digest: bytes) -> str:
+    """ Convert a 32 byte sha2-256 digest to a base58 IPFS hash """
+    if len(digest) != 32:
+        raise ValueError("Expected a 32 byte digest, got {} bytes".format(len(digest)))
+    cid = b58encode(SHA2_256_PREFIX + digest)
+    return cid.decode('ascii') if isinstance(cid, bytes) else cid
+
+
+@lru_cache(maxsize=CID_CACHE_SIZE)
+def cid_to_digest(cid: str) -> bytes:
+    """ Convert a base58 IPFS hash to the 32 byte sha2-256 digest stored on-chain """
+    multihash = b58decode(cid)
+    if len(multihash) != 34 or multihash[:2] != SHA2_256_PREFIX:
+        raise ValueError("{} is not a sha2-256 CIDv0".format(cid))
+    return bytes(multihash[2:])
+
+
+def to_cid(file_hash: StrOrBytes) -> str:
+    """ Get the IPFS hash for a file hash given as a digest, hex string or IPFS hash """
+    if isinstance(file_hash, (bytes, bytearray, memoryview)):
+        return digest_to_cid(bytes(file_hash))
+    elif file_hash.startswith('Qm'):
+        return file_hash
+    elif file_hash[:2] in ('0x', '0X'):
+        return digest_to_cid(bytes.fromhex(file_hash[2:]))
+    return digest_to_cid(bytes.fromhex(file_hash))
+
+
+def to_cids(file_hashes: Iterable[Optional[StrOrBytes]]) -> List[Optional[str]]:
+    """ to_cid() for many file hashes, converting each distinct hash once.  Hashes that are None
+    or can't be converted give None. """
+    converted = {}
+    cids: List[Optional[str]] = []
+
+    for file_hash in file_hashes:
+        key = bytes(file_hash) if isinstance(file_hash, (bytearray, memoryview)) else file_hash
+        if key not in converted:
+            try:
+                converted[key] = None if key is None else to_cid(key)
+            except ValueError:
+                converted[key] = None
+        cids.append(converted[key])
+
+    return cids
@@ -12,7 +12,14 @@ from .typing import (
     Any,
 )
 from .exceptions import ConfigurationError
-from .const import VALIDATION_DEFAULTS, DEFAULT_CONFIG_PATH, MAINNET_ROUTER_ADDRESS
+from .const import (
+    VALIDATION_DEFAULTS,
+    DEFAULT_CONFIG_PATH,
+    DEFAULT_CONFIRMATIONS,
+    IPFS_DEFAULT_API,
+    MAINNET_ROUTER_ADDRESS,
+    DEFAULT_IPFS_REPO,
+)
 from .logging import getLogger
 
 log = getLogger(__name__)
@@ -30,15 +37,20 @@ def initial_config_structure(parser, overrides={}) -> None:
     parser.set(ROOT_EL, 'account', overrides.get('account', ''))
     parser.set(ROOT_EL, 'router_address', overrides.get('router', MAINNET_ROUTER_ADDRESS))
     parser.set(ROOT_EL, 'db_file', overrides.get('db_file', '~/.scatter/scatter.db'))
+    parser.set(ROOT_EL, 'confirmations', overrides.get('confirmations',
+                                                       str(DEFAULT_CONFIRMATIONS)))
 
     parser.add_section(VALIDATOR_EL)
     parser.set(VALIDATOR_EL, 'max_file_size', overrides.get(
         'max_file_size',
         str(VALIDATION_DEFAULTS.get('max_file_size'))
     ))
+    parser.set(VALIDATOR_EL, 'ipfs_api', overrides.get('ipfs_api', IPFS_DEFAULT_API))
 
     parser.add_section(HOSTER_EL)
     parser.set(HOSTER_EL, 'max_storage', overrides.get('max_storage', '21474836480'))  # 20GB
+    parser.set(HOSTER_EL, 'ipfs_api', overrides.get('ipfs_api', IPFS_DEFAULT_API))
+    parser.set(HOSTER_EL, 'ipfs_repo', overrides.get('ipfs_repo', DEFAULT_IPFS_REPO))
     parser.set(VALIDATOR_EL, 'max_file_size', overrides.get(
         'max_file_size',
         str(VALIDATION_DEFAULTS.get('max_file_size'))
@@ -4,8 +4,13 @@ MAX_TX_GAS_LIMIT = int(3e6)
 GAS_LIMITS = {  # TODO: Get these accurate once there's accurate estimates
     'Register': {
         'register': MAX_TX_GAS_LIMIT,
-    }
+    },
+    'Scatter': {
+        'accept': MAX_TX_GAS_LIMIT,
+        'pinned': MAX_TX_GAS_LIMIT,
+    },
 }
+TX_RECEIPT_TIMEOUT = 300  # Seconds to wait for a transaction to be mined
 
 # Validation Selection Defaults
 VALIDATION_DEFAULTS = {
@@ -16,11 +21,97 @@ VALIDATION_DEFAULTS = {
     'max_duration': 2678400,  # 31 days
 }
 
+# Validation scheduling.  Bids are ranked by payout per validation, per unit of file size and
+# per unit of remaining duration.
+SCHEDULE_SIZE_UNIT = 1048576  # 1MiB
+SCHEDULE_TIME_UNIT = 86400  # 1 day
+
+# Validation workers, and how many of them may work on the same hoster at once
+VALIDATOR_WORKERS = 4
+VALIDATOR_MAX_PER_HOSTER = 2
+VALIDATOR_LOOKAHEAD = 4  # Candidates considered per free worker
+VALIDATOR_ASYNC_CONCURRENCY = 256  # Validations in flight at once with --async
+
+# Hoster pin workers.  Pins of at least HOSTER_LARGE_PIN_SIZE bytes get their own, smaller pool so
+# they can't hold up small ones.  Bids that fail are left alone for HOSTER_RETRY_DELAY seconds.
+HOSTER_PIN_WORKERS = 8
+HOSTER_LARGE_PIN_WORKERS = 2
+HOSTER_LARGE_PIN_SIZE = 67108864  # 64MiB
+HOSTER_PIN_TIMEOUT = 3600
+HOSTER_RETRY_DELAY = 600
+DEFAULT_IPFS_REPO = '~/.ipfs'
+
+# Hoster bid selection.  Up to HOSTER_PORTFOLIO_EXACT_LIMIT candidates are solved by dynamic
+# programming over storage split into HOSTER_PORTFOLIO_RESOLUTION units.  Bigger sets are solved
+# greedily by reward rate per byte, which gets at least half the best reward.
+HOSTER_PORTFOLIO_EXACT_LIMIT = 64
+HOSTER_PORTFOLIO_RESOLUTION = 1024
+
+# Hoster registrations kept in memory, and for how long (seconds)
+REGISTRATION_CACHE_SIZE = 1024
+REGISTRATION_CACHE_TTL = 3600
+
+# File hash to IPFS hash conversions kept in memory
+CID_CACHE_SIZE = 4096
+
+# IPFS API endpoints (comma separated host:port), request timeout and how long to back off from
+# a failing endpoint, in seconds
+IPFS_DEFAULT_API = '127.0.0.1:5001'
+IPFS_DEFAULT_PORT = 5001
+IPFS_TIMEOUT = 30
+IPFS_BACKOFF_MIN = 1
+IPFS_BACKOFF_MAX = 60
+
+# Proof of pin by sampling.  Enough random blocks are fetched to catch, with the given
+# confidence, a hoster that is missing the given fraction of a file.  Each block fetch is given
+# up on after VALIDATION_BLOCK_TIMEOUT seconds.
+VALIDATION_SAMPLE_CONFIDENCE = 0.99
+VALIDATION_SAMPLE_MISSING = 0.1
+VALIDATION_BLOCK_TIMEOUT = 15
+
+# Swarm connections to hosters kept open per IPFS node, how often (seconds) to check the node's
+# peer list, and the backoff range for unreachable hosters
+SWARM_MAX_PEERS = 100
+SWARM_REFRESH_INTERVAL = 60
+SWARM_BACKOFF_MIN = 5
+SWARM_BACKOFF_MAX = 600
+
+# Largest JSON document (e.g. a registration) read from IPFS
+IPFS_JSON_MAX_BYTES = 1048576  # 1MiB
+
+# Registrations without a $schema or version are validated against this schema
+DEFAULT_REGISTRATION_VERSION = '0.1'
+
 # Default place to locate the configuration file
 DEFAULT_CONFIG_PATH = '~/.scatter/daemon.ini'
 DEFAULT_KEYSTORE_PATH = '~/.ethereum/keystore'
 DEFAULT_DB_FILE = '~/scatter/scatter.db'
 
+# SQLite tuning
+DB_READERS = 4  # Pooled read-only connections
+DB_SYNCHRONOUS = 'NORMAL'  # Safe with WAL, only the last commits can be lost on power failure
+DB_CACHE_SIZE = -16384  # Negative is in KiB, so 16MiB per connection
+DB_MMAP_SIZE = 268435456  # 256MiB
+DB_BUSY_TIMEOUT = 10  # seconds
+
+# Blocks to wait before considering events final
+DEFAULT_CONFIRMATIONS = 12
+
+# eth_getLogs pagination.  Windows are in blocks and adapt between 1 and LOG_FETCH_MAX_WINDOW
+# depending on how many results the provider returns.
+LOG_FETCH_WINDOW = 5000
+LOG_FETCH_MAX_WINDOW = 500000
+LOG_FETCH_TARGET_RESULTS = 1000
+LOG_FETCH_WORKERS = 4
+# A window is only split when the node says it's too big or the request times out.  Other
+# failures (connection refused, 5xx) are retried LOG_FETCH_RETRIES times, backing off from
+# LOG_FETCH_RETRY_DELAY seconds, then raised.
+LOG_FETCH_RETRIES = 3
+LOG_FETCH_RETRY_DELAY = 1
+
+# Maximum eth_calls per JSON-RPC batch request
+RPC_BATCH_SIZE = 100
+
 # Delays, in seconds, for continually running processes
 STD_PROCESS_DELAY = 3
 SETTLED_PROCESS_DELAY = 30
@@ -16,6 +16,9 @@ from .typing import (
     Tuple,
     List,
     Any,
+    Callable,
+    Iterable,
+    Optional,
 )
 from .utils import safe_slice
 from .logging import getLogger
@@ -25,6 +28,13 @@ log = getLogger(__name__)
 THIS_DIR: Path = Path(__file__).parent
 ABI_CACHE: Dict[str, Dict] = {}
 ABI_FILE_DIR: Path = THIS_DIR.joinpath('files')
+# id(abi) -> (abi, decoders by topic0).  The ABI is held so its id can not be reused.
+EVENT_DECODER_CACHE: Dict[int, Tuple[Any, Dict[bytes, 'EventDecoder']]] = {}
+# ABI files of the contracts the router knows, by router name
+ROUTER_ABIS: Dict[str, str] = {
+    'Scatter': 'IScatter.abi',
+    'Register': 'IRegister.abi',
+}
 
 
 class Web3JsonEncoder(json.JSONEncoder):
@@ -57,20 +67,25 @@ def init_router_contract(web3: Web3, address: StrOrBytes) -> Contract:
     return web3.eth.contract(address=address, abi=abi)
 
 
+def router_lookup(router: Contract, name: str) -> Any:
+    """ The router call that gets a contract's address, e.g. router_lookup(router, 'Scatter') """
+    return router.functions.get(Web3.sha3(text=name))
+
+
+def contract_at(web3: Web3, name: str, address: StrOrBytes) -> Contract:
+    """ Initialize a Web3 Contract for a contract the router knows, at an address already looked
+    up """
+    return web3.eth.contract(address=to_account(address), abi=load_abi(ROUTER_ABIS[name]))
+
+
 def init_scatter_contract(web3: Web3, router: Contract) -> Contract:
     """ Initialize a Scatter Web3 Contract """
-    address = router.functions.get(Web3.sha3(text='Scatter')).call()
-    address = to_account(address)
-    abi = load_abi('IScatter.abi')
-    return web3.eth.contract(address=address, abi=abi)
+    return contract_at(web3, 'Scatter', router_lookup(router, 'Scatter').call())
 
 
 def init_register_contract(web3: Web3, router: Contract) -> Contract:
     """ Initialize a Scatter Web3 Contract """
-    address = router.functions.get(Web3.sha3(text='Register')).call()
-    address = to_account(address)
-    abi = load_abi('IRegister.abi')
-    return web3.eth.contract(address=address, abi=abi)
+    return contract_at(web3, 'Register', router_lookup(router, 'Register').call())
 
 
 def gen_signature(abi_entry: dict) -> str:
@@ -94,6 +109,12 @@ def events_from_abi(abi: dict) -> dict:
     return events
 
 
+def event_topics(abi: List[Dict[str, Any]], names: Collection[str]) -> List[str]:
+    """ Get the topic signatures of the named events in an ABI """
+    return [add_0x_prefix(topic.hex()) for topic, decoder in get_event_decoders(abi).items()
+            if decoder.name in names]
+
+
 def get_types_from_inputs(abi_inputs: List[Dict[str, Any]]) -> Tuple[List, List]:
     """ Take the types from an abi and return them as indexed or not """
     indexed_types: List = []
@@ -164,3 +185,157 @@ def event_from_log(abi: Dict[str, Any], event_log: Dict[str, Any]) -> AttrDict:
                 val = data_decoded[i]
             event['args'][name] = val
     return event
+
+
+def _identity(v: Any) -> Any:
+    return v
+
+
+def _indexed_post(v: Any) -> Any:
+    """ Indexed bytes32 and address values are stored 0x prefixed """
+    if isinstance(v, bytes):
+        return add_0x_prefix(v.hex())
+    return v
+
+
+def _data_post(v: Any) -> Any:
+    """ Non-indexed bytes values are stored as unprefixed hex """
+    if isinstance(v, bytes):
+        return v.hex()
+    return v
+
+
+def _to_bytes(v: Any) -> bytes:
+    """ Logs usually already carry bytes, only convert when they don't """
+    if isinstance(v, bytes):
+        return v
+    return HexBytes(v)
+
+
+def _topic_type(abi_type: str) -> str:
+    """ Indexed dynamic types only have their hash in the topic """
+    if abi_type in ('string', 'bytes') or abi_type.endswith(']') or abi_type.startswith('('):
+        return 'bytes32'
+    return abi_type
+
+
+def _word_decoder(abi_type: str) -> Optional[Callable[[bytes], Any]]:
+    """ Get a decoder for a single 32-byte word of a static elementary type, or None if the type
+    needs the full ABI decoder. """
+    if abi_type == 'address':
+        return lambda w: add_0x_prefix(w[12:].hex())
+    elif abi_type == 'bool':
+        return lambda w: w[-1] != 0
+    elif abi_type.startswith('uint'):
+        return lambda w: int.from_bytes(w, 'big')
+    elif abi_type.startswith('int'):
+        return lambda w: int.from_bytes(w, 'big', signed=True)
+    elif abi_type.startswith('bytes') and abi_type[5:].isdigit():
+        size = int(abi_type[5:])
+        return lambda w: w[:size]
+    return None
+
+
+def _word_decoders(types: Tuple[str, ...]) -> Optional[Tuple[Callable, ...]]:
+    """ Get word decoders for all types, or None if any of them is not a static word """
+    decoders = tuple(_word_decoder(t) for t in types)
+    if any(d is None for d in decoders):
+        return None
+    return decoders
+
+
+class EventDecoder(object):
+    """ Decoder for a single event, with everything that can be derived from the ABI computed up
+    front.
+    """
+    __slots__ = ('name', 'topic', 'indexed_types', 'indexed_names', 'indexed_post',
+                 'indexed_words', 'data_types', 'data_names', 'data_post', 'data_words')
+
+    def __init__(self, abi_entry: Dict[str, Any]):
+        self.name: str = abi_entry['name']
+        self.topic: bytes = bytes(HexBytes(gen_signature(abi_entry)))
+
+        indexed = [x for x in abi_entry['inputs'] if x.get('indexed') is True]
+        data = [x for x in abi_entry['inputs'] if x.get('indexed') is False]
+
+        self.indexed_types: Tuple[str, ...] = tuple(_topic_type(x['type']) for x in indexed)
+        self.indexed_names: Tuple[str, ...] = tuple(x['name'] for x in indexed)
+        self.indexed_post: Tuple[Callable, ...] = tuple(
+            _indexed_post if x['type'] in ('bytes32', 'address') else _identity for x in indexed
+        )
+        self.indexed_words = _word_decoders(self.indexed_types)
+
+        self.data_types: Tuple[str, ...] = tuple(x['type'] for x in data)
+        self.data_names: Tuple[str, ...] = tuple(x['name'] for x in data)
+        self.data_post: Tuple[Callable, ...] = tuple(_data_post for x in data)
+        self.data_words = _word_decoders(self.data_types)
+
+    def decode(self, event_log: Dict[str, Any]) -> AttrDict:
+        """ Decode a raw log into an event """
+        args = AttrDict()
+
+        if self.indexed_types:
+            topics = [_to_bytes(t) for t in event_log['topics'][1:len(self.indexed_types) + 1]]
+            if self.indexed_words is not None:
+                values = [dec(t) for dec, t in zip(self.indexed_words, topics)]
+            else:
+                values = decode_abi(self.indexed_types, b''.join(topics))
+            for name, post, val in zip(self.indexed_names, self.indexed_post, values):
+                args[name] = post(val)
+
+        if self.data_types and len(event_log['data']) > 0:
+            data = _to_bytes(event_log['data'])
+            if self.data_words is not None:
+                values = [dec(data[i * 32:(i + 1) * 32])
+                          for i, dec in enumerate(self.data_words)]
+            else:
+                values = decode_abi(self.data_types, data)
+            for name, post, val in zip(self.data_names, self.data_post, values):
+                args[name] = post(val)
+
+        return AttrDict({
+            'args': args,
+            'name': self.name,
+        })
+
+
+def compile_event_decoders(abi: List[Dict[str, Any]]) -> Dict[bytes, EventDecoder]:
+    """ Build decoders for every event in an ABI, keyed by topic0 """
+    decoders: Dict[bytes, EventDecoder] = {}
+    for ent in abi:
+        if ent.get('type') == 'event' and ent.get('inputs'):
+            decoder = EventDecoder(ent)
+            decoders[decoder.topic] = decoder
+    return decoders
+
+
+def get_event_decoders(abi: List[Dict[str, Any]]) -> Dict[bytes, EventDecoder]:
+    """ Get the event decoders for an ABI, compiling them only the first time it's seen """
+    global EVENT_DECODER_CACHE
+    cached = EVENT_DECODER_CACHE.get(id(abi))
+    if cached is not None and cached[0] is abi:
+        return cached[1]
+    decoders = compile_event_decoders(abi)
+    if len(EVENT_DECODER_CACHE) >= 32:
+        EVENT_DECODER_CACHE.clear()
+    EVENT_DECODER_CACHE[id(abi)] = (abi, decoders)
+    return decoders
+
+
+def decode_logs(decoders: Dict[bytes, EventDecoder],
+                logs: Iterable[Dict[str, Any]]) -> List[AttrDict]:
+    """ Decode a batch of raw logs into events, skipping any without a decoder """
+    events: List[AttrDict] = []
+    for event_log in logs:
+        topics = event_log['topics']
+        if not topics:
+            continue
+        decoder: Optional[EventDecoder] = decoders.get(_to_bytes(topics[0]))
+        if decoder is None:
+            continue
+        event = decoder.decode(event_log)
+        event['txhash'] = HexBytes(event_log['transactionHash']).hex()
+        event['block_number'] = event_log['blockNumber']
+        event['log_index'] = event_log['logIndex']
+        events.append(event)
+    return events
@@ -3,3 +3,4 @@ class ScatterError(Exception): pass
 class ConfigurationError(ScatterError): pass
 class StorageError(ScatterError): pass
 class ValidatorError(ScatterError): pass
+class HosterError(ScatterError): pass
@@ -1,46 +1,331 @@
-import os
 import json
-import tempfile
+import time
+import threading
 import ipfsapi
-from pathlib import Path
-from multihash import from_hex_string, to_b58_string
-from eth_utils import is_0x_prefixed, remove_0x_prefix, is_hex
-from .typing import Optional, Dict, Any, PS
-from .exceptions import ScatterError
-
-
-def ipfs_get_json(ipfs_conn: ipfsapi.client.Client, file_hash: str, tmpdir: Optional[PS] = None) -> Dict[str, Any]:
-    """ Perform an ipfs.get and return the json object as a Python dict """
-
-    if isinstance(file_hash, bytes):
-        file_hash = to_b58_string(from_hex_string('1220' + remove_0x_prefix(file_hash.hex())))
-    elif is_0x_prefixed(file_hash):
-        file_hash = to_b58_string(from_hex_string('1220' + remove_0x_prefix(file_hash)))
-    elif is_hex(file_hash):
-        file_hash = to_b58_string(from_hex_string('1220' + file_hash))
-    elif file_hash.startswith('Qm'):
-        pass
-    else:
-        raise ValueError("Invalid file_hash")
-
-    with tempfile.TemporaryDirectory(dir=tmpdir) as _workdir:
-        workdir = Path(_workdir)
-        orig_dir = Path.cwd()
-        assert orig_dir is not None
-        os.chdir(workdir)
-
-        ipfs_conn.get(file_hash)
-
-        downloaded: Path = workdir.joinpath(file_hash)
-        if not downloaded.exists() or not downloaded.is_file():
-            raise ScatterError("Download filed.  File not found.")
-
-        contents = ''
-        with downloaded.open() as _userfile:
-            userfile_text = _userfile.read()
-            print("Downloaded... {}".format(userfile_text))
-            contents = json.loads(userfile_text)
-
-        os.chdir(orig_dir)
-        downloaded.unlink()
-        return contents
+from contextlib import contextmanager
+from ipfsapi.exceptions import (
+    ConnectionError as IPFSConnectionError,
+    TimeoutError as IPFSTimeoutError,
+    ProtocolError as IPFSProtocolError,
+)
+from .cid import to_cid
+from .config import ConfigParser, config_get
+from .const import (
+    IPFS_JSON_MAX_BYTES,
+    IPFS_DEFAULT_API,
+    IPFS_DEFAULT_PORT,
+    IPFS_TIMEOUT,
+    IPFS_BACKOFF_MIN,
+    IPFS_BACKOFF_MAX,
+)
+from .typing import Optional, Dict, Any, StrOrBytes, List, Tuple, Callable, Iterator
+from .exceptions import ScatterError, ConfigurationError
+from .logging import getLogger
+
+log = getLogger(__name__)
+
+# Errors that mean the endpoint itself is in trouble
+IPFS_ENDPOINT_ERRORS = (IPFSConnectionError, IPFSTimeoutError, IPFSProtocolError)
+
+
+def json_from_buffer(buf: bytes, file_hash: str) -> Any:
+    """ Parse a JSON file fetched from IPFS """
+    try:
+        return json.loads(buf.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError) as err:
+        raise ScatterError("{} is not a valid JSON file".format(file_hash)) from err
+
+
+def ipfs_get_json(ipfs_conn: ipfsapi.client.Client, file_hash: StrOrBytes,
+                  max_bytes: int = IPFS_JSON_MAX_BYTES,
+                  timeout: Optional[float] = None) -> Dict[str, Any]:
+    """ Fetch a JSON file with ipfs cat and return it as a Python dict.  The file is read into
+    memory as it streams in, and files larger than max_bytes are rejected without reading the
+    rest. """
+    file_hash = to_cid(file_hash)
+
+    kwargs: Dict[str, Any] = {'stream': True}
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+
+    # One byte past the limit is enough to know the file is too large
+    chunks = ipfs_conn.cat(file_hash, length=max_bytes + 1, **kwargs)
+    buf = bytearray()
+
+    try:
+        for chunk in chunks:
+            buf.extend(chunk)
+            if len(buf) > max_bytes:
+                raise ScatterError("{} is larger than {} bytes".format(file_hash, max_bytes))
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+    return json_from_buffer(bytes(buf), file_hash)
+
+
+def parse_ipfs_endpoints(value: str) -> List[Tuple[str, int]]:
+    """ Parse a comma separated list of IPFS API host:port pairs """
+    endpoints: List[Tuple[str, int]] = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.rpartition(':')
+        if not host:
+            host, port = port, str(IPFS_DEFAULT_PORT)
+        try:
+            endpoints.append((host, int(port)))
+        except ValueError:
+            raise ConfigurationError("Invalid IPFS API endpoint {}".format(item))
+    if len(endpoints) < 1:
+        raise ConfigurationError("No IPFS API endpoints configured")
+    return endpoints
+
+
+class IPFSClient(ipfsapi.Client):
+    """ ipfsapi's client, with the API calls it doesn't have """
+    def block_rm(self, *multihashes: str, **kwargs: Any) -> Any:
+        """ Remove blocks from the node's repo.  The daemon refuses to remove pinned ones. """
+        return self._client.request('/block/rm', multihashes, decoder='json', **kwargs)
+
+
+class IPFSEndpoint:
+    """ An IPFS API endpoint and how it's been doing """
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.in_flight = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self.latency = 0.0
+        self._client: Optional[IPFSClient] = None
+
+    def __repr__(self):
+        return '<IPFSEndpoint {}>'.format(self.name)
+
+    @property
+    def name(self) -> str:
+        return '{}:{}'.format(self.host, self.port)
+
+    @property
+    def client(self) -> IPFSClient:
+        """ Client with a keep-alive session, created on first use """
+        if self._client is None:
+            self._client = IPFSClient(self.host, self.port, session=True)
+        return self._client
+
+    def available(self, now: float) -> bool:
+        return self.down_until <= now
+
+    def succeeded(self, elapsed: float) -> None:
+        self.failures = 0
+        self.down_until = 0.0
+        self.latency = elapsed if self.latency == 0 else (self.latency * 0.8 + elapsed * 0.2)
+
+    def failed(self, now: float) -> None:
+        """ Back off exponentially while the endpoint keeps failing """
+        self.failures += 1
+        backoff = min(IPFS_BACKOFF_MAX, IPFS_BACKOFF_MIN * 2 ** (self.failures - 1))
+        self.down_until = now + backoff
+        log.warning("IPFS API {}:{} failed.  Not using it for {}s.".format(self.host, self.port,
+                                                                          backoff))
+
+
+class IPFSRouter:
+    """ Route requests between IPFS API endpoints.  Each request goes to the healthy endpoint
+    with the fewest requests in flight, then the lowest latency.  If every endpoint is backing
+    off, the one that's due back first is used anyway. """
+    def __init__(self, endpoints: List[Tuple[str, int]], timeout: Optional[float] = IPFS_TIMEOUT):
+        self.endpoints = [IPFSEndpoint(host, port) for host, port in endpoints]
+        self.timeout = timeout
+        self.lock = threading.Lock()
+
+    def acquire(self) -> IPFSEndpoint:
+        """ Pick an endpoint and count a request against it """
+        if len(self.endpoints) < 1:
+            raise ScatterError("No IPFS endpoints configured")
+
+        now = time.monotonic()
+        with self.lock:
+            healthy = [ep for ep in self.endpoints if ep.available(now)]
+            if healthy:
+                endpoint = min(healthy, key=lambda ep: (ep.in_flight, ep.latency))
+            else:
+                endpoint = min(self.endpoints, key=lambda ep: ep.down_until)
+            endpoint.in_flight += 1
+            return endpoint
+
+    def record(self, endpoint: IPFSEndpoint, ok: bool, elapsed: float) -> None:
+        """ Record the outcome of a request """
+        with self.lock:
+            if ok:
+                endpoint.succeeded(elapsed)
+            else:
+                endpoint.failed(time.monotonic())
+
+    def release(self, endpoint: IPFSEndpoint, ok: bool, elapsed: float) -> None:
+        """ Record the outcome of a request from acquire() """
+        with self.lock:
+            endpoint.in_flight -= 1
+        self.record(endpoint, ok, elapsed)
+
+
+class StreamedResponse:
+    """ A response from a `stream=True` call.  The request isn't over until the stream has been
+    read or closed, so done(ok) is only called then, once. """
+    def __init__(self, chunks: Any, done: Callable[[bool], None]):
+        self.chunks = chunks
+        self.iterator = iter(chunks)
+        self.done: Optional[Callable[[bool], None]] = done
+
+    def _finish(self, ok: bool) -> None:
+        done, self.done = self.done, None
+        if done is not None:
+            done(ok)
+
+    def __iter__(self) -> 'StreamedResponse':
+        return self
+
+    def __next__(self) -> Any:
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self._finish(True)
+            raise
+        except IPFS_ENDPOINT_ERRORS:
+            self._finish(False)
+            raise
+        except Exception:
+            self._finish(True)
+            raise
+
+    def close(self) -> None:
+        try:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+        finally:
+            self._finish(True)
+
+    def __del__(self) -> None:
+        self._finish(True)
+
+
+class IPFSNode:
+    """ A client bound to one of a pool's endpoints, for work that has to stay on the same IPFS
+    daemon, like using a swarm connection.  See IPFSPool.checkout(). """
+    def __init__(self, router: IPFSRouter, endpoint: IPFSEndpoint):
+        self.router = router
+        self.endpoint = endpoint
+
+    @property
+    def name(self) -> str:
+        return self.endpoint.name
+
+    def __getattr__(self, name: str) -> Callable:
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            if self.router.timeout is not None:
+                kwargs.setdefault('timeout', self.router.timeout)
+
+            start = time.monotonic()
+
+            def done(ok: bool) -> None:
+                self.router.record(self.endpoint, ok, time.monotonic() - start)
+
+            try:
+                result = getattr(self.endpoint.client, name)(*args, **kwargs)
+            except IPFS_ENDPOINT_ERRORS:
+                done(False)
+                raise
+
+            if kwargs.get('stream'):
+                return StreamedResponse(result, done)
+
+            done(True)
+            return result
+
+        return call
+
+
+class IPFSPool(IPFSRouter):
+    """ Drop-in for an ipfsapi client that spreads calls over several IPFS API endpoints, each
+    with a keep-alive session.  Calls get the pool's timeout unless they give their own.
+
+    Only failures to talk to an endpoint (connection errors, timeouts) count against it, and
+    refused connections are retried on another endpoint.  Error responses from a working daemon
+    are passed on as they are.  A `stream=True` call counts as in flight until its stream has
+    been read or closed.
+    """
+    @contextmanager
+    def checkout(self) -> Iterator[IPFSNode]:
+        """ Use a single endpoint, picked like any other request, for a block of work """
+        endpoint = self.acquire()
+        try:
+            yield IPFSNode(self, endpoint)
+        finally:
+            with self.lock:
+                endpoint.in_flight -= 1
+
+    def __getattr__(self, name: str) -> Callable:
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            if self.timeout is not None:
+                kwargs.setdefault('timeout', self.timeout)
+
+            if len(self.endpoints) < 1:
+                raise ScatterError("No IPFS endpoints configured")
+
+            # A refused connection fails fast, so try the next endpoint.  Timeouts aren't
+            # retried, they've already cost the caller their wait.
+            for attempt in range(len(self.endpoints)):
+                endpoint = self.acquire()
+                start = time.monotonic()
+
+                def done(ok: bool, endpoint: IPFSEndpoint = endpoint,
+                         start: float = start) -> None:
+                    self.release(endpoint, ok, time.monotonic() - start)
+
+                try:
+                    result = getattr(endpoint.client, name)(*args, **kwargs)
+                except IPFSConnectionError:
+                    done(False)
+                    if attempt + 1 >= len(self.endpoints):
+                        raise
+                    continue
+                except IPFS_ENDPOINT_ERRORS:
+                    done(False)
+                    raise
+                except BaseException:
+                    done(True)
+                    raise
+
+                # Streams hold the endpoint until they've been read
+                if kwargs.get('stream'):
+                    return StreamedResponse(result, done)
+
+                done(True)
+                return result
+
+        return call
+
+
+def ipfs_endpoints_from_config(conf: ConfigParser, section: str) -> List[Tuple[str, int]]:
+    """ The IPFS API endpoints from a section's ipfs_api option """
+    return parse_ipfs_endpoints(config_get(conf, 'ipfs_api', IPFS_DEFAULT_API, section=section))
+
+
+def ipfs_timeout_from_config(conf: ConfigParser, section: str) -> Optional[float]:
+    """ The request timeout from a section's ipfs_timeout option.  0 disables it. """
+    timeout = float(config_get(conf, 'ipfs_timeout', IPFS_TIMEOUT, section=section))
+    return timeout if timeout > 0 else None
+
+
+def ipfs_pool_from_config(conf: ConfigParser, section: str) -> IPFSPool:
+    """ Create an IPFSPool from the ipfs_api and ipfs_timeout options in a config section """
+    return IPFSPool(ipfs_endpoints_from_config(conf, section),
+                    ipfs_timeout_from_config(conf, section))
@@ -0,0 +1,190 @@
+""" Keep IPFS swarm connections to hosters open between validations """
+import time
+import threading
+from collections import OrderedDict
+from .const import (
+    SWARM_MAX_PEERS,
+    SWARM_REFRESH_INTERVAL,
+    SWARM_BACKOFF_MIN,
+    SWARM_BACKOFF_MAX,
+)
+from .typing import Any, Dict, List, Optional, Set
+from .logging import getLogger
+
+log = getLogger(__name__)
+
+PEER_CONNECTED = 'connected'
+PEER_CONNECT = 'connect'
+PEER_BACKOFF = 'backoff'
+
+
+def peer_id_from_multiaddr(multiaddr: str) -> Optional[str]:
+    """ Get the peer ID from a multiaddr like /ip4/1.2.3.4/tcp/4001/ipfs/Qm... """
+    parts = multiaddr.rstrip('/').split('/')
+    for proto in ('ipfs', 'p2p'):
+        if proto in parts:
+            idx = parts.index(proto)
+            if idx + 1 < len(parts):
+                return parts[idx + 1]
+    return None
+
+
+def node_name(ipfs: Any) -> str:
+    """ Swarm connections belong to an IPFS daemon, so peers are tracked per endpoint.  Clients
+    that aren't bound to one endpoint are tracked on their own. """
+    name = getattr(ipfs, 'name', None)
+    if isinstance(name, str):
+        return name
+    return str(id(ipfs))
+
+
+class SwarmPeer:
+    """ A hoster's IPFS node, as seen from one of ours """
+    __slots__ = ('multiaddr', 'peer_id', 'connected', 'last_used', 'failures', 'retry_at')
+
+    def __init__(self, multiaddr: str):
+        self.multiaddr = multiaddr
+        self.peer_id = peer_id_from_multiaddr(multiaddr)
+        self.connected = False
+        self.last_used = 0.0
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class SwarmManager:
+    """ Track swarm connections from our IPFS nodes to hosters.
+
+    Connected hosters are reused without connecting again.  Hosters that can't be reached are
+    retried with exponential backoff.  Each of our nodes keeps at most max_peers connections,
+    disconnecting from the peer that has gone unused the longest when it needs room.  The node's
+    actual peer list is checked every refresh_interval seconds, since IPFS drops connections on
+    its own.
+
+    connect() and refresh() do the IPFS calls for a blocking client.  The bookkeeping methods
+    they use are public so an async client can do the same.
+    """
+    def __init__(self, max_peers: int = SWARM_MAX_PEERS,
+                 refresh_interval: float = SWARM_REFRESH_INTERVAL):
+        self.max_peers = max_peers
+        self.refresh_interval = refresh_interval
+        self.nodes: Dict[str, OrderedDict] = {}
+        self.refreshed: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def _peers(self, node: str) -> OrderedDict:
+        if node not in self.nodes:
+            self.nodes[node] = OrderedDict()
+        return self.nodes[node]
+
+    def status(self, node: str, multiaddr: str) -> str:
+        """ Whether a node is connected to a peer, should connect, or is backing off """
+        now = time.monotonic()
+        with self.lock:
+            peers = self._peers(node)
+            peer = peers.get(multiaddr)
+
+            if peer is None:
+                return PEER_CONNECT
+
+            peers.move_to_end(multiaddr)
+            peer.last_used = now
+
+            if peer.connected:
+                return PEER_CONNECTED
+            if peer.retry_at > now:
+                return PEER_BACKOFF
+            return PEER_CONNECT
+
+    def connected(self, node: str, multiaddr: str, ok: bool) -> List[str]:
+        """ Record the result of a connect.  Returns the peers to disconnect to stay in budget. """
+        now = time.monotonic()
+        evict: List[str] = []
+
+        with self.lock:
+            peers = self._peers(node)
+            peer = peers.get(multiaddr)
+            if peer is None:
+                peer = peers[multiaddr] = SwarmPeer(multiaddr)
+            peers.move_to_end(multiaddr)
+            peer.last_used = now
+
+            if ok:
+                peer.connected = True
+                peer.failures = 0
+                peer.retry_at = 0.0
+            else:
+                peer.connected = False
+                peer.failures += 1
+                backoff = min(SWARM_BACKOFF_MAX, SWARM_BACKOFF_MIN * 2 ** (peer.failures - 1))
+                peer.retry_at = now + backoff
+                log.debug("Unable to connect to {}.  Retrying in {}s.".format(multiaddr, backoff))
+
+            # Least recently used first
+            connected = [p for p in peers.values() if p.connected]
+            for old in connected[:max(0, len(connected) - self.max_peers)]:
+                old.connected = False
+                evict.append(old.multiaddr)
+
+            # Forget peers that are neither connected nor backing off
+            for addr in [a for a, p in peers.items() if not p.connected and p.retry_at <= now
+                         and a != multiaddr]:
+                del peers[addr]
+
+        return evict
+
+    def needs_refresh(self, node: str) -> bool:
+        return time.monotonic() - self.refreshed.get(node, 0) >= self.refresh_interval
+
+    def live_peers(self, node: str, peer_ids: Set[str]) -> None:
+        """ Update from the node's actual peer list """
+        with self.lock:
+            self.refreshed[node] = time.monotonic()
+            for peer in self._peers(node).values():
+                if peer.connected and peer.peer_id not in peer_ids:
+                    log.debug("Lost connection to {}".format(peer.multiaddr))
+                    peer.connected = False
+
+    def reachable(self, multiaddr: str) -> Optional[bool]:
+        """ Whether any of our nodes can reach a peer, or None if we haven't tried """
+        with self.lock:
+            seen = [peers[multiaddr] for peers in self.nodes.values() if multiaddr in peers]
+        if not seen:
+            return None
+        return any(p.connected or p.failures == 0 for p in seen)
+
+    def refresh(self, ipfs: Any) -> None:
+        """ Check which peers a node is still connected to """
+        peers = ipfs.swarm_peers()
+        self.live_peers(node_name(ipfs), {p.get('Peer') for p in peers.get('Peers') or []})
+
+    def connect(self, ipfs: Any, multiaddr: str) -> bool:
+        """ Make sure a node is connected to a peer, connecting only if it isn't already.  Returns
+        False if the peer can't be reached. """
+        node = node_name(ipfs)
+
+        if self.needs_refresh(node):
+            try:
+                self.refresh(ipfs)
+            except Exception as err:
+                log.warning("Unable to list swarm peers: {}".format(err))
+
+        status = self.status(node, multiaddr)
+        if status == PEER_CONNECTED:
+            return True
+        elif status == PEER_BACKOFF:
+            return False
+
+        ok = False
+        try:
+            resp = ipfs.swarm_connect(multiaddr)
+            ok = any('success' in ln for ln in resp.get('Strings', []))
+        except Exception as err:
+            log.debug("swarm connect to {} failed: {}".format(multiaddr, err))
+
+        for addr in self.connected(node, multiaddr, ok):
+            try:
+                ipfs.swarm_disconnect(addr)
+            except Exception as err:
+                log.debug("swarm disconnect from {} failed: {}".format(addr, err))
+
+        return ok
@@ -0,0 +1,59 @@
+""" Sign and send transactions from the daemon's account """
+import threading
+from web3 import Web3
+from hexbytes import HexBytes
+from .const import TX_RECEIPT_TIMEOUT
+from .typing import Any, Dict, Optional
+from .logging import getLogger
+
+log = getLogger(__name__)
+
+
+class TransactionSender:
+    """ Sends transactions from one account, from any number of threads.  Nonces are handed out
+    locally under a lock, so transactions can be sent back to back without waiting for the
+    previous one to be mined.  If a send fails, the nonce is read from the node again. """
+    def __init__(self, web3: Web3, account: str, private_key: bytes,
+                 gas_price: Optional[int] = None):
+        self.web3 = web3
+        self.account = account
+        self.private_key = private_key
+        self.gas_price = gas_price
+        self.nonce: Optional[int] = None
+        self.lock = threading.Lock()
+
+    def send(self, fn: Any, gas: int) -> HexBytes:
+        """ Send a prepared contract function, e.g. contract.functions.accept(1).  Returns the
+        transaction hash. """
+        with self.lock:
+            if self.nonce is None:
+                self.nonce = self.web3.eth.getTransactionCount(self.account, 'pending')
+
+            tx: Dict[str, Any] = fn.buildTransaction({
+                'from': self.account,
+                'nonce': self.nonce,
+                'gas': gas,
+                'gasPrice': self.gas_price or self.web3.eth.gasPrice,
+            })
+            signed = self.web3.eth.account.signTransaction(tx, self.private_key)
+
+            try:
+                tx_hash = self.web3.eth.sendRawTransaction(signed.rawTransaction)
+            except Exception:
+                # We don't know if the node took it, so ask it next time
+                self.nonce = None
+                raise
+
+            self.nonce += 1
+
+        log.debug("Sent transaction {} with nonce {}".format(tx_hash.hex(), tx['nonce']))
+        return tx_hash
+
+    def wait(self, tx_hash: HexBytes, timeout: int = TX_RECEIPT_TIMEOUT) -> bool:
+        """ Wait for a transaction to be mined.  Returns whether it succeeded. """
+        receipt = self.web3.eth.waitForTransactionReceipt(tx_hash, timeout=timeout)
+        return receipt is not None and receipt.get('status', 1) == 1
+
+    def transact(self, fn: Any, gas: int, timeout: int = TX_RECEIPT_TIMEOUT) -> bool:
+        """ Send a transaction and wait for it to be mined """
+        return self.wait(self.send(fn, gas), timeout)
@@ -7,8 +7,12 @@ from typing import (  # noqa: F401
     List,
     Tuple,
     Iterable,
+    Iterator,
+    Generator,
     Collection,
+    Sequence,
     Set,
+    Hashable,
 )
 from pathlib import Path
 from eth_utils import is_address, to_normalized_address
@@ -1,12 +1,41 @@
 """ Handles web3 related operations """
-from typing import Callable, List
+import time
+import asyncio
+import itertools
+import requests
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, List, Iterator
+from hexbytes import HexBytes
+from eth_abi import encode_abi, decode_abi
+from eth_utils import function_abi_to_4byte_selector, to_checksum_address, encode_hex
 from web3 import Web3
 from web3.providers import HTTPProvider, WebsocketProvider, IPCProvider
 from .config import ConfigParser, ROOT_EL, config_get
+from .const import (
+    LOG_FETCH_WINDOW,
+    LOG_FETCH_MAX_WINDOW,
+    LOG_FETCH_TARGET_RESULTS,
+    LOG_FETCH_WORKERS,
+    LOG_FETCH_RETRIES,
+    LOG_FETCH_RETRY_DELAY,
+    RPC_BATCH_SIZE,
+)
+from .typing import Optional, Dict, Tuple, Any, Union, StrOrBytes
 from .logging import getLogger
 
 log = getLogger(__name__)
 
+# Keep-alive session for batch requests
+rpc_session = requests.Session()
+rpc_ids = itertools.count(1)
+
+# What nodes say when an eth_getLogs range, or its result, is too big.  e.g. "query returned more
+# than 10000 results", "exceed maximum block range: 5000", "query timeout exceeded"
+LOG_RANGE_ERROR_MESSAGES = ('more than', 'too many', 'too large', 'too big', 'block range',
+                            'limit exceeded', 'response size', 'timeout', 'timed out')
+# JSON-RPC "limit exceeded"
+LOG_RANGE_ERROR_CODES = (-32005,)
+
 
 def resolve_web3_provider(s: str) -> Callable:
     """ Return a provider from a type from config """
@@ -39,3 +68,226 @@ def eth_getLogs(web3, from_block: str, address: str, to_block: str = 'latest', t
         'topics': topics,
     }
     return web3.eth.getLogs(params)
+
+
+def is_log_range_error(err: Exception) -> bool:
+    """ Whether an eth_getLogs failure means the range should be split, rather than that the
+    node is unreachable or broken """
+    if isinstance(err, requests.ConnectionError):
+        return False
+    if isinstance(err, (requests.Timeout, asyncio.TimeoutError)):
+        return True
+    if isinstance(err, requests.HTTPError):
+        return False
+
+    for arg in err.args:
+        if isinstance(arg, dict) and arg.get('code') in LOG_RANGE_ERROR_CODES:
+            return True
+
+    message = str(err).lower()
+    return any(m in message for m in LOG_RANGE_ERROR_MESSAGES)
+
+
+def get_logs_retrying(web3: Web3, address: str, start: int, end: int, topics: List,
+                      retries: int = LOG_FETCH_RETRIES) -> List:
+    """ eth_getLogs for a block range.  Transport errors are retried with backoff, errors that
+    mean the range is too big are raised straight away for the caller to split. """
+    delay = LOG_FETCH_RETRY_DELAY
+    while True:
+        try:
+            return eth_getLogs(web3, from_block=hex(start), to_block=hex(end), address=address,
+                               topics=topics)
+        except Exception as err:
+            if is_log_range_error(err) or retries < 1:
+                raise
+            log.warning("Fetching logs for {}-{} failed ({}).  Retrying in {}s.".format(
+                start, end, err, delay
+            ))
+            time.sleep(delay)
+            delay *= 2
+            retries -= 1
+
+
+class LogWindowPlanner:
+    """ Plans the block windows to fetch logs for, without doing any I/O, so the threaded and the
+    asyncio engines share one policy.  The driver fetches what next_windows() returns, reports
+    each result to finished() or failed(), and takes the logs in block order from ready().
+
+    The window doubles while providers return few results and halves when they return too
+    many.  A window the node says is too big, or that times out, is split in two and retried,
+    down to a single block.  Anything else is raised.
+    """
+    def __init__(self, from_block: int, to_block: int, window: int = LOG_FETCH_WINDOW,
+                 workers: int = LOG_FETCH_WORKERS):
+        self.to_block = to_block
+        self.window = max(1, window)
+        self.workers = max(1, workers)
+        self.next_start = from_block
+        self.next_yield = from_block
+        self.pending = 0
+        self.splits: List[Tuple[int, int]] = []
+        self.fetched: Dict[int, Tuple[int, List]] = {}
+
+    def done(self) -> bool:
+        return self.next_yield > self.to_block
+
+    def next_windows(self) -> List[Tuple[int, int]]:
+        """ The windows to start fetching now.  Keeps workers busy without buffering too far
+        ahead of the consumer. """
+        windows = self.splits
+        self.splits = []
+
+        while (self.next_start <= self.to_block and self.pending + len(windows) < self.workers
+               and len(self.fetched) < self.workers * 4):
+            end = min(self.next_start + self.window - 1, self.to_block)
+            windows.append((self.next_start, end))
+            self.next_start = end + 1
+
+        self.pending += len(windows)
+        return windows
+
+    def finished(self, start: int, end: int, logs: List) -> None:
+        self.pending -= 1
+
+        if len(logs) > LOG_FETCH_TARGET_RESULTS:
+            self.window = max(1, self.window // 2)
+        elif len(logs) < LOG_FETCH_TARGET_RESULTS // 4:
+            self.window = min(LOG_FETCH_MAX_WINDOW, self.window * 2)
+
+        self.fetched[start] = (end, logs)
+
+    def failed(self, start: int, end: int, err: Exception) -> None:
+        """ Split a window that was too big, or raise err """
+        self.pending -= 1
+
+        if start == end or not is_log_range_error(err):
+            log.error("Unable to fetch logs for blocks {}-{}".format(start, end))
+            raise err
+
+        middle = (start + end) // 2
+        self.window = max(1, (end - start + 1) // 2)
+        log.debug("Fetching logs for {}-{} failed ({}).  Splitting.".format(start, end, err))
+        self.splits.extend([(start, middle), (middle + 1, end)])
+
+    def ready(self) -> Iterator[Tuple[int, int, List]]:
+        """ (start_block, end_block, logs) for the windows that are next in block order """
+        while self.next_yield in self.fetched:
+            start = self.next_yield
+            end, logs = self.fetched.pop(start)
+            self.next_yield = end + 1
+            yield start, end, logs
+
+
+def iter_logs(web3: Web3, address: str, from_block: int, to_block: int,
+              topics: Optional[List] = None, window: int = LOG_FETCH_WINDOW,
+              workers: int = LOG_FETCH_WORKERS) -> Iterator[Tuple[int, int, List]]:
+    """ Fetch logs for a block range on a thread pool, in windows planned by LogWindowPlanner,
+    and yield (start_block, end_block, logs) in block order.  Transport errors are retried a few
+    times, then raised. """
+    planner = LogWindowPlanner(from_block, to_block, window, workers)
+    pending: Dict[Future, Tuple[int, int]] = {}
+
+    with ThreadPoolExecutor(max_workers=planner.workers) as executor:
+        while not planner.done():
+            for start, end in planner.next_windows():
+                fut = executor.submit(get_logs_retrying, web3, address, start, end, topics or [])
+                pending[fut] = (start, end)
+
+            finished, _ = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+
+            for fut in finished:
+                start, end = pending.pop(fut)
+                try:
+                    logs = fut.result()
+                except Exception as err:
+                    planner.failed(start, end, err)
+                    continue
+                planner.finished(start, end, logs)
+
+            yield from planner.ready()
+
+
+def encode_call(fn: Any) -> Dict[str, str]:
+    """ Build the eth_call transaction for a prepared contract function,
+    e.g. contract.functions.getBid(1) """
+    input_types = [x['type'] for x in fn.abi['inputs']]
+    data = function_abi_to_4byte_selector(fn.abi) + encode_abi(input_types, fn.args)
+    return {
+        'to': fn.address,
+        'data': encode_hex(data),
+    }
+
+
+def decode_call_result(fn: Any, result: StrOrBytes) -> Any:
+    """ Decode eth_call output the way ContractFunction.call() would """
+    output_types = [x['type'] for x in fn.abi['outputs']]
+    values = [
+        to_checksum_address(v) if t == 'address' else v
+        for t, v in zip(output_types, decode_abi(output_types, HexBytes(result)))
+    ]
+    if len(values) == 1:
+        return values[0]
+    return values
+
+
+def _post_batch(provider: HTTPProvider,
+                payload: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+    """ Send a JSON-RPC batch and return the responses in request order, or None if the node
+    doesn't support batches.  Nodes that reject batches either answer with a client error or
+    with something other than a list. """
+    resp = rpc_session.post(provider.endpoint_uri, json=payload, **provider.get_request_kwargs())
+    if 400 <= resp.status_code < 500:
+        log.debug("Batch rejected with HTTP {}".format(resp.status_code))
+        return None
+    resp.raise_for_status()
+    try:
+        results = resp.json()
+    except ValueError:
+        return None
+    if not isinstance(results, list) or len(results) != len(payload):
+        return None
+    by_id = {r.get('id'): r for r in results}
+    return [by_id.get(req['id'], {'error': 'Missing response'}) for req in payload]
+
+
+def batch_call(web3: Web3, fns: List[Any], block_identifier: Optional[Union[int, str]] = None,
+               batch_size: int = RPC_BATCH_SIZE) -> List[Any]:
+    """ Run many contract calls against the same block and return their results in order.
+
+    Over HTTP the calls are sent as JSON-RPC batches of up to batch_size.  Other providers, or
+    nodes that refuse batches, get one eth_call per function.
+    """
+    if len(fns) < 1:
+        return []
+
+    if block_identifier is None:
+        block_identifier = web3.eth.blockNumber
+    block = hex(block_identifier) if isinstance(block_identifier, int) else block_identifier
+
+    provider = web3.providers[0]
+    results: List[Any] = []
+
+    if isinstance(provider, HTTPProvider):
+        for i in range(0, len(fns), batch_size):
+            chunk = fns[i:i + batch_size]
+            payload = [{
+                'jsonrpc': '2.0',
+                'id': next(rpc_ids),
+                'method': 'eth_call',
+                'params': [encode_call(fn), block],
+            } for fn in chunk]
+
+            responses = _post_batch(provider, payload)
+            if responses is None:
+                log.warning("Node does not support JSON-RPC batches.  Using single calls.")
+                break
+
+            for fn, resp in zip(chunk, responses):
+                if 'error' in resp:
+                    raise ValueError(resp['error'])
+                results.append(decode_call_result(fn, resp['result']))
+
+    for fn in fns[len(results):]:
+        results.append(fn.call(block_identifier=block_identifier))
+
+    return results
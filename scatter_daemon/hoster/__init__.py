@@ -0,0 +1 @@
+from .main import hoster_run  # noqa: F401
@@ -0,0 +1,86 @@
+""" Admission of bids against the hoster's storage """
+import threading
+from pathlib import Path
+from ..common.utils import is_free_space_available
+from ..common.typing import Dict, Optional
+from ..common.logging import getLogger
+
+log = getLogger(__name__)
+
+
+class StorageBudget:
+    """ Keeps the files being pinned, plus the ones already hosted, within max_storage and the
+    free space on the IPFS repo's disk.
+
+    Space is reserved for a bid before it's accepted and released if hosting fails, so pins that
+    are still downloading are counted and the pipeline never commits to more than fits.
+    """
+    def __init__(self, max_storage: int, repo_path: Optional[Path] = None):
+        self.max_storage = max_storage
+        self.repo_path = repo_path
+        self.hosted = 0
+        # What set_hosted() was given, bid ID -> size
+        self.hosted_bids: Dict[int, int] = {}
+        self.reserved: Dict[int, int] = {}
+        # Hosted by us, but the events saying so haven't been synced yet
+        self.unsynced: Dict[int, int] = {}
+        self.lock = threading.Lock()
+
+        if repo_path is not None and not repo_path.exists():
+            log.warning("IPFS repo {} not found.  Only max_storage will be checked.".format(
+                repo_path
+            ))
+            self.repo_path = None
+
+    @property
+    def committed(self) -> int:
+        """ Bytes hosted or reserved """
+        return self.hosted + sum(self.reserved.values())
+
+    def set_hosted(self, hosted: Dict[int, int]) -> None:
+        """ Update what's hosted from the DB, as bid ID -> file size.  Bids that are still
+        reserved are already counted. """
+        with self.lock:
+            for bid_id in hosted:
+                self.unsynced.pop(bid_id, None)
+            self.hosted_bids = dict(hosted)
+            self.hosted = sum(size for bid_id, size in hosted.items()
+                              if bid_id not in self.reserved) + sum(self.unsynced.values())
+
+    def reserve(self, bid_id: int, size: int) -> bool:
+        """ Reserve space for a bid.  Returns False if it doesn't fit.  Bids that are already
+        hosted, like ones we've accepted but not pinned, are within max_storage already and only
+        need the disk space. """
+        with self.lock:
+            if bid_id in self.reserved:
+                return True
+
+            counted = self.hosted_bids.get(bid_id)
+            if counted is None and self.committed + size > self.max_storage:
+                return False
+
+            # Reservations haven't been written yet, so they count against the free space too
+            pending = sum(self.reserved.values())
+            if (self.repo_path is not None
+                    and not is_free_space_available(self.repo_path, pending + size)):
+                return False
+
+            # Counted as reserved from now on, like set_hosted() does
+            if counted is not None:
+                self.hosted -= counted
+            self.reserved[bid_id] = size
+            return True
+
+    def release(self, bid_id: int) -> None:
+        """ Give back a bid's reservation after it failed.  A bid that was already hosted still
+        is. """
+        with self.lock:
+            if self.reserved.pop(bid_id, None) is not None and bid_id in self.hosted_bids:
+                self.hosted += self.hosted_bids[bid_id]
+
+    def commit(self, bid_id: int) -> None:
+        """ Count a reserved bid as hosted """
+        with self.lock:
+            size = self.reserved.pop(bid_id, 0)
+            self.unsynced[bid_id] = size
+            self.hosted += size
@@ -0,0 +1,261 @@
+""" The Hoster """
+import time
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from configparser import ConfigParser
+from web3.eth import Contract
+from ..accounts import decrypt_account
+from ..storage import open_db_from_config, get_bids_to_pin, get_hosted_bids
+from ..scatter.bids import fetch_bid_details
+from ..scatter.events import fetch_events
+from ..common.const import (
+    GAS_LIMITS,
+    STD_PROCESS_DELAY,
+    SETTLED_PROCESS_DELAY,
+    DEFAULT_CONFIRMATIONS,
+    LOG_FETCH_WINDOW,
+    LOG_FETCH_WORKERS,
+    HOSTER_PIN_WORKERS,
+    HOSTER_LARGE_PIN_WORKERS,
+    HOSTER_LARGE_PIN_SIZE,
+    HOSTER_PIN_TIMEOUT,
+    HOSTER_RETRY_DELAY,
+    DEFAULT_IPFS_REPO,
+)
+from ..common.config import HOSTER_EL, config_get
+from ..common.contracts import init_router_contract, init_scatter_contract
+from ..common.cid import to_cid
+from ..common.ipfs import IPFSPool, ipfs_pool_from_config
+from ..common.transactions import TransactionSender
+from ..common.web3 import init_web3
+from ..common.exceptions import HosterError
+from ..common.typing import Any, Callable, Dict, List, Optional, Set, PS, DictOfAny, to_path
+from ..common.logging import getLogger
+from .admission import StorageBudget
+from .portfolio import PortfolioOptimizer
+
+log = getLogger(__name__)
+
+
+class PinPool:
+    """ A fixed number of pin workers.  Jobs are only taken while a worker is free, so bids wait
+    in the intake instead of holding a storage reservation in a queue. """
+    def __init__(self, name: str, workers: int, wake_event: threading.Event):
+        self.name = name
+        self.workers = workers
+        self.wake_event = wake_event
+        self.active = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+
+    def free_slots(self) -> int:
+        with self.lock:
+            return self.workers - self.active
+
+    def submit(self, fn: Callable, *args: Any) -> bool:
+        """ Start a job if a worker is free """
+        with self.lock:
+            if self.active >= self.workers:
+                return False
+            self.active += 1
+
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return True
+
+    def _done(self, future: Future) -> None:
+        with self.lock:
+            self.active -= 1
+        self.wake_event.set()
+
+    def shutdown(self) -> None:
+        """ Wait for running jobs and stop the workers """
+        self.executor.shutdown(wait=True)
+
+
+def host_bid(scatter: Contract, sender: TransactionSender, ipfs: IPFSPool, bid: DictOfAny,
+             pin_timeout: int = HOSTER_PIN_TIMEOUT) -> None:
+    """ Accept a bid, pin its file and tell the contract it's pinned.  Bids we've already
+    accepted carry on from the pin. """
+    bid_id = bid['bid_id']
+    file_cid = bid['file_cid'] or to_cid(bid['file_hash'])
+
+    if bid['accepted'] is None:
+        if not scatter.functions.isBidOpenForAccept(bid_id).call():
+            raise HosterError("Bid #{} is no longer open for accept".format(bid_id))
+
+        log.info("Accepting bid #{}".format(bid_id))
+        if not sender.transact(scatter.functions.accept(bid_id),
+                               GAS_LIMITS['Scatter']['accept']):
+            raise HosterError("Accept transaction for bid #{} failed".format(bid_id))
+
+    log.info("Pinning {} for bid #{}".format(file_cid, bid_id))
+    ipfs.pin_add(file_cid, timeout=pin_timeout)
+
+    if not sender.transact(scatter.functions.pinned(bid_id), GAS_LIMITS['Scatter']['pinned']):
+        raise HosterError("Pinned transaction for bid #{} failed".format(bid_id))
+
+    log.info("Bid #{} is pinned".format(bid_id))
+
+
+def hoster_run(conf: ConfigParser, keystore: PS, passphrase: Optional[str] = None) -> None:
+    """ Run a continuous process that hosts the open bids that fit in our storage.
+
+    Bids go through a pipeline: intake from synced events, selection of the bids that pay best
+    for the storage left, admission against max_storage and the free space on the IPFS repo's
+    disk, then a pool of pin workers that accept, pin and report each one on chain.  Large files
+    have their own pool so they can't hold up small ones.  SIGINT and SIGTERM let running pins
+    finish before exiting.
+    """
+    log.info("Preparing to start hoster...")
+
+    web3 = init_web3(conf)
+    my_account = config_get(conf, 'account')
+    router_address = config_get(conf, 'router_address')
+
+    if not my_account or not router_address:
+        raise HosterError("Missing an address for router or hoster.")
+
+    max_storage = config_get(conf, 'max_storage', section=HOSTER_EL)
+    if not max_storage:
+        raise HosterError("max_storage must be set in [hoster].")
+
+    router = init_router_contract(web3, router_address)
+    scatter = init_scatter_contract(web3, router)
+    db = open_db_from_config(conf)
+    ipfs = ipfs_pool_from_config(conf, HOSTER_EL)
+    sender = TransactionSender(web3, my_account, decrypt_account(keystore, my_account,
+                                                                 passphrase))
+    budget = StorageBudget(int(max_storage), to_path(config_get(conf, 'ipfs_repo',
+                                                                DEFAULT_IPFS_REPO,
+                                                                section=HOSTER_EL)))
+    confirmations = int(config_get(conf, 'confirmations', DEFAULT_CONFIRMATIONS))
+    log_window = int(config_get(conf, 'log_fetch_window', LOG_FETCH_WINDOW))
+    log_workers = int(config_get(conf, 'log_fetch_workers', LOG_FETCH_WORKERS))
+    large_size = int(config_get(conf, 'large_pin_size', HOSTER_LARGE_PIN_SIZE,
+                                section=HOSTER_EL))
+    pin_timeout = int(config_get(conf, 'pin_timeout', HOSTER_PIN_TIMEOUT, section=HOSTER_EL))
+
+    stop_event = threading.Event()
+    wake_event = threading.Event()
+    small_pins = PinPool('pin', int(config_get(conf, 'pin_workers', HOSTER_PIN_WORKERS,
+                                               section=HOSTER_EL)), wake_event)
+    large_pins = PinPool('pin-large', int(config_get(conf, 'large_pin_workers',
+                                                     HOSTER_LARGE_PIN_WORKERS,
+                                                     section=HOSTER_EL)), wake_event)
+
+    state_lock = threading.Lock()
+    in_progress: Set[int] = set()
+    # Hosted, but the events saying so haven't been synced yet
+    done: Set[int] = set()
+    retry_at: Dict[int, float] = {}
+
+    def run_job(bid: DictOfAny) -> None:
+        ok = False
+        try:
+            host_bid(scatter, sender, ipfs, bid, pin_timeout)
+            ok = True
+        except Exception:
+            log.exception("Hosting bid #{} failed.".format(bid['bid_id']))
+        finally:
+            with state_lock:
+                in_progress.discard(bid['bid_id'])
+                if ok:
+                    budget.commit(bid['bid_id'])
+                    done.add(bid['bid_id'])
+                else:
+                    budget.release(bid['bid_id'])
+                    retry_at[bid['bid_id']] = time.time() + HOSTER_RETRY_DELAY
+
+    def handle_signal(signum, frame):
+        log.info("Received signal {}.  Finishing running pins...".format(signum))
+        stop_event.set()
+        wake_event.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    optimizer = PortfolioOptimizer()
+    candidates: Dict[int, DictOfAny] = {}
+    # Bids we've accepted on chain have to be hosted whatever they pay
+    must_host: List[int] = []
+    last_sync = 0.0
+
+    try:
+        while not stop_event.is_set():
+
+            # Intake
+            if time.time() - last_sync >= STD_PROCESS_DELAY:
+                log.info("Fetching events...")
+                with db.writer() as db_conn:
+                    with db_conn:
+                        fetch_events(db_conn, web3, scatter, confirmations, log_window,
+                                     log_workers, stop_event)
+                        if stop_event.is_set():
+                            break
+                        fetch_bid_details(db_conn, scatter)
+                last_sync = time.time()
+
+                with db.reader() as db_conn:
+                    candidates = {bid['bid_id']: bid for bid in get_bids_to_pin(db_conn,
+                                                                                my_account)}
+                    budget.set_hosted(get_hosted_bids(db_conn, my_account, int(last_sync)))
+
+                with state_lock:
+                    done.intersection_update(candidates)
+                    # Partial rows from Accepted or Pinned wait on BidSuccessful
+                    eligible = [
+                        bid for bid in candidates.values()
+                        if bid['file_size'] and (bid['file_hash'] or bid['file_cid'])
+                        and bid['bid_id'] not in in_progress and bid['bid_id'] not in done
+                        and retry_at.get(bid['bid_id'], 0) <= last_sync
+                    ]
+
+                must_host = [bid['bid_id'] for bid in eligible if bid['accepted'] is not None]
+                optimizer.update(bid for bid in eligible if bid['accepted'] is None)
+
+                log.debug("{} bids open for pinning, {} of {} bytes committed".format(
+                    len(candidates), budget.committed, budget.max_storage
+                ))
+
+            # Admission, in order of what pays best for the space left
+            now = time.time()
+            selected = optimizer.select(max(budget.max_storage - budget.committed, 0))
+            for bid_id in must_host + selected:
+                if small_pins.free_slots() < 1 and large_pins.free_slots() < 1:
+                    break
+
+                bid = candidates[bid_id]
+                with state_lock:
+                    if (bid_id in in_progress or bid_id in done
+                            or retry_at.get(bid_id, 0) > now):
+                        continue
+
+                pool = large_pins if bid['file_size'] >= large_size else small_pins
+                if pool.free_slots() < 1:
+                    continue
+
+                if not budget.reserve(bid_id, bid['file_size']):
+                    continue
+
+                with state_lock:
+                    in_progress.add(bid_id)
+
+                if pool.submit(run_job, bid):
+                    optimizer.remove(bid_id)
+                else:
+                    budget.release(bid_id)
+                    with state_lock:
+                        in_progress.discard(bid_id)
+
+            with state_lock:
+                busy = len(in_progress) > 0
+
+            wake_event.wait(STD_PROCESS_DELAY if busy or len(optimizer) > 0
+                            else SETTLED_PROCESS_DELAY)
+            wake_event.clear()
+    finally:
+        small_pins.shutdown()
+        large_pins.shutdown()
+        log.info("Hoster stopped.")
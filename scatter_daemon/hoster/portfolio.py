@@ -0,0 +1,192 @@
+""" Choosing which bids to host with the storage we have left """
+from bisect import bisect_left, insort
+from ..common.const import HOSTER_PORTFOLIO_EXACT_LIMIT, HOSTER_PORTFOLIO_RESOLUTION
+from ..common.typing import Dict, Iterable, List, Optional, Tuple, DictOfAny
+
+
+class Candidate:
+    """ A bid we could host.  rate is the reward per second of hosting.  Candidates sort by reward
+    per byte-second, best first, then oldest bid. """
+    __slots__ = ('bid_id', 'size', 'rate', 'key')
+
+    def __init__(self, bid_id: int, size: int, rate: float):
+        self.bid_id = bid_id
+        self.size = size
+        self.rate = rate
+        self.key = (-rate / size, bid_id)
+
+    def __lt__(self, other: 'Candidate') -> bool:
+        return self.key < other.key
+
+
+def reward_rate(bid_value: int, duration: int) -> float:
+    """ What a bid pays per second of hosting """
+    return bid_value / duration
+
+
+def total_rate(candidates: List[Candidate]) -> float:
+    return sum(cand.rate for cand in candidates)
+
+
+def solve_greedy(candidates: List[Candidate], capacity: int) -> List[Candidate]:
+    """ Take the best reward per byte that still fits, or the single best bid if that pays more.
+    candidates must be in sorted order.  Gets at least half of the best possible reward. """
+    chosen: List[Candidate] = []
+    free = capacity
+    best_single: Optional[Candidate] = None
+
+    for cand in candidates:
+        if cand.size > capacity:
+            continue
+        if best_single is None or cand.rate > best_single.rate:
+            best_single = cand
+        if cand.size <= free:
+            chosen.append(cand)
+            free -= cand.size
+
+    if best_single is not None and best_single.rate > total_rate(chosen):
+        return [best_single]
+
+    return chosen
+
+
+def solve_exact(candidates: List[Candidate], capacity: int,
+                resolution: int = HOSTER_PORTFOLIO_RESOLUTION) -> List[Candidate]:
+    """ 0/1 knapsack by dynamic programming, with capacity split into resolution units.  Sizes are
+    rounded up to whole units so the result always fits. """
+    weights = [-(-cand.size * resolution // capacity) for cand in candidates]
+    best = [0.0] * (resolution + 1)
+    taken: List[bytearray] = []
+
+    for cand, weight in zip(candidates, weights):
+        took = bytearray(resolution + 1)
+        for units in range(resolution, weight - 1, -1):
+            value = best[units - weight] + cand.rate
+            if value > best[units]:
+                best[units] = value
+                took[units] = 1
+        taken.append(took)
+
+    chosen: List[Candidate] = []
+    units = resolution
+    for idx in range(len(candidates) - 1, -1, -1):
+        if taken[idx][units]:
+            chosen.append(candidates[idx])
+            units -= weights[idx]
+
+    chosen.reverse()
+    return chosen
+
+
+class PortfolioOptimizer:
+    """ Picks the set of bids that earns the most per second from the storage left, counting each
+    bid's file size, value and duration.
+
+    Candidates are kept sorted by reward per byte-second as bids are added and removed, so a
+    re-solve never sorts.  Small candidate sets are solved by dynamic programming, with sizes
+    rounded up to 1/resolution of the capacity, and large ones greedily.  The last solution is
+    reused until the candidates or the capacity change.
+    """
+    # Updates with more changes than this re-sort instead of inserting one at a time
+    REBUILD_CHANGES = 64
+
+    def __init__(self, exact_limit: int = HOSTER_PORTFOLIO_EXACT_LIMIT,
+                 resolution: int = HOSTER_PORTFOLIO_RESOLUTION):
+        self.exact_limit = exact_limit
+        self.resolution = resolution
+        self.candidates: Dict[int, Candidate] = {}
+        self.order: List[Candidate] = []
+        self.solution: Optional[Tuple[int, List[int]]] = None
+
+    def __len__(self) -> int:
+        return len(self.candidates)
+
+    def __contains__(self, bid_id: int) -> bool:
+        return bid_id in self.candidates
+
+    def _changed(self, bid_id: int, size: Optional[int], bid_value: Optional[int],
+                 duration: Optional[int]) -> Tuple[bool, Optional[Candidate]]:
+        """ Whether a bid differs from its candidate, and the new candidate.  Bids we can't rate
+        yet give None. """
+        if not size or not duration or bid_value is None or size < 0 or duration < 0:
+            return bid_id in self.candidates, None
+
+        rate = reward_rate(bid_value, duration)
+        existing = self.candidates.get(bid_id)
+        if existing is not None and existing.size == size and existing.rate == rate:
+            return False, existing
+
+        return True, Candidate(bid_id, size, rate)
+
+    def add(self, bid_id: int, size: Optional[int], bid_value: Optional[int],
+            duration: Optional[int]) -> bool:
+        """ Add or update a candidate bid.  Returns False for bids we can't rate yet. """
+        changed, cand = self._changed(bid_id, size, bid_value, duration)
+        if changed:
+            self.remove(bid_id)
+            if cand is not None:
+                self.candidates[bid_id] = cand
+                insort(self.order, cand)
+                self.solution = None
+        return cand is not None
+
+    def remove(self, bid_id: int) -> None:
+        cand = self.candidates.pop(bid_id, None)
+        if cand is None:
+            return
+
+        del self.order[bisect_left(self.order, cand)]
+        self.solution = None
+
+    def update(self, bids: Iterable[DictOfAny]) -> None:
+        """ Make the candidates match bids, touching only the ones that changed """
+        current = set()
+        changes: List[Tuple[int, Optional[Candidate]]] = []
+
+        for bid in bids:
+            changed, cand = self._changed(bid['bid_id'], bid['file_size'], bid['bid_value'],
+                                          bid['duration'])
+            if cand is not None:
+                current.add(bid['bid_id'])
+            if changed:
+                changes.append((bid['bid_id'], cand))
+
+        changes.extend((bid_id, None) for bid_id in self.candidates if bid_id not in current)
+
+        if len(changes) <= self.REBUILD_CHANGES:
+            for bid_id, cand in changes:
+                self.remove(bid_id)
+                if cand is not None:
+                    self.candidates[bid_id] = cand
+                    insort(self.order, cand)
+                    self.solution = None
+            return
+
+        for bid_id, cand in changes:
+            if cand is None:
+                self.candidates.pop(bid_id, None)
+            else:
+                self.candidates[bid_id] = cand
+        self.order = sorted(self.candidates.values())
+        self.solution = None
+
+    def select(self, capacity: int) -> List[int]:
+        """ The IDs of the bids to host in capacity bytes, best reward per byte-second first """
+        if self.solution is not None and self.solution[0] == capacity:
+            return list(self.solution[1])
+
+        fitting = [cand for cand in self.order if cand.size <= capacity]
+
+        if sum(cand.size for cand in fitting) <= capacity:
+            chosen = fitting
+        else:
+            chosen = solve_greedy(fitting, capacity)
+            if len(fitting) <= self.exact_limit:
+                exact = solve_exact(fitting, capacity, self.resolution)
+                # Rounding sizes up can cost the exact solver more than greedy loses
+                if total_rate(exact) > total_rate(chosen):
+                    chosen = exact
+
+        selection = [cand.bid_id for cand in chosen]
+        self.solution = (capacity, selection)
+        return list(selection)
@@ -0,0 +1,28 @@
+""" Handle functionality around bids on the Scatter contract """
+import sqlite3
+from web3.eth import Contract
+from ..common.web3 import batch_call
+from ..common.logging import getLogger
+from ..storage import get_bids_missing_details, store_bid_details
+
+log = getLogger(__name__)
+
+
+def fetch_bid_details(conn: sqlite3.Connection, scatter: Contract) -> int:
+    """ Fetch and store the bid attributes that BidSuccessful doesn't carry (duration and
+    minValidations).  They never change, so this only happens once per bid. """
+    bid_ids = get_bids_missing_details(conn)
+
+    if len(bid_ids) < 1:
+        return 0
+
+    log.debug("Fetching details for {} bids.".format(len(bid_ids)))
+
+    bids = batch_call(scatter.web3, [scatter.functions.getBid(bid_id) for bid_id in bid_ids])
+
+    store_bid_details(conn, [
+        (bid_id, duration, min_valid)
+        for bid_id, (_, _, _, _, _, duration, min_valid) in zip(bid_ids, bids)
+    ])
+
+    return len(bid_ids)
@@ -0,0 +1,75 @@
+""" Sync events from the Scatter contract into the local DB """
+import sqlite3
+import threading
+from typing import List
+from web3 import Web3
+from web3.eth import Contract
+from attrdict import AttrDict
+from ..storage import (
+    store_events,
+    handled_events,
+    get_sync_block,
+    set_sync_block,
+)
+from ..common.const import (
+    DEFAULT_CONFIRMATIONS,
+    LOG_FETCH_WINDOW,
+    LOG_FETCH_WORKERS,
+)
+from ..common.contracts import event_topics, get_event_decoders, decode_logs
+from ..common.web3 import iter_logs
+from ..common.typing import Optional, Set
+from ..common.logging import getLogger
+
+log = getLogger(__name__)
+
+
+def process_events(contract: Contract, logs: List) -> List[AttrDict]:
+    """ Process all events """
+    events = decode_logs(get_event_decoders(contract.abi), logs)
+    for new_event in events:
+        log.debug("Received event {}.".format(new_event['name']))
+    log.info("Received {} events.".format(len(events)))
+    return events
+
+
+def fetch_events(conn: sqlite3.Connection, web3: Web3, scatter: Contract,
+                 confirmations: int = DEFAULT_CONFIRMATIONS, window: int = LOG_FETCH_WINDOW,
+                 workers: int = LOG_FETCH_WORKERS,
+                 stop_event: Optional[threading.Event] = None) -> Set[int]:
+    """ Retrieve and store all events since the last synced block.  Returns the IDs of the bids
+    the new events touched.  If stop_event is set, this returns after the window being stored,
+    so a long backfill can be interrupted and picked up from there. """
+    log.debug("Getting events for Scatter")
+
+    touched: Set[int] = set()
+
+    last_block = get_sync_block(conn, scatter.address)
+    from_block = 0 if last_block is None else last_block + 1
+    to_block = web3.eth.blockNumber - confirmations
+
+    if to_block < from_block:
+        log.debug("No new confirmed blocks since {}.".format(last_block))
+        return touched
+
+    # Only ask the node for the events we actually store
+    topics = [event_topics(scatter.abi, handled_events())]
+
+    for start, end, logs in iter_logs(web3, scatter.address, from_block, to_block,
+                                      topics=topics, window=window, workers=workers):
+
+        log.debug("Found {} logs between blocks {} and {}.".format(len(logs), start, end))
+
+        if logs:
+            events = process_events(scatter, logs)
+            if events:
+                touched.update(store_events(conn, events))
+
+        # Only move the cursor once everything in the range has been committed
+        set_sync_block(conn, scatter.address, end)
+
+        if stop_event is not None and stop_event.is_set():
+            log.info("Stopped syncing events at block {}.".format(end))
+            break
+
+    return touched
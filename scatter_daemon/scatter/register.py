@@ -1,30 +1,46 @@
 """ Handle functionality around the Register contract """
+import re
 import json
 import ipfsapi
 from pathlib import Path
 from eth_utils import remove_0x_prefix
 from web3.eth import Contract
-from multihash import from_hex_string, to_b58_string
-from jsonschema import validate as validate_json
+from jsonschema.validators import validator_for
 from jsonschema.exceptions import SchemaError, ValidationError
+from hexbytes import HexBytes
+from ..common.cache import TTLCache
+from ..common.const import (
+    REGISTRATION_CACHE_SIZE,
+    REGISTRATION_CACHE_TTL,
+    DEFAULT_REGISTRATION_VERSION,
+)
 from ..common.ipfs import ipfs_get_json
-from ..common.typing import Optional, Any, Dict
+from ..common.typing import Optional, Any, Dict, StrOrBytes
 from ..common.logging import getLogger
 
 log = getLogger(__name__)
 
-registration_cache: Dict = {}
+# (address, user file hash) -> registration, or None if invalid.  The file is addressed by its
+# hash, so an entry only goes stale when the user registers a new file.
+registration_cache = TTLCache(REGISTRATION_CACHE_SIZE, REGISTRATION_CACHE_TTL)
+registration_files: Dict[str, HexBytes] = {}
+REGISTRATION_MISS = object()
 schema_cache: Dict[str, Dict] = {}
+validator_cache: Dict[str, Any] = {}
+SCHEMA_DIR = Path(__file__).parent.parent.joinpath('common', 'files')
+SCHEMA_VERSION_RE = re.compile(r'registration-([\w.]+)\.schema\.json')
 
 
-def load_registration_schema(version='0.1') -> Dict[str, Any]:
+def load_registration_schema(version: str = DEFAULT_REGISTRATION_VERSION) -> Dict[str, Any]:
     """ Load the Registration JSON schema """
 
     if schema_cache.get(version) is not None:
         return schema_cache[version]
 
-    schema_file = Path(__file__).parent.parent.joinpath('common', 'files',
-                                                        'registration-{}.schema.json')
+    schema_file = SCHEMA_DIR.joinpath('registration-{}.schema.json'.format(version))
+    if not schema_file.is_file():
+        raise ValueError('Unknown Registration schema version {}'.format(version))
+
     schema_string: str = ''
     with schema_file.open() as _file:
         schema_string = _file.read()
@@ -39,25 +55,98 @@ def load_registration_schema(version='0.1') -> Dict[str, Any]:
         log.exception("Registration file invalid")
         raise err
 
+    schema_cache[version] = schema_object
     return schema_object
 
 
+def get_registration_validator(version: str = DEFAULT_REGISTRATION_VERSION) -> Any:
+    """ Get the compiled validator for a version of the Registration schema.  The schema itself
+    is only checked the first time. """
+
+    if validator_cache.get(version) is not None:
+        return validator_cache[version]
+
+    schema = load_registration_schema(version)
+    validator_class = validator_for(schema)
+    validator_class.check_schema(schema)
+
+    validator_cache[version] = validator_class(schema)
+    return validator_cache[version]
+
+
+def registration_version(doc: Any) -> str:
+    """ Get the schema version a registration is written against, from its $schema.
+    Registrations that don't say are the original version.  A top-level "version" is left alone,
+    since the original schema allows extra properties and it may mean something else. """
+    if not isinstance(doc, dict):
+        return DEFAULT_REGISTRATION_VERSION
+
+    if isinstance(doc.get('$schema'), str):
+        match = SCHEMA_VERSION_RE.search(doc['$schema'])
+        if match:
+            return match.group(1)
+
+    return DEFAULT_REGISTRATION_VERSION
+
+
+def validate_registration(doc: Any) -> None:
+    """ Validate a registration against the schema for its version.  Raises ValidationError if
+    it's invalid. """
+    version = registration_version(doc)
+
+    try:
+        validator = get_registration_validator(version)
+    except ValueError:
+        raise ValidationError('Unknown Registration version {}'.format(version))
+
+    validator.validate(doc)
+
+
+def get_cached_registration(address: str, file_hash: StrOrBytes) -> Any:
+    """ Get a registration from the cache.  Returns REGISTRATION_MISS if it's not cached, and None
+    if the registration is cached as invalid. """
+    return registration_cache.get((address.lower(), HexBytes(file_hash)), REGISTRATION_MISS)
+
+
+def cache_registration(address: str, file_hash: StrOrBytes,
+                       registration: Optional[Dict[str, Any]]) -> None:
+    """ Cache a user's registration, or None if it's invalid.  An older user file for the same
+    address is dropped. """
+    address = address.lower()
+    file_hash = HexBytes(file_hash)
+    previous = registration_files.get(address)
+    if previous is not None and previous != file_hash:
+        registration_cache.pop((address, previous))
+    registration_files[address] = file_hash
+    registration_cache.set((address, file_hash), registration)
+
+
 def get_registration(ipfs: ipfsapi.client.Client, register: Contract,
                      address: str) -> Optional[Dict[str, Any]]:
-    """ Retrieve a user's registration """
-    global registration_cache
-
+    """ Retrieve a user's registration.  The user file hash is always checked on-chain, so a new
+    registration replaces the cached one. """
     hex_hash = register.functions.getUserFile(address).call()
+
+    cached = get_cached_registration(address, hex_hash)
+    if cached is not REGISTRATION_MISS:
+        return cached
+
     user_json = ipfs_get_json(ipfs, hex_hash)
+    registration = verify_registration(user_json)
+    cache_registration(address, hex_hash, registration)
+
+    return registration
+
 
-    schema = load_registration_schema()
+def verify_registration(user_json: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """ Check a registration against the schema, returning it if valid """
     try:
-        validate_json(user_json, schema)
+        validate_registration(user_json)
     except SchemaError as err:
         log.error("Error validation Registration schema.  Invalid schema.")
         raise err
     except ValidationError as err:
-        log.exception("Invalid Registration schema.")
+        log.warning("Invalid Registration: {}".format(err.message))
         return None
 
     return user_json
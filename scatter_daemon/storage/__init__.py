@@ -1,7 +1,9 @@
 # flake8: noqa
-from .db import connect, cursor
+from .db import connect, cursor, open_db, open_db_from_config, ConnectionManager
 from .events import (
     get_stored_events,
+    iter_stored_events,
+    handled_events,
     store_events,
 )
 from .pins import (
@@ -10,5 +12,21 @@ from .pins import (
 )
 from .bids import (
     get_bids_to_pin,
+    get_hosted_bids,
     get_bids_to_validate,
+    get_bids_missing_details,
+    store_bid_details,
+)
+from .validations import (
+    store_validation,
+    get_validation_count,
+)
+from .dag import (
+    DagIndex,
+    get_dag_index,
+    store_dag_index,
+)
+from .sync import (
+    get_sync_block,
+    set_sync_block,
 )
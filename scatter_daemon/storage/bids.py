@@ -1,51 +1,62 @@
 import json
 import sqlite3
 from attrdict import AttrDict
-from ..common.typing import DictOfAny, List
+from eth_utils import to_normalized_address
+from ..common.typing import Dict, DictOfAny, List, Tuple, Optional, Iterable
+from ..common.const import VALIDATION_DEFAULTS
+from ..common.utils import get_from_first
+from ..common.cid import to_cid
 from ..common.logging import getLogger
 
 log = getLogger(__name__)
 
+BID_ID_CHUNK_SIZE = 500
+
 
 def store_bid(conn: sqlite3.Connection, evnt: DictOfAny):
-    """ Store a pin in the DB """
+    """ Store a bid in the DB.  The caller is responsible for committing.
+
+    Pinned or Accepted may have already created a partial row for this bid, in which case the
+    bid's own attributes are filled in and the pin/accept state is left alone.
+    """
     cur = conn.cursor()
     assert evnt.get('name') == 'BidSuccessful', "Invalid event given to store_bid"
-    try:
-        cur.execute("INSERT INTO bid (tx_hash, bid_id, bidder, bid_value, validation_pool, "
-                    "file_size, file_hash) "
-                    "VALUES (:tx_hash, :bid_id, :bidder, :bid_value, :validation_pool, "
-                    ":file_size, :file_hash);",
-                    {
-                        'tx_hash': evnt['txhash'],
-                        'bid_id': evnt['args'].bidId,
-                        'bidder': evnt['args'].bidder,
-                        'bid_value': evnt['args'].bidValue,
-                        'validation_pool': evnt['args'].validationPool,
-                        'file_size': evnt['args'].fileSize,
-                        'file_hash': evnt['args'].fileHash,
-                    })
-    except sqlite3.IntegrityError as err:
-        if 'UNIQUE' in str(err):
-            log.debug("Event already exists.")
-            pass
-        else:
-            raise err
-    else:
-        assert cur.rowcount > 0, "INSERT failed"
-        conn.commit()
+    cur.execute("INSERT INTO bid (tx_hash, bid_id, bidder, bid_value, validation_pool, "
+                "file_size, file_hash, file_cid, pinned) "
+                "VALUES (:tx_hash, :bid_id, :bidder, :bid_value, :validation_pool, "
+                ":file_size, :file_hash, :file_cid, false) "
+                "ON CONFLICT(bid_id) DO UPDATE SET tx_hash = excluded.tx_hash, "
+                "bidder = excluded.bidder, bid_value = excluded.bid_value, "
+                "validation_pool = excluded.validation_pool, file_size = excluded.file_size, "
+                "file_hash = excluded.file_hash, file_cid = excluded.file_cid;",
+                {
+                    'tx_hash': evnt['txhash'],
+                    'bid_id': evnt['args'].bidId,
+                    'bidder': to_normalized_address(evnt['args'].bidder),
+                    'bid_value': evnt['args'].bidValue,
+                    'validation_pool': evnt['args'].validationPool,
+                    'file_size': evnt['args'].fileSize,
+                    'file_hash': evnt['args'].fileHash,
+                    'file_cid': to_cid(evnt['args'].fileHash),
+                })
+    assert cur.rowcount > 0, "UPSERT failed"
 
 
 def get_bids_to_pin(conn: sqlite3.Connection, my_address: str):
-    """ Get bids that have been pinned and are open for validation """
+    """ Get bids that haven't been pinned yet, except our own.  Bids accepted by another hoster
+    are left out. """
 
     bids: List[DictOfAny] = []
 
     cur = conn.cursor()
 
-    cur.execute("SELECT tx_hash, bid_id, bidder, file_hash, file_size, validated FROM bid "
-                "WHERE bidder != :me AND pinned = false;",
-                {'me': my_address})
+    # Matches the partial index bid_to_pin.  COALESCE rather than OR, which would have the
+    # planner look hoster up in bid_hoster instead of using the covering index.
+    cur.execute("SELECT tx_hash, bid_id, bidder, file_hash, file_size, validated, file_cid, "
+                "hoster, accepted, bid_value, duration "
+                "FROM bid WHERE pinned = 0 AND bidder != :me "
+                "AND COALESCE(hoster, :me) = :me;",
+                {'me': to_normalized_address(my_address)})
     res = cur.fetchall()
     if len(res) < 1:
         log.debug("NO BIDS FOUND")
@@ -58,23 +69,91 @@ def get_bids_to_pin(conn: sqlite3.Connection, my_address: str):
                 'file_hash': row[3],
                 'file_size': row[4],
                 'validated': row[5],
+                'file_cid': row[6],
+                'hoster': row[7],
+                'accepted': row[8],
+                'bid_value': row[9],
+                'duration': row[10],
             }))
 
     return bids
 
 
-def get_bids_to_validate(conn: sqlite3.Connection, my_address: str):
-    """ Get bids that have been pinned and are open for validation """
+def get_hosted_bids(conn: sqlite3.Connection, my_address: str, now: int) -> Dict[int, int]:
+    """ Get the file sizes of the bids we've accepted or pinned that haven't ended yet """
+    cur = conn.cursor()
+    cur.execute("SELECT bid_id, file_size FROM bid WHERE hoster = :me "
+                "AND (accepted IS NULL OR duration IS NULL OR accepted + duration > :now);",
+                {'me': to_normalized_address(my_address), 'now': now})
+    return {bid_id: file_size or 0 for bid_id, file_size in cur.fetchall()}
+
+
+def get_bids_missing_details(conn: sqlite3.Connection) -> List[int]:
+    """ Get the IDs of bids we haven't fetched the on-chain details for yet """
+    cur = conn.cursor()
+    cur.execute("SELECT bid_id FROM bid WHERE duration IS NULL AND bidder IS NOT NULL;")
+    return [row[0] for row in cur.fetchall()]
+
+
+def store_bid_details(conn: sqlite3.Connection, details: List[Tuple[int, int, int]]) -> None:
+    """ Store the (bid_id, duration, min_validations) of bids """
+    if len(details) < 1:
+        return
+    with conn:
+        conn.executemany("UPDATE bid SET duration = ?, min_validations = ? WHERE bid_id = ?;",
+                         ((duration, min_valid, bid_id)
+                          for bid_id, duration, min_valid in details))
+
+
+def get_bids_to_validate(conn: sqlite3.Connection, my_address: str,
+                         options: Optional[DictOfAny] = None,
+                         bid_ids: Optional[Iterable[int]] = None):
+    """ Get bids that have been pinned and are open for validation, and fit the file size,
+    duration and reward filters in options.  The reward is the validation pool split between the
+    validations so far.  If bid_ids is given, only those bids are considered. """
 
     bids: List[DictOfAny] = []
+    options = options or {}
+
+    params: DictOfAny = {
+        'me': to_normalized_address(my_address),
+        'min_file_size': get_from_first('min_file_size', options, VALIDATION_DEFAULTS),
+        'max_file_size': get_from_first('max_file_size', options, VALIDATION_DEFAULTS),
+        'min_duration': get_from_first('min_duration', options, VALIDATION_DEFAULTS),
+        'max_duration': get_from_first('max_duration', options, VALIDATION_DEFAULTS),
+        'min_reward': get_from_first('min_reward', options, VALIDATION_DEFAULTS),
+    }
+
+    # Matches the partial index bid_to_validate
+    query = ("SELECT tx_hash, bid_id, hoster, file_hash, file_size, validated, "
+             "validation_pool, duration, validation_count, accepted, file_cid FROM bid "
+             "WHERE pinned = 1 AND validated IS NOT 1 AND bidder IS NOT NULL "
+             "AND file_size BETWEEN :min_file_size AND :max_file_size "
+             "AND duration BETWEEN :min_duration AND :max_duration "
+             "AND (validation_count = 0 "
+             "     OR validation_pool / validation_count >= :min_reward) "
+             "AND hoster != :me")
 
     cur = conn.cursor()
+    res = []
+
+    if bid_ids is None:
+        cur.execute(query + ";", params)
+        res = cur.fetchall()
+    else:
+        bid_ids = list(bid_ids)
+
+        # Keep well under SQLite's limit on bound variables
+        for i in range(0, len(bid_ids), BID_ID_CHUNK_SIZE):
+            chunk = bid_ids[i:i + BID_ID_CHUNK_SIZE]
+            chunk_params = dict(params)
+            chunk_params.update({'b{}'.format(j): bid_id for j, bid_id in enumerate(chunk)})
+            cur.execute("{} AND bid_id IN ({});".format(
+                query,
+                ', '.join(':b{}'.format(j) for j in range(len(chunk)))
+            ), chunk_params)
+            res.extend(cur.fetchall())
 
-    cur.execute("SELECT tx_hash, bid_id, hoster, file_hash, file_size, validated FROM bid "
-                "WHERE hoster != :me AND pinned = true "
-                "AND (validated is null or validated = false);",
-                {'me': my_address})
-    res = cur.fetchall()
     if len(res) < 1:
         log.debug("NO BIDS FOUND")
         return bids
@@ -86,6 +165,11 @@ def get_bids_to_validate(conn: sqlite3.Connection, my_address: str):
                 'file_hash': row[3],
                 'file_size': row[4],
                 'validated': row[5],
+                'validation_pool': row[6],
+                'duration': row[7],
+                'validation_count': row[8],
+                'accepted': row[9],
+                'file_cid': row[10],
             }))
 
     return bids
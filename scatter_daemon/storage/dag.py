@@ -0,0 +1,92 @@
+import sys
+import sqlite3
+from array import array
+from ..common.typing import Iterable, Iterator, List, Optional, Tuple
+from ..common.logging import getLogger
+
+log = getLogger(__name__)
+
+
+def sizes_to_blob(sizes: Iterable[int]) -> bytes:
+    """ Pack block sizes as little-endian uint64 """
+    packed = array('Q', sizes)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def sizes_from_blob(blob: bytes) -> array:
+    """ Unpack block sizes stored by sizes_to_blob """
+    sizes = array('Q')
+    sizes.frombytes(blob)
+    if sys.byteorder == 'big':
+        sizes.byteswap()
+    return sizes
+
+
+class DagIndex:
+    """ The blocks of a file's DAG, in file order.  CIDs are kept as one fixed width ASCII blob
+    and sizes as an array, so a block is looked up by index without building a list.  Indexes as
+    a sequence of (CID, size). """
+    __slots__ = ('file_hash', 'cids', 'cid_width', 'sizes', 'total_size')
+
+    def __init__(self, file_hash: str, cids: bytes, cid_width: int, sizes: array):
+        self.file_hash = file_hash
+        self.cids = cids
+        self.cid_width = cid_width
+        self.sizes = sizes
+        self.total_size = sum(sizes)
+
+    @classmethod
+    def from_blocks(cls, file_hash: str, blocks: List[Tuple[str, int]]) -> 'DagIndex':
+        width = max((len(cid) for cid, _ in blocks), default=0)
+        cids = b''.join(cid.encode('ascii').ljust(width) for cid, _ in blocks)
+        return cls(file_hash, cids, width, array('Q', [size for _, size in blocks]))
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def __getitem__(self, idx: int) -> Tuple[str, int]:
+        if idx < 0:
+            idx += len(self.sizes)
+        if not 0 <= idx < len(self.sizes):
+            raise IndexError('block index out of range')
+        start = idx * self.cid_width
+        return (self.cids[start:start + self.cid_width].rstrip(b' ').decode('ascii'),
+                self.sizes[idx])
+
+    def __iter__(self) -> Iterator[Tuple[str, int]]:
+        for idx in range(len(self.sizes)):
+            yield self[idx]
+
+
+def get_dag_index(conn: sqlite3.Connection, file_hash: str) -> Optional[DagIndex]:
+    """ Get the stored block index of a file, by its IPFS hash """
+    cur = conn.cursor()
+    cur.execute("SELECT cid_width, cids, sizes FROM dag_index WHERE file_hash = :file_hash;", {
+        'file_hash': file_hash,
+    })
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return DagIndex(file_hash, bytes(row[1]), row[0], sizes_from_blob(row[2]))
+
+
+def store_dag_index(conn: sqlite3.Connection, index: DagIndex) -> None:
+    """ Store a file's block index.  The caller is responsible for committing. """
+    cur = conn.cursor()
+    cur.execute("INSERT INTO dag_index (file_hash, block_count, total_size, cid_width, cids, "
+                "sizes) VALUES (:file_hash, :block_count, :total_size, :cid_width, :cids, "
+                ":sizes) "
+                "ON CONFLICT(file_hash) DO UPDATE SET block_count = excluded.block_count, "
+                "total_size = excluded.total_size, cid_width = excluded.cid_width, "
+                "cids = excluded.cids, sizes = excluded.sizes;",
+                {
+                    'file_hash': index.file_hash,
+                    'block_count': len(index),
+                    'total_size': index.total_size,
+                    'cid_width': index.cid_width,
+                    'cids': index.cids,
+                    'sizes': sizes_to_blob(index.sizes),
+                })
+    assert cur.rowcount > 0, "UPSERT failed"
@@ -1,63 +1,356 @@
+import queue
 import sqlite3
-from ..common.typing import PS, Optional
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.request import pathname2url
+from ..common.typing import PS, Optional, List, Union, Callable, Iterator
 from ..common.utils import to_path
+from ..common.cid import to_cids
+from ..common.config import ConfigParser, config_get
+from ..common.const import (
+    DEFAULT_DB_FILE,
+    DB_READERS,
+    DB_SYNCHRONOUS,
+    DB_CACHE_SIZE,
+    DB_MMAP_SIZE,
+    DB_BUSY_TIMEOUT,
+)
 from ..common.exceptions import StorageError
 from ..common.logging import getLogger
 
 log = getLogger(__name__)
 
-cached_connection: Optional[sqlite3.Connection] = None
-#TABLES = ['event', 'pin', 'action', 'action_type']
-TABLES = ['event', 'bid', 'action', 'action_type']
+cached_manager: Optional['ConnectionManager'] = None
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
 
 
-def structure_exists(connect: sqlite3.Connection) -> bool:
-    """ See if the DB structure has been created """
+def reset_event_data(connect: sqlite3.Connection) -> None:
+    """ Drop everything derived from chain events so it is synced again from scratch, keeping
+    our own validated flags. """
     cur = connect.cursor()
-    for tbl in TABLES:
-        cur.execute("SELECT name FROM sqlite_master "
-                    "WHERE type='table' AND name=:table_name;",
-                    {'table_name': tbl})
-        res = cur.fetchall()
-        if len(res) < 1:
-            log.debug('Table {} does not exist.'.format(tbl))
-            return False
-    return True
+    cur.execute("SELECT bid_id FROM bid WHERE validated = true;")
+    validated = cur.fetchall()
+    cur.execute("DELETE FROM event;")
+    cur.execute("DELETE FROM bid;")
+    cur.execute("DELETE FROM sync_state;")
+    cur.executemany("INSERT INTO bid (bid_id, pinned, validated) VALUES (?, false, true);",
+                    validated)
 
 
-def init_structure(connect: sqlite3.Connection):
-    """ Create the table structure """
+def backfill_file_cids(connect: sqlite3.Connection) -> None:
+    """ Fill in bid.file_cid from bid.file_hash """
+    cur = connect.cursor()
+    cur.execute("SELECT rowid, file_hash FROM bid WHERE file_hash IS NOT NULL;")
+    rows = cur.fetchall()
+    cids = to_cids(file_hash for _, file_hash in rows)
+    cur.executemany("UPDATE bid SET file_cid = ? WHERE rowid = ?;",
+                    ((cid, rowid) for (rowid, _), cid in zip(rows, cids) if cid is not None))
+
+
+# Each entry upgrades the schema by one version, recorded in PRAGMA user_version.  Steps are SQL
+# statements or callables that take the connection.  Append new migrations, never edit old ones.
+MIGRATIONS: List[List[Union[str, Callable]]] = [
+    # 1: Base structure.  Also adopts databases created before schema versioning.
+    [
+        "CREATE TABLE IF NOT EXISTS event "
+        "(tx_hash TEXT, block_number INT, name TEXT, args TEXT);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS event_single ON event(tx_hash, name);",
+        "CREATE TABLE IF NOT EXISTS action_type (name TEXT);",
+        "CREATE TABLE IF NOT EXISTS bid "
+        "(tx_hash TEXT UNIQUE, bid_id INT UNIQUE, bidder TEXT, bid_value INT, "
+        "validation_pool INT, file_hash TEXT, file_size INT, hoster TEXT, pinned BOOLEAN, "
+        "pinned_txhash TEXT, accepted INT, accepted_txhash TEXT, validated BOOLEAN);",
+        "CREATE TABLE IF NOT EXISTS action (action_rowid INT, event_rowid INT);",
+        # Last fully processed block, per contract
+        "CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, block_number INT);",
+        "INSERT INTO action_type (name) SELECT 'validation' "
+        "WHERE NOT EXISTS (SELECT 1 FROM action_type WHERE name = 'validation');",
+        "INSERT INTO action_type (name) SELECT 'host' "
+        "WHERE NOT EXISTS (SELECT 1 FROM action_type WHERE name = 'host');",
+    ],
+    # 2: Unversioned databases stored the wrong tx hash and block for most events and had every
+    # Pinned/Accepted event overwrite every bid.  Re-sync them.
+    [
+        reset_event_data,
+    ],
+    # 3: Indexes for the validator and hoster queries in storage/bids.py.  The bid indexes are
+    # partial and cover every column those queries touch.
+    [
+        "CREATE INDEX IF NOT EXISTS bid_to_validate "
+        "ON bid(hoster, bid_id, tx_hash, file_hash, file_size, validated, bidder, pinned) "
+        "WHERE pinned = 1 AND validated IS NOT 1 AND bidder IS NOT NULL;",
+        "CREATE INDEX IF NOT EXISTS bid_to_pin "
+        "ON bid(bidder, bid_id, tx_hash, file_hash, file_size, validated, pinned) "
+        "WHERE pinned = 0;",
+        "CREATE INDEX IF NOT EXISTS event_block_number ON event(block_number);",
+        "CREATE INDEX IF NOT EXISTS event_name ON event(name, block_number);",
+    ],
+    # 4: Immutable bid attributes that aren't in BidSuccessful, fetched once per bid.  The
+    # validation index leads with the filter columns so the candidate query is a range scan.
+    [
+        "ALTER TABLE bid ADD COLUMN duration INT;",
+        "ALTER TABLE bid ADD COLUMN min_validations INT;",
+        "CREATE INDEX IF NOT EXISTS bid_missing_details ON bid(bid_id) "
+        "WHERE duration IS NULL AND bidder IS NOT NULL;",
+        "DROP INDEX IF EXISTS bid_to_validate;",
+        "CREATE INDEX bid_to_validate "
+        "ON bid(file_size, duration, hoster, bid_id, tx_hash, file_hash, validation_pool, "
+        "validated, bidder, pinned) "
+        "WHERE pinned = 1 AND validated IS NOT 1 AND bidder IS NOT NULL;",
+    ],
+    # 5: Validations, tracked from ValidationOcurred.  The sync cursor is reset so validations
+    # from before the handler existed are fetched.  Every handler is safe to replay.
+    [
+        "CREATE TABLE IF NOT EXISTS validation "
+        "(tx_hash TEXT, bid_id INT, validator TEXT, is_valid BOOLEAN, block_number INT, "
+        "UNIQUE(tx_hash, bid_id, validator));",
+        "CREATE INDEX IF NOT EXISTS validation_bid ON validation(bid_id);",
+        "ALTER TABLE bid ADD COLUMN validation_count INT NOT NULL DEFAULT 0;",
+        "DROP INDEX IF EXISTS bid_to_validate;",
+        "CREATE INDEX bid_to_validate "
+        "ON bid(file_size, duration, hoster, bid_id, tx_hash, file_hash, validation_pool, "
+        "validation_count, validated, bidder, pinned) "
+        "WHERE pinned = 1 AND validated IS NOT 1 AND bidder IS NOT NULL;",
+        "DELETE FROM sync_state;",
+    ],
+    # 6: Cover accepted in bid_to_validate, for the remaining duration of a bid
+    [
+        "DROP INDEX IF EXISTS bid_to_validate;",
+        "CREATE INDEX bid_to_validate "
+        "ON bid(file_size, duration, hoster, bid_id, tx_hash, file_hash, validation_pool, "
+        "validation_count, accepted, validated, bidder, pinned) "
+        "WHERE pinned = 1 AND validated IS NOT 1 AND bidder IS NOT NULL;",
+    ],
+    # 7: Block lists of validated files, so sampling doesn't walk the DAG again.  See
+    # storage/dag.py for the format of cids and sizes.
+    [
+        "CREATE TABLE IF NOT EXISTS dag_index "
+        "(file_hash TEXT PRIMARY KEY, block_count INT NOT NULL, total_size INT NOT NULL, "
+        "cid_width INT NOT NULL, cids BLOB NOT NULL, sizes BLOB NOT NULL);",
+    ],
+    # 8: The IPFS hash of each bid's file, converted once when the bid is stored
+    [
+        "ALTER TABLE bid ADD COLUMN file_cid TEXT;",
+        backfill_file_cids,
+        "DROP INDEX IF EXISTS bid_to_validate;",
+        "CREATE INDEX bid_to_validate "
+        "ON bid(file_size, duration, hoster, bid_id, tx_hash, file_hash, file_cid, "
+        "validation_pool, validation_count, accepted, validated, bidder, pinned) "
+        "WHERE pinned = 1 AND validated IS NOT 1 AND bidder IS NOT NULL;",
+        "DROP INDEX IF EXISTS bid_to_pin;",
+        "CREATE INDEX bid_to_pin "
+        "ON bid(bidder, bid_id, tx_hash, file_hash, file_cid, file_size, validated, pinned) "
+        "WHERE pinned = 0;",
+    ],
+    # 9: The hoster needs to know who accepted an unpinned bid, and how much it's hosting
+    [
+        "DROP INDEX IF EXISTS bid_to_pin;",
+        "CREATE INDEX bid_to_pin "
+        "ON bid(bidder, bid_id, tx_hash, file_hash, file_cid, file_size, hoster, accepted, "
+        "validated, pinned) "
+        "WHERE pinned = 0;",
+        "CREATE INDEX IF NOT EXISTS bid_hoster "
+        "ON bid(hoster, bid_id, file_size, accepted, duration);",
+    ],
+    # 10: Cover bid_value and duration in bid_to_pin, for choosing which bids to host
+    [
+        "DROP INDEX IF EXISTS bid_to_pin;",
+        "CREATE INDEX bid_to_pin "
+        "ON bid(bidder, bid_id, tx_hash, file_hash, file_cid, file_size, bid_value, duration, "
+        "hoster, accepted, validated, pinned) "
+        "WHERE pinned = 0;",
+    ],
+    # 11: Addresses are stored lowercase, so they can be compared with =
+    [
+        "UPDATE bid SET bidder = lower(bidder), hoster = lower(hoster) "
+        "WHERE bidder != lower(bidder) OR hoster != lower(hoster);",
+        "UPDATE OR IGNORE validation SET validator = lower(validator) "
+        "WHERE validator != lower(validator);",
+    ],
+    # 12: Indexes walked before leaves were told apart by codec may list internal nodes as leaves
+    [
+        "DELETE FROM dag_index;",
+    ],
+    # 13: One transaction can make several bids, so tx_hash can't be UNIQUE.  SQLite can't drop a
+    # constraint, so the table is rebuilt with its indexes.
+    [
+        "CREATE TABLE bid_new "
+        "(tx_hash TEXT, bid_id INT UNIQUE, bidder TEXT, bid_value INT, validation_pool INT, "
+        "file_hash TEXT, file_size INT, hoster TEXT, pinned BOOLEAN, pinned_txhash TEXT, "
+        "accepted INT, accepted_txhash TEXT, validated BOOLEAN, duration INT, "
+        "min_validations INT, validation_count INT NOT NULL DEFAULT 0, file_cid TEXT);",
+        "INSERT INTO bid_new (rowid, tx_hash, bid_id, bidder, bid_value, validation_pool, "
+        "file_hash, file_size, hoster, pinned, pinned_txhash, accepted, accepted_txhash, "
+        "validated, duration, min_validations, validation_count, file_cid) "
+        "SELECT rowid, tx_hash, bid_id, bidder, bid_value, validation_pool, "
+        "file_hash, file_size, hoster, pinned, pinned_txhash, accepted, accepted_txhash, "
+        "validated, duration, min_validations, validation_count, file_cid FROM bid;",
+        "DROP TABLE bid;",
+        "ALTER TABLE bid_new RENAME TO bid;",
+        "CREATE INDEX bid_missing_details ON bid(bid_id) "
+        "WHERE duration IS NULL AND bidder IS NOT NULL;",
+        "CREATE INDEX bid_to_validate "
+        "ON bid(file_size, duration, hoster, bid_id, tx_hash, file_hash, file_cid, "
+        "validation_pool, validation_count, accepted, validated, bidder, pinned) "
+        "WHERE pinned = 1 AND validated IS NOT 1 AND bidder IS NOT NULL;",
+        "CREATE INDEX bid_hoster ON bid(hoster, bid_id, file_size, accepted, duration);",
+        "CREATE INDEX bid_to_pin "
+        "ON bid(bidder, bid_id, tx_hash, file_hash, file_cid, file_size, bid_value, duration, "
+        "hoster, accepted, validated, pinned) "
+        "WHERE pinned = 0;",
+    ],
+    # 14: One transaction can emit several events of the same name, so events are keyed on their
+    # log index.  Stored events don't have one, so they're synced again.  Every handler is safe
+    # to replay.
+    [
+        "ALTER TABLE event ADD COLUMN log_index INT;",
+        "DROP INDEX IF EXISTS event_single;",
+        "DELETE FROM event;",
+        "CREATE UNIQUE INDEX event_log ON event(tx_hash, log_index);",
+        "DELETE FROM sync_state;",
+    ],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
 
+
+def schema_version(connect: sqlite3.Connection) -> int:
+    """ Get the schema version of the DB """
     cur = connect.cursor()
+    cur.execute("PRAGMA user_version;")
+    return cur.fetchone()[0]
 
-    cur.execute("CREATE TABLE event "
-                "(tx_hash TEXT, block_number INT, name TEXT, "
-                "args TEXT);")
 
-    cur.execute("CREATE UNIQUE INDEX event_single ON event(tx_hash, name);")
+def migrate(connect: sqlite3.Connection) -> int:
+    """ Bring the DB schema up to date, one migration per transaction """
+    version = schema_version(connect)
 
-    cur.execute("CREATE TABLE action_type "
-                "(name TEXT);")
+    if version == SCHEMA_VERSION:
+        return version
+    elif version > SCHEMA_VERSION:
+        raise StorageError('DB schema version {} is newer than this software ({}).'.format(
+            version,
+            SCHEMA_VERSION,
+        ))
 
-    cur.execute("CREATE TABLE bid "
-                "(tx_hash TEXT UNIQUE, bid_id INT UNIQUE, bidder TEXT, bid_value INT, "
-                "validation_pool INT, file_hash TEXT, file_size INT, hoster TEXT, pinned BOOLEAN, "
-                "pinned_txhash TEXT, accepted INT, accepted_txhash TEXT, "
-                "validated BOOLEAN);")
+    cur = connect.cursor()
 
-    cur.execute("CREATE TABLE action "
-                "(action_rowid INT, event_rowid INT);")
+    for idx in range(version, SCHEMA_VERSION):
+        log.info('Migrating DB schema to version {}...'.format(idx + 1))
+        try:
+            cur.execute("BEGIN;")
+            for step in MIGRATIONS[idx]:
+                if callable(step):
+                    step(connect)
+                else:
+                    cur.execute(step)
+            # PRAGMA doesn't take parameters
+            cur.execute("PRAGMA user_version = {:d};".format(idx + 1))
+            connect.commit()
+        except Exception:
+            connect.rollback()
+            log.exception('DB schema migration to version {} failed.'.format(idx + 1))
+            raise
 
-    # Pre-data
-    cur.execute("INSERT INTO action_type (name) VALUES (:name);", {'name': 'validation'})
-    cur.execute("INSERT INTO action_type (name) VALUES (:name);", {'name': 'host'})
+    return SCHEMA_VERSION
 
-    connect.commit()
 
+class ConnectionManager(object):
+    """ Hands out connections to a DB in WAL mode: a single writer guarded by a lock and a pool of
+    read-only connections, so readers never wait on ingestion.  Connections are safe to use from
+    any thread while checked out.
+    """
 
-def connect(filename: PS) -> sqlite3.Connection:
-    """ Initialize the SQLite connection """
-    global cached_connection
+    def __init__(self, filename: Path, readers: int = DB_READERS,
+                 synchronous: str = DB_SYNCHRONOUS, cache_size: int = DB_CACHE_SIZE,
+                 mmap_size: int = DB_MMAP_SIZE):
+        synchronous = synchronous.upper()
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise StorageError('Invalid synchronous mode {}'.format(synchronous))
+
+        self.filename = filename
+        self.synchronous = synchronous
+        self.cache_size = int(cache_size)
+        self.mmap_size = int(mmap_size)
+        self.max_readers = max(1, int(readers))
+
+        self._write_lock = threading.RLock()
+        self._pool_lock = threading.Lock()
+        self._readers: queue.LifoQueue = queue.LifoQueue()
+        self._reader_count = 0
+
+        self.writer_conn = self._open(readonly=False)
+        mode = self.writer_conn.execute("PRAGMA journal_mode = WAL;").fetchone()[0]
+        if mode.lower() != 'wal':
+            log.warning('Unable to put DB in WAL mode, using {}.'.format(mode))
+
+        # Create or upgrade the schema if necessary
+        migrate(self.writer_conn)
+
+    def _open(self, readonly: bool) -> sqlite3.Connection:
+        """ Open and tune a new connection """
+        if readonly:
+            conn = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(str(self.filename))),
+                                   uri=True, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(str(self.filename), timeout=DB_BUSY_TIMEOUT,
+                                   check_same_thread=False)
+
+        # PRAGMA doesn't take parameters.  Values are validated in __init__.
+        conn.execute("PRAGMA synchronous = {};".format(self.synchronous))
+        conn.execute("PRAGMA cache_size = {:d};".format(self.cache_size))
+        conn.execute("PRAGMA mmap_size = {:d};".format(self.mmap_size))
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        return conn
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """ Check out the writer connection """
+        with self._write_lock:
+            yield self.writer_conn
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """ Check out a read-only connection, opening one if the pool isn't full yet """
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._pool_lock:
+                if self._reader_count < self.max_readers:
+                    self._reader_count += 1
+                    try:
+                        conn = self._open(readonly=True)
+                    except Exception:
+                        self._reader_count -= 1
+                        raise
+            if conn is None:
+                conn = self._readers.get()
+
+        try:
+            yield conn
+        finally:
+            # Don't hand out a connection with an open read transaction
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    def close(self) -> None:
+        """ Close all connections.  Checked out readers are closed when they come back. """
+        with self._pool_lock:
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except queue.Empty:
+                    break
+                self._reader_count -= 1
+        with self._write_lock:
+            self.writer_conn.close()
+
+
+def open_db(filename: PS, **options) -> ConnectionManager:
+    """ Initialize the DB connection manager.  options are passed to ConnectionManager. """
+    global cached_manager
 
     filename = to_path(filename)
 
@@ -67,24 +360,37 @@ def connect(filename: PS) -> sqlite3.Connection:
     elif filename.parent.exists() and not filename.parent.is_dir():
         raise StorageError('Directory for DB storage is not a directory!')
 
-    # Use the cached connection if possible
-    if cached_connection is None:
-        cached_connection = sqlite3.connect(filename)
+    # Use the cached manager if possible
+    if cached_manager is None:
+        cached_manager = ConnectionManager(filename, **options)
+
+    return cached_manager
+
 
-    # Create the schema if necessary
-    if not structure_exists(cached_connection):
-        init_structure(cached_connection)
+def open_db_from_config(conf: ConfigParser) -> ConnectionManager:
+    """ Initialize the DB connection manager with the settings from the [scatter] section """
+    return open_db(
+        config_get(conf, 'db_file', DEFAULT_DB_FILE),
+        readers=int(config_get(conf, 'db_readers', DB_READERS)),
+        synchronous=config_get(conf, 'db_synchronous', DB_SYNCHRONOUS),
+        cache_size=int(config_get(conf, 'db_cache_size', DB_CACHE_SIZE)),
+        mmap_size=int(config_get(conf, 'db_mmap_size', DB_MMAP_SIZE)),
+    )
 
-    return cached_connection
+
+def connect(filename: PS) -> sqlite3.Connection:
+    """ Initialize the SQLite connection and return the writer connection.  Multi-threaded
+    callers should use open_db() and check connections out instead. """
+    return open_db(filename).writer_conn
 
 
 def cursor(filename=None):
     """ return a cursor, creating a connection if necessary """
-    global cached_connection
+    global cached_manager
 
-    if cached_connection is None:
+    if cached_manager is None:
         if not filename:
             raise Exception('Unable to get a cursor without a filename')
         connect(filename)
 
-    return cached_connection.cursor()
+    return cached_manager.writer_conn.cursor()
@@ -1,66 +1,145 @@
 import json
 import sqlite3
-from ..common.typing import DictOfAny, List
+from ..common.typing import DictOfAny, List, Dict, Callable, Optional, Iterator, Set, Any
 from ..common.logging import getLogger
 from .pins import store_accept, store_pin
 from .bids import store_bid
+from .validations import store_validation
 
 log = getLogger(__name__)
 
+STORED_EVENTS_PAGE_SIZE = 1000
+
+# Events we persist, by name.  Only these are requested from the node.
+EVENT_HANDLERS: Dict[str, Callable] = {
+    'BidSuccessful': store_bid,
+    'Pinned': store_pin,
+    'Accepted': store_accept,
+    'ValidationOcurred': store_validation,
+}
+
+
+def handled_events() -> List[str]:
+    """ Return the names of all events that have a storage handler """
+    return list(EVENT_HANDLERS.keys())
+
+
+class StoredEvent(object):
+    """ An event read back from storage.  args are only decoded from JSON when first accessed.
+    Supports item access by field name, like the dicts this used to be.
+    """
+    __slots__ = ('event_id', 'tx_hash', 'block_number', 'name', '_args_json', '_args')
+    FIELDS = ('event_id', 'tx_hash', 'block_number', 'name', 'args')
+
+    def __init__(self, event_id: int, tx_hash: str, block_number: int, name: str,
+                 args_json: str):
+        self.event_id = event_id
+        self.tx_hash = tx_hash
+        self.block_number = block_number
+        self.name = name
+        self._args_json = args_json
+        self._args: Optional[DictOfAny] = None
+
+    @property
+    def args(self) -> DictOfAny:
+        if self._args is None:
+            self._args = json.loads(self._args_json)
+        return self._args
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key not in self.FIELDS:
+            return default
+        return getattr(self, key)
+
+    def __repr__(self):
+        return '<StoredEvent #{} {} block={}>'.format(self.event_id, self.name,
+                                                     self.block_number)
+
+
+def iter_stored_events(conn: sqlite3.Connection, name: Optional[str] = None,
+                       from_block: Optional[int] = None, to_block: Optional[int] = None,
+                       page_size: int = STORED_EVENTS_PAGE_SIZE) -> Iterator[StoredEvent]:
+    """ Stream stored events in block order, optionally filtered by name and an inclusive block
+    range.  Rows are read one page at a time, keyed on (block_number, rowid), so memory use is
+    constant and no cursor is held open between pages.
+    """
+    # rowids start at 1, so the first page starts with every row of from_block
+    clauses = ['(block_number, rowid) > (:last_block, :last_rowid)']
+    params: DictOfAny = {
+        'last_block': -1 if from_block is None else from_block,
+        'last_rowid': 0,
+        'limit': page_size,
+    }
+
+    if name is not None:
+        clauses.append('name = :name')
+        params['name'] = name
+    if to_block is not None:
+        clauses.append('block_number <= :to_block')
+        params['to_block'] = to_block
+
+    query = ("SELECT rowid, tx_hash, block_number, name, args FROM event WHERE {} "
+             "ORDER BY block_number, rowid LIMIT :limit;").format(' AND '.join(clauses))
 
-def get_stored_events(conn: sqlite3.Connection) -> List[DictOfAny]:
-    events: List[DictOfAny] = []
     cur = conn.cursor()
-    cur.execute("SELECT rowid, tx_hash, block_number, name, args FROM event;")
-    res = cur.fetchall()
-    if len(res) < 1:
-        return events
 
-    for row in res:
-        events.append({
-            'event_id': row[0],
-            'tx_hash': row[1],
-            'block_number': row[2],
-            'name': row[3],
-            'args': json.loads(row[4]),
-        })
+    while True:
+        cur.execute(query, params)
+        rows = cur.fetchall()
+
+        for row in rows:
+            yield StoredEvent(*row)
+
+        if len(rows) < page_size:
+            return
+
+        params['last_block'] = rows[-1][2]
+        params['last_rowid'] = rows[-1][0]
+
 
-    return events
+def get_stored_events(conn: sqlite3.Connection, **filters) -> List[StoredEvent]:
+    """ Get all stored events as a list.  Prefer iter_stored_events() for anything large.
+    filters are passed on to iter_stored_events(). """
+    return list(iter_stored_events(conn, **filters))
 
 
-def store_events(conn: sqlite3.Connection, events: List[DictOfAny]) -> None:
-    """ Store events in persistent storage """
+def store_events(conn: sqlite3.Connection, events: List[DictOfAny]) -> Set[int]:
+    """ Store events in persistent storage.  The whole batch is written in a single transaction
+    and rolled back if anything fails.  Returns the IDs of the bids the events touched. """
+    touched: Set[int] = set()
+
     if len(events) < 1:
-        return
-    cur = conn.cursor()
+        return touched
+
+    try:
+        with conn:
+            conn.executemany("INSERT INTO event (tx_hash, log_index, name, block_number, args) "
+                             "VALUES (:tx_hash, :log_index, :name, :block_number, :args) "
+                             "ON CONFLICT DO NOTHING;",
+                             ({
+                                 'tx_hash': evnt['txhash'],
+                                 'log_index': evnt['log_index'],
+                                 'block_number': evnt['block_number'],
+                                 'name': evnt['name'],
+                                 'args': json.dumps(evnt['args']),
+                             } for evnt in events))
+
+            for evnt in events:
+                event_name = evnt.get('name')
+                if event_name in EVENT_HANDLERS:
+                    EVENT_HANDLERS[event_name](conn, evnt)
+                    touched.add(evnt['args'].bidId)
+                else:
+                    log.warning("Unhandled event {}".format(event_name))
+    except Exception:
+        log.error("Storing {} events failed.  Rolled back.".format(len(events)))
+        raise
+
+    log.debug("Stored {} events".format(len(events)))
 
-    for evnt in events:
-        # log.debug("evnt: {}".format(evnt))
-        try:
-            cur.execute("INSERT INTO event (tx_hash, name, block_number, args) "
-                        "VALUES (:tx_hash, :name, :block_number, :args);",
-                        {
-                            'tx_hash': evnt['txhash'],
-                            'block_number': evnt['block_number'],
-                            'name': evnt['name'],
-                            'args': json.dumps(evnt['args']),
-                        })
-        except sqlite3.IntegrityError as err:
-            if 'UNIQUE' in str(err):
-                log.debug("Event already exists.")
-                pass
-            else:
-                raise err
-        else:
-            conn.commit()
-        log.debug("Inserted event {}".format(evnt.get('name')))
-        event_name = evnt.get('name')
-        if event_name == 'Pinned':
-            store_pin(conn, evnt)
-        elif event_name == 'BidSuccessful':
-            # store_bid(evnt)
-            store_bid(conn, evnt)
-        elif event_name == 'Accepted':
-            store_accept(conn, evnt)
-        else:
-            log.warning("Unhandled event {}".format(event_name))
+    return touched
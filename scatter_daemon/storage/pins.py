@@ -2,54 +2,58 @@ import json
 import sqlite3
 from datetime import datetime
 from attrdict import AttrDict
+from eth_utils import to_normalized_address
 from ..common.typing import DictOfAny, List
+from ..common.cid import to_cid
 from ..common.logging import getLogger
 
 log = getLogger(__name__)
 
 
 def store_accept(conn: sqlite3.Connection, evnt: DictOfAny):
-    """ Store an accept in the DB """
+    """ Store an accept in the DB.  The caller is responsible for committing.
+
+    Only the accepted bid's row is touched.  If the bid hasn't been seen yet, a partial row is
+    created that BidSuccessful will fill in.
+    """
     cur = conn.cursor()
-    assert evnt.get('name') == 'Accepted', "Invalid event given to store_pin"
-    try:
-        cur.execute("SELECT true FROM bid WHERE accepted_txhash = :txhash", {
-            'txhash': evnt['txhash']
-        })
-        if len(cur.fetchall()) == 0:
-            log.debug("!!!!!! accepted")
-            cur.execute("UPDATE bid SET accepted = :accept_stamp, accepted_txhash = :txhash, "
-                        " hoster = :hoster;", {
-                            'accept_stamp': evnt['args'].when,
-                            'txhash': evnt['txhash'],
-                            'hoster': evnt['args'].hoster,
-                        })
-            assert cur.rowcount > 0, "UPDATE failed"
-            conn.commit()
-        else:
-            log.warning("Accept already exists")
-    except Exception as err:
-        raise err
+    assert evnt.get('name') == 'Accepted', "Invalid event given to store_accept"
+    cur.execute("INSERT INTO bid (bid_id, hoster, pinned, accepted, accepted_txhash) "
+                "VALUES (:bid_id, :hoster, false, :accept_stamp, :txhash) "
+                "ON CONFLICT(bid_id) DO UPDATE SET accepted = excluded.accepted, "
+                "accepted_txhash = excluded.accepted_txhash, hoster = excluded.hoster;",
+                {
+                    'bid_id': evnt['args'].bidId,
+                    'accept_stamp': evnt['args'].when,
+                    'txhash': evnt['txhash'],
+                    'hoster': to_normalized_address(evnt['args'].hoster),
+                })
+    assert cur.rowcount > 0, "UPSERT failed"
 
 
 def store_pin(conn: sqlite3.Connection, evnt: DictOfAny):
-    """ Store a pin in the DB """
+    """ Store a pin in the DB.  The caller is responsible for committing.
+
+    Only the pinned bid's row is touched.  If the bid hasn't been seen yet, a partial row is
+    created that BidSuccessful will fill in.
+    """
     cur = conn.cursor()
     assert evnt.get('name') == 'Pinned', "Invalid event given to store_pin"
-    try:
-        cur.execute("SELECT true FROM bid WHERE pinned_txhash = :txhash", {
-            'txhash': evnt['txhash']
-        })
-        if len(cur.fetchall()) == 0:
-            cur.execute("UPDATE bid SET pinned = true, pinned_txhash = :txhash, "
-                        "hoster = :hoster", {
-                            'txhash': evnt['txhash'],
-                            'hoster': evnt['args'].hoster,
-                        })
-            assert cur.rowcount > 0, "UPDATE failed"
-            conn.commit()
-    except Exception as err:
-        raise err
+    file_hash = evnt['args'].get('fileHash')
+    cur.execute("INSERT INTO bid (bid_id, hoster, file_hash, file_cid, pinned, pinned_txhash) "
+                "VALUES (:bid_id, :hoster, :file_hash, :file_cid, true, :txhash) "
+                "ON CONFLICT(bid_id) DO UPDATE SET pinned = true, "
+                "pinned_txhash = excluded.pinned_txhash, hoster = excluded.hoster, "
+                "file_hash = COALESCE(bid.file_hash, excluded.file_hash), "
+                "file_cid = COALESCE(bid.file_cid, excluded.file_cid);",
+                {
+                    'bid_id': evnt['args'].bidId,
+                    'hoster': to_normalized_address(evnt['args'].hoster),
+                    'file_hash': file_hash,
+                    'file_cid': to_cid(file_hash) if file_hash else None,
+                    'txhash': evnt['txhash'],
+                })
+    assert cur.rowcount > 0, "UPSERT failed"
 
 
 def set_pin_validated(conn: sqlite3.Connection, bid_id: int) -> None:
@@ -0,0 +1,26 @@
+import sqlite3
+from ..common.typing import Optional
+from ..common.logging import getLogger
+
+log = getLogger(__name__)
+
+
+def get_sync_block(conn: sqlite3.Connection, name: str) -> Optional[int]:
+    """ Get the last fully processed block for the named sync cursor """
+    cur = conn.cursor()
+    cur.execute("SELECT block_number FROM sync_state WHERE name = :name;", {'name': name})
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def set_sync_block(conn: sqlite3.Connection, name: str, block_number: int) -> None:
+    """ Advance the named sync cursor.  Only call once the events up to and including
+    block_number have been committed. """
+    cur = conn.cursor()
+    cur.execute("INSERT OR REPLACE INTO sync_state (name, block_number) "
+                "VALUES (:name, :block_number);",
+                {'name': name, 'block_number': block_number})
+    conn.commit()
+    log.debug("Sync cursor {} now at block {}".format(name, block_number))
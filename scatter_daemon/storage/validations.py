@@ -0,0 +1,44 @@
+import sqlite3
+from eth_utils import to_normalized_address
+from ..common.typing import DictOfAny
+from ..common.logging import getLogger
+
+log = getLogger(__name__)
+
+
+def store_validation(conn: sqlite3.Connection, evnt: DictOfAny):
+    """ Store a validation in the DB and count it against its bid.  The caller is responsible for
+    committing. """
+    cur = conn.cursor()
+    assert evnt.get('name') == 'ValidationOcurred', "Invalid event given to store_validation"
+    cur.execute("INSERT INTO validation (tx_hash, bid_id, validator, is_valid, block_number) "
+                "VALUES (:tx_hash, :bid_id, :validator, :is_valid, :block_number) "
+                "ON CONFLICT DO NOTHING;",
+                {
+                    'tx_hash': evnt['txhash'],
+                    'bid_id': evnt['args'].bidId,
+                    'validator': to_normalized_address(evnt['args'].validator),
+                    'is_valid': evnt['args'].isValid,
+                    'block_number': evnt['block_number'],
+                })
+
+    # Only count validations we haven't seen before, so replays don't inflate the count
+    if cur.rowcount < 1:
+        log.debug("Validation already exists.")
+        return
+
+    cur.execute("INSERT INTO bid (bid_id, pinned, validation_count) "
+                "VALUES (:bid_id, false, 1) "
+                "ON CONFLICT(bid_id) DO UPDATE SET validation_count = validation_count + 1;",
+                {'bid_id': evnt['args'].bidId})
+    assert cur.rowcount > 0, "UPSERT failed"
+
+
+def get_validation_count(conn: sqlite3.Connection, bid_id: int) -> int:
+    """ Get the number of validations a bid has had """
+    cur = conn.cursor()
+    cur.execute("SELECT validation_count FROM bid WHERE bid_id = :bid_id;", {'bid_id': bid_id})
+    row = cur.fetchone()
+    if row is None:
+        return 0
+    return row[0]
@@ -1 +1,2 @@
 from .main import validate_run  # noqa: F401
+from .aio import validate_run_async  # noqa: F401
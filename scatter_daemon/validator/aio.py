@@ -0,0 +1,467 @@
+""" asyncio validator engine, for `scatter validator run --async`.
+
+Event sync, bid selection and validations run as tasks on a single event loop.  Validations only
+wait on the network, so thousands of them can be in flight against different hosters without a
+thread for each.  SQLite is still blocking, so it's used from the loop's default executor.
+"""
+import asyncio
+import signal
+from collections import Counter
+from configparser import ConfigParser
+from web3.providers import HTTPProvider
+from ..storage import (
+    open_db_from_config,
+    store_events,
+    handled_events,
+    get_bids_to_validate,
+    get_bids_missing_details,
+    store_bid_details,
+    get_sync_block,
+    set_sync_block,
+    set_pin_validated,
+    get_dag_index,
+    store_dag_index,
+    DagIndex,
+)
+from ..scatter.register import (
+    REGISTRATION_MISS,
+    verify_registration,
+    get_cached_registration,
+    cache_registration,
+)
+from ..common.aio import aiohttp, require_aiohttp, AsyncJSONRPC, AsyncIPFS
+from ..common.const import (
+    STD_PROCESS_DELAY,
+    SETTLED_PROCESS_DELAY,
+    DEFAULT_CONFIRMATIONS,
+    LOG_FETCH_WINDOW,
+    LOG_FETCH_WORKERS,
+    VALIDATOR_MAX_PER_HOSTER,
+    VALIDATOR_LOOKAHEAD,
+    VALIDATOR_ASYNC_CONCURRENCY,
+    SWARM_MAX_PEERS,
+)
+from ..common.config import VALIDATOR_EL, config_get
+from ..common.contracts import (
+    init_router_contract,
+    router_lookup,
+    contract_at,
+    event_topics,
+    get_event_decoders,
+    decode_logs,
+)
+from ..common.cid import to_cid
+from ..common.ipfs import (
+    IPFSRouter,
+    ipfs_endpoints_from_config,
+    ipfs_timeout_from_config,
+)
+from ..common.swarm import PEER_CONNECTED, PEER_BACKOFF, SwarmManager
+from ..common.web3 import init_web3, LogWindowPlanner
+from ..common.exceptions import ScatterError, ValidatorError
+from ..common.typing import Any, Dict, Generator, List, Set, Tuple, DictOfAny
+from ..common.logging import getLogger
+from .logic import ValidationScheduler
+from .main import get_validation_options, get_sampling_options
+from .sampling import (
+    LINKS,
+    DATA,
+    SIZE,
+    FETCH,
+    LOCAL,
+    Step,
+    BLOCK_RM_BATCH,
+    daemon_timeout,
+    walk_dag,
+    sample_steps,
+    sample_seed,
+    sample_result,
+)
+
+log = getLogger(__name__)
+
+IPFS_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ScatterError) if aiohttp else ()
+
+
+class AsyncValidator:
+    """ The validator, as cooperating asyncio tasks """
+    def __init__(self, conf: ConfigParser):
+        require_aiohttp()
+
+        self.web3 = init_web3(conf)
+        self.my_account = config_get(conf, 'account')
+        router_address = config_get(conf, 'router_address')
+
+        if not self.my_account or not router_address:
+            raise ValidatorError("Missing an address for router or validator.")
+
+        provider = self.web3.providers[0]
+        if not isinstance(provider, HTTPProvider):
+            raise ValidatorError("Async mode needs an HTTP web3 provider.")
+        self.endpoint_uri = provider.endpoint_uri
+
+        # Contracts are only used to build calls, which doesn't touch the network.  The Scatter
+        # and Register addresses are looked up by run(), on the event loop.
+        self.router = init_router_contract(self.web3, router_address)
+
+        self.db = open_db_from_config(conf)
+        self.ipfs_router = IPFSRouter(ipfs_endpoints_from_config(conf, VALIDATOR_EL),
+                                      ipfs_timeout_from_config(conf, VALIDATOR_EL))
+        self.confirmations = int(config_get(conf, 'confirmations', DEFAULT_CONFIRMATIONS))
+        self.log_window = int(config_get(conf, 'log_fetch_window', LOG_FETCH_WINDOW))
+        self.log_workers = int(config_get(conf, 'log_fetch_workers', LOG_FETCH_WORKERS))
+        self.options = get_validation_options(conf)
+        self.sampling = get_sampling_options(conf)
+        self.concurrency = int(config_get(conf, 'async_concurrency', VALIDATOR_ASYNC_CONCURRENCY,
+                                          section=VALIDATOR_EL))
+        self.max_per_hoster = int(config_get(conf, 'max_per_hoster', VALIDATOR_MAX_PER_HOSTER,
+                                             section=VALIDATOR_EL))
+        self.swarm = SwarmManager(int(config_get(conf, 'swarm_max_peers', SWARM_MAX_PEERS,
+                                                 section=VALIDATOR_EL)))
+        self.scheduler = ValidationScheduler(
+            random_tie_break=config_get(conf, 'random_tie_break', 'false',
+                                        section=VALIDATOR_EL).lower() in ('true', 'yes', '1')
+        )
+
+        self.in_flight: Set[int] = set()
+        self.hoster_active: Counter = Counter()
+        self.tasks: Set[asyncio.Future] = set()
+
+    async def run_db(self, fn: Any, *args: Any, write: bool = False) -> Any:
+        """ Run a storage function with a connection, off the event loop.  Writes are
+        committed. """
+        def run():
+            if write:
+                with self.db.writer() as conn:
+                    with conn:
+                        return fn(conn, *args)
+            with self.db.reader() as conn:
+                return fn(conn, *args)
+        return await self.loop.run_in_executor(None, run)
+
+    async def fetch_events(self) -> Set[int]:
+        """ Fetch and store all events since the last synced block, returning the touched bids.
+        Windows are planned like iter_logs() does, with tasks instead of threads. """
+        touched: Set[int] = set()
+
+        last_block = await self.run_db(get_sync_block, self.scatter.address)
+        from_block = 0 if last_block is None else last_block + 1
+        to_block = await self.rpc.block_number() - self.confirmations
+
+        if to_block < from_block:
+            return touched
+
+        topics = [event_topics(self.scatter.abi, handled_events())]
+        decoders = get_event_decoders(self.scatter.abi)
+        planner = LogWindowPlanner(from_block, to_block, self.log_window, self.log_workers)
+        pending: Dict[asyncio.Future, Tuple[int, int]] = {}
+
+        try:
+            while not planner.done() and not self.stop_event.is_set():
+                for start, end in planner.next_windows():
+                    fut = asyncio.ensure_future(self.rpc.get_logs_retrying(
+                        self.scatter.address, start, end, topics
+                    ))
+                    pending[fut] = (start, end)
+
+                finished, _ = await asyncio.wait(list(pending.keys()),
+                                                 return_when=asyncio.FIRST_COMPLETED)
+
+                for fut in finished:
+                    start, end = pending.pop(fut)
+                    try:
+                        logs = fut.result()
+                    except Exception as err:
+                        planner.failed(start, end, err)
+                        continue
+                    planner.finished(start, end, logs)
+
+                # Stored in block order so the cursor never skips anything
+                for start, end, logs in planner.ready():
+                    events = decode_logs(decoders, logs)
+                    log.debug("Found {} events between blocks {} and {}.".format(
+                        len(events), start, end
+                    ))
+                    if events:
+                        touched.update(await self.run_db(store_events, events, write=True))
+                    await self.run_db(set_sync_block, self.scatter.address, end, write=True)
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+        return touched
+
+    async def fetch_bid_details(self) -> None:
+        """ Fill in the bid attributes that BidSuccessful doesn't carry """
+        bid_ids = await self.run_db(get_bids_missing_details)
+        if len(bid_ids) < 1:
+            return
+
+        bids = await self.rpc.call_many([self.scatter.functions.getBid(bid_id)
+                                         for bid_id in bid_ids])
+        await self.run_db(store_bid_details, [
+            (bid_id, duration, min_valid)
+            for bid_id, (_, _, _, _, _, duration, min_valid) in zip(bid_ids, bids)
+        ], write=True)
+
+    async def sync_task(self) -> None:
+        """ Keep the local state and the schedule up to date with the chain """
+        while not self.stop_event.is_set():
+            try:
+                touched = await self.fetch_events()
+                await self.fetch_bid_details()
+
+                if len(self.scheduler) < 1:
+                    pins = await self.run_db(get_bids_to_validate, self.my_account, self.options)
+                    self.scheduler.update_many(pins)
+                elif touched:
+                    pins = await self.run_db(get_bids_to_validate, self.my_account,
+                                             self.options, touched)
+                    self.scheduler.update_many(pins, touched)
+
+                self.scheduler.rescore()
+                log.debug("{} pins scheduled for validation".format(len(self.scheduler)))
+
+                if len(self.scheduler) > 0:
+                    self.work_event.set()
+            except Exception:
+                log.exception("Event sync failed.  Will try again.")
+
+            delay = STD_PROCESS_DELAY if len(self.scheduler) > 0 else SETTLED_PROCESS_DELAY
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def select_task(self) -> None:
+        """ Start validations for the best bids, as concurrency allows """
+        while not self.stop_event.is_set():
+            await self.work_event.wait()
+            self.work_event.clear()
+
+            free = self.concurrency - len(self.in_flight)
+
+            # Look past the first few, in case their hosters are already busy
+            for pin in self.scheduler.top(free * VALIDATOR_LOOKAHEAD):
+                if len(self.in_flight) >= self.concurrency:
+                    break
+                if (pin['bid_id'] in self.in_flight
+                        or self.hoster_active[pin['hoster']] >= self.max_per_hoster):
+                    continue
+
+                self.scheduler.remove(pin['bid_id'])
+                self.in_flight.add(pin['bid_id'])
+                self.hoster_active[pin['hoster']] += 1
+                task = self.loop.create_task(self.validate_task(pin))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def validate_task(self, pin: DictOfAny) -> None:
+        """ Validate a bid.  select_task() has already counted it in in_flight. """
+        try:
+            log.info('Validating bid #{}'.format(pin['bid_id']))
+            await self.validate_bid(pin)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Validation of bid #{} failed.".format(pin['bid_id']))
+        finally:
+            self.in_flight.discard(pin['bid_id'])
+            self.hoster_active[pin['hoster']] -= 1
+            if self.hoster_active[pin['hoster']] < 1:
+                del self.hoster_active[pin['hoster']]
+            self.work_event.set()
+
+    async def validate_bid(self, pin: DictOfAny) -> None:
+        """ Perform validation """
+        bid_id = pin['bid_id']
+
+        hex_hash = await self.rpc.call(self.register.functions.getUserFile(pin['hoster']))
+        hoster_reg = get_cached_registration(pin['hoster'], hex_hash)
+        if hoster_reg is REGISTRATION_MISS:
+            hoster_reg = verify_registration(await self.ipfs.cat_json(to_cid(hex_hash)))
+            cache_registration(pin['hoster'], hex_hash, hoster_reg)
+
+        if hoster_reg is None:
+            log.warning("Unable to retrieve hoster's Registration from IPFS. Can not validate bid "
+                        "#{}. Will try again later.".format(bid_id))
+            return
+
+        multiaddr = hoster_reg.get('host', {}).get('multiaddr')
+        if not multiaddr:
+            log.warning("Hoster for bid #{} has no IPFS multiaddr.".format(bid_id))
+            return
+
+        # Swarm connections belong to one IPFS daemon, so the validation stays on one endpoint
+        async with self.ipfs.checkout() as node:
+            if not await self.swarm_connect(node, multiaddr):
+                log.warning("Unable to make connection to hoster's IPFS node. Can not validate "
+                            "bid #{}. Will try again later.".format(bid_id))
+                return
+
+            file_cid = pin['file_cid'] or to_cid(pin['file_hash'])
+            block = await self.rpc.request('eth_getBlockByNumber', ['latest', False])
+
+            try:
+                blocks = await self.file_blocks(node, file_cid)
+                result = await self.run_steps(node, sample_steps(
+                    blocks, sample_seed(bid_id, block['hash']), self.sampling.confidence,
+                    self.sampling.missing
+                ))
+            except ScatterError as err:
+                log.warning("Unable to list the blocks of {} for bid #{}: {}".format(
+                    file_cid, bid_id, err
+                ))
+                blocks = []
+                result = sample_result(0, [file_cid], 0, self.sampling.missing)
+
+        log.info("Bid #{} valid: {}.  Sampled {} of {} blocks at block {} ({} skipped as "
+                 "local), confidence {:.4f}.".format(bid_id, result.valid,
+                                                     result.proven + len(result.failed),
+                                                     len(blocks), int(block['number'], 16),
+                                                     result.local, result.confidence))
+
+        if result.valid:
+            await self.run_db(set_pin_validated, bid_id, write=True)
+
+    async def file_blocks(self, node: AsyncIPFS, file_cid: str) -> DagIndex:
+        """ A file's blocks from the DAG index, walking the DAG the first time the file is
+        seen """
+        index = await self.run_db(get_dag_index, file_cid)
+
+        if index is None:
+            index = DagIndex.from_blocks(file_cid, await self.run_steps(node, walk_dag(file_cid)))
+            await self.run_db(store_dag_index, index, write=True)
+            log.debug("Indexed {} blocks of {}".format(len(index), file_cid))
+
+        return index
+
+    async def run_steps(self, node: AsyncIPFS, steps: Generator[Step, Any, Any]) -> Any:
+        """ sampling.run_steps() for an async client """
+        timeout = daemon_timeout(self.sampling.timeout)
+        answer = None
+        fetched: List[str] = []
+
+        try:
+            while True:
+                try:
+                    kind, cid = steps.send(answer)
+                except StopIteration as stop:
+                    return stop.value
+
+                if kind == LINKS:
+                    answer = (await node.object_links(cid, timeout=timeout)).get('Links') or []
+                elif kind == DATA:
+                    answer = await node.object_data(cid, timeout=timeout)
+                elif kind == SIZE:
+                    answer = (await node.block_stat(cid, timeout=timeout))['Size']
+                elif kind == FETCH:
+                    try:
+                        answer = (await node.block_stat(cid, timeout=timeout)).get('Size')
+                    except ScatterError as err:
+                        log.debug("Unable to fetch block {}: {}".format(cid, err))
+                        answer = None
+                elif kind == LOCAL:
+                    try:
+                        await node.block_stat(cid, offline='true')
+                        answer = True
+                    except ScatterError:
+                        answer = False
+                        fetched.append(cid)
+                else:
+                    raise ValueError("Unknown step {}".format(kind))
+        finally:
+            await self.remove_blocks(node, fetched)
+
+    async def remove_blocks(self, node: AsyncIPFS, cids: List[str]) -> None:
+        """ sampling.remove_blocks() for an async client """
+        for i in range(0, len(cids), BLOCK_RM_BATCH):
+            try:
+                await node.block_rm(*cids[i:i + BLOCK_RM_BATCH])
+            except IPFS_ERRORS as err:
+                log.debug("Unable to remove fetched blocks: {}".format(err))
+
+    async def swarm_connect(self, node: AsyncIPFS, multiaddr: str) -> bool:
+        """ SwarmManager.connect() for an async client """
+        if self.swarm.needs_refresh(node.name):
+            try:
+                peers = await node.swarm_peers()
+                self.swarm.live_peers(node.name, {p.get('Peer') for p in peers.get('Peers') or []})
+            except IPFS_ERRORS as err:
+                log.warning("Unable to list swarm peers: {}".format(err))
+
+        status = self.swarm.status(node.name, multiaddr)
+        if status == PEER_CONNECTED:
+            return True
+        elif status == PEER_BACKOFF:
+            return False
+
+        ok = False
+        try:
+            resp = await node.swarm_connect(multiaddr)
+            ok = any('success' in ln for ln in resp.get('Strings', []))
+        except IPFS_ERRORS as err:
+            log.debug("swarm connect to {} failed: {}".format(multiaddr, err))
+
+        for addr in self.swarm.connected(node.name, multiaddr, ok):
+            try:
+                await node.swarm_disconnect(addr)
+            except IPFS_ERRORS as err:
+                log.debug("swarm disconnect from {} failed: {}".format(addr, err))
+
+        return ok
+
+    def stop(self) -> None:
+        log.info("Stopping.  Finishing running validations...")
+        self.stop_event.set()
+        self.work_event.set()
+
+    async def run(self) -> None:
+        """ Run until stopped by SIGINT or SIGTERM """
+        self.loop = asyncio.get_event_loop()
+        self.stop_event = asyncio.Event()
+        self.work_event = asyncio.Event()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self.stop)
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.rpc = AsyncJSONRPC(session, self.endpoint_uri)
+            self.ipfs = AsyncIPFS(session, self.ipfs_router)
+
+            self.scatter = contract_at(self.web3, 'Scatter', await self.rpc.call(
+                router_lookup(self.router, 'Scatter')
+            ))
+            self.register = contract_at(self.web3, 'Register', await self.rpc.call(
+                router_lookup(self.router, 'Register')
+            ))
+
+            log.info("Starting async validation run with up to {} validations at once.".format(
+                self.concurrency
+            ))
+
+            sync = self.loop.create_task(self.sync_task())
+            select = self.loop.create_task(self.select_task())
+
+            await self.stop_event.wait()
+
+            select.cancel()
+            await asyncio.gather(sync, select, return_exceptions=True)
+
+            if self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        log.info("Validation run stopped.")
+
+
+def validate_run_async(conf: ConfigParser) -> None:
+    """ Run the validator on an asyncio event loop """
+    require_aiohttp()
+    validator = AsyncValidator(conf)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(validator.run())
+    finally:
+        loop.close()
@@ -1,57 +1,154 @@
-from random import shuffle
-from web3.eth import Contract
-from ..common.typing import List, DictOfAny
-from ..common.const import VALIDATION_DEFAULTS
-from ..common.utils import get_from_first
+import time
+import heapq
+from random import random
+from itertools import count
+from ..common.typing import List, Dict, Optional, Iterable, DictOfAny
+from ..common.const import SCHEDULE_SIZE_UNIT, SCHEDULE_TIME_UNIT
 from ..common.logging import getLogger
 
 log = getLogger(__name__)
 
 
-def select_random_pin_for_validation(scatter: Contract, pins: List[DictOfAny], options: DictOfAny) -> int:
-    """ Select a pin to validate at random, as long as the bid fits our criterea """
-    total = len(pins)
-    log.debug('Selecting from {} total pins.'.format(total))
-    if total < 1:
-        return -1
-
-    min_file_size = get_from_first('min_file_size', options, VALIDATION_DEFAULTS)
-    max_file_size = get_from_first('max_file_size', options, VALIDATION_DEFAULTS)
-    min_reward = get_from_first('min_reward', options, VALIDATION_DEFAULTS)
-    min_duration = get_from_first('min_duration', options, VALIDATION_DEFAULTS)
-    max_duration = get_from_first('max_duration', options, VALIDATION_DEFAULTS)
-
-    pin_idx_range = list(range(0, total))
-    shuffle(pin_idx_range)
-
-    for idx in pin_idx_range:
-        log.debug('Checking pin #{}'.format(idx))
-        pin = pins[idx]
-        bid_id = pin.get('bid_id')
-
-        if bid_id is None:
-            raise ValueError("Provided pin missing bid_id")
-
-        (
-            bidder,
-            file_hash,
-            file_size,
-            bid_value,
-            validation_pool,
-            duration,
-            min_valid
-        ) = scatter.functions.getBid(bid_id).call()
-        validation_count = scatter.functions.getValidationCount(bid_id).call()
-
-        # Only return something we want
-        if (file_size < min_file_size
-                or file_size > max_file_size
-                or (validation_count != 0 and (validation_pool // validation_count) < min_reward)
-                or duration < min_duration
-                or duration > max_duration):
-            log.debug('Pin #{} does not meet criteria.'.format(idx))
-            continue
-        else:
-            log.debug('Selecting pin #{}.'.format(idx))
-            return bid_id
-    return -1
+def bid_ends(pin: DictOfAny) -> Optional[int]:
+    """ The timestamp a bid's hosting period ends, if it's known """
+    if not pin.get('accepted') or pin.get('duration') is None:
+        return None
+    return pin['accepted'] + pin['duration']
+
+
+def bid_priority(pin: DictOfAny, now: Optional[int] = None) -> Optional[float]:
+    """ Score a bid by the payout we'd receive for validating it next, relative to the size of the
+    file we have to fetch and the time it has left.  Bids near their end are favoured, since
+    they won't be available for long.  Returns None if the bid has already ended. """
+    now = now or int(time.time())
+
+    remaining = pin.get('duration') or 0
+    ends = bid_ends(pin)
+    if ends is not None:
+        remaining = ends - now
+        if remaining <= 0:
+            return None
+
+    payout = (pin.get('validation_pool') or 0) // ((pin.get('validation_count') or 0) + 1)
+    size = (pin.get('file_size') or 0) / SCHEDULE_SIZE_UNIT
+
+    return payout / (1 + size) / max(1, remaining / SCHEDULE_TIME_UNIT)
+
+
+class ValidationScheduler:
+    """ Priority queue of bids to validate, highest bid_priority() first.
+
+    Bids are updated in place as events come in.  Replaced or removed entries are left in the
+    heap and skipped when they reach the top, so every operation is O(log n).  Priorities depend
+    on the time a bid has left, so their order drifts; rescore() brings it up to date.  With
+    random_tie_break, bids of equal priority come out in random order, so validators with the
+    same view of the chain don't all pick the same bid.
+    """
+    def __init__(self, random_tie_break: bool = False):
+        self.random_tie_break = random_tie_break
+        self.heap: List[list] = []
+        self.entries: Dict[int, list] = {}
+        self.counter = count()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, bid_id: int) -> bool:
+        return bid_id in self.entries
+
+    def update(self, pin: DictOfAny, now: Optional[int] = None) -> None:
+        """ Add a bid or re-score an existing one """
+        bid_id = pin['bid_id']
+        priority = bid_priority(pin, now)
+
+        self.remove(bid_id)
+
+        if priority is None:
+            log.debug('Bid #{} has ended, not scheduling.'.format(bid_id))
+            return
+
+        tie_break = random() if self.random_tie_break else 0
+        entry = [-priority, tie_break, next(self.counter), bid_id, pin]
+        self.entries[bid_id] = entry
+        heapq.heappush(self.heap, entry)
+
+        # Don't let stale entries pile up when bids are updated a lot
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+
+    def update_many(self, pins: Iterable[DictOfAny], bid_ids: Iterable[int] = (),
+                    now: Optional[int] = None) -> None:
+        """ Update from the eligible pins for a set of touched bid_ids.  Any of those bids not in
+        pins are no longer eligible and removed. """
+        now = now or int(time.time())
+        eligible = set()
+
+        for pin in pins:
+            self.update(pin, now)
+            eligible.add(pin['bid_id'])
+
+        for bid_id in bid_ids:
+            if bid_id not in eligible:
+                self.remove(bid_id)
+
+    def rescore(self, now: Optional[int] = None) -> None:
+        """ Re-score every bid for the time now and rebuild the heap, dropping ended bids and
+        stale entries.  O(n), so it's meant for once per sync. """
+        now = now or int(time.time())
+
+        for bid_id, entry in list(self.entries.items()):
+            priority = bid_priority(entry[-1], now)
+            if priority is None:
+                del self.entries[bid_id]
+            else:
+                entry[0] = -priority
+
+        self.heap = list(self.entries.values())
+        heapq.heapify(self.heap)
+
+    def remove(self, bid_id: int) -> None:
+        """ Remove a bid, if scheduled """
+        entry = self.entries.pop(bid_id, None)
+        if entry is not None:
+            entry[-1] = None
+
+    def _pop_entry(self, now: int) -> Optional[list]:
+        """ Pop the best live entry off the heap, dropping anything stale or ended """
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            pin = entry[-1]
+            if pin is None:
+                continue
+
+            ends = bid_ends(pin)
+            if ends is not None and ends <= now:
+                del self.entries[entry[3]]
+                continue
+
+            return entry
+        return None
+
+    def top(self, k: int = 1, now: Optional[int] = None) -> List[DictOfAny]:
+        """ The k best bids, without removing them """
+        now = now or int(time.time())
+        best: List[list] = []
+
+        while len(best) < k:
+            entry = self._pop_entry(now)
+            if entry is None:
+                break
+            best.append(entry)
+
+        for entry in best:
+            heapq.heappush(self.heap, entry)
+
+        return [entry[-1] for entry in best]
+
+    def pop(self, now: Optional[int] = None) -> Optional[DictOfAny]:
+        """ Remove and return the best bid """
+        entry = self._pop_entry(now or int(time.time()))
+        if entry is None:
+            return None
+        del self.entries[entry[3]]
+        return entry[-1]
@@ -1,28 +1,56 @@
 """ The Validator """
 import time
-import sqlite3
+import signal
 import ipfsapi
-from typing import List
+from functools import partial
 from configparser import ConfigParser
 from eth_utils import is_address
 from web3 import Web3
 from web3.eth import Contract
 from attrdict import AttrDict
-from ..storage import connect, store_events, get_bids_to_validate
+from ..storage import (
+    ConnectionManager,
+    DagIndex,
+    open_db_from_config,
+    get_bids_to_validate,
+    set_pin_validated,
+    get_dag_index,
+    store_dag_index,
+)
+from ..scatter.bids import fetch_bid_details
+from ..scatter.events import fetch_events
 from ..scatter.register import get_registration
-from ..common.const import STD_PROCESS_DELAY, SETTLED_PROCESS_DELAY, DEFAULT_DB_FILE
+from ..common.const import (
+    STD_PROCESS_DELAY,
+    SETTLED_PROCESS_DELAY,
+    DEFAULT_CONFIRMATIONS,
+    VALIDATION_DEFAULTS,
+    LOG_FETCH_WINDOW,
+    LOG_FETCH_WORKERS,
+    VALIDATOR_WORKERS,
+    VALIDATOR_MAX_PER_HOSTER,
+    VALIDATOR_LOOKAHEAD,
+    SWARM_MAX_PEERS,
+    VALIDATION_SAMPLE_CONFIDENCE,
+    VALIDATION_SAMPLE_MISSING,
+    VALIDATION_BLOCK_TIMEOUT,
+)
 from ..common.config import VALIDATOR_EL, config_get
 from ..common.contracts import (
     init_router_contract,
     init_scatter_contract,
-    events_from_abi,
-    event_from_log,
     init_register_contract,
 )
-from ..common.web3 import init_web3, eth_getLogs
+from ..common.cid import to_cid
+from ..common.ipfs import IPFSNode, IPFSPool, ipfs_pool_from_config
+from ..common.swarm import SwarmManager
+from ..common.web3 import init_web3
 from ..common.exceptions import ValidatorError
+from ..common.typing import DictOfAny, Optional
 from ..common.logging import getLogger
-from .logic import select_random_pin_for_validation
+from .logic import ValidationScheduler
+from .pool import ValidatorPool
+from .sampling import dag_blocks, sample_seed, sample_result, validate_sample
 
 log = getLogger(__name__)
 
@@ -33,70 +61,126 @@ def get_job():
     pass
 
 
-def process_events(contract: Contract, logs: List) -> List[AttrDict]:
-    """ Process all events """
-    events = []
-    event_lookup = events_from_abi(contract.abi)
-    for event_log in logs:
-        topic_sig = event_log['topics'][0].hex()
-        log.debug("topic_sig: {}".format(topic_sig))
-        log.debug("event_lookup: {}".format(event_lookup))
-        if topic_sig in event_lookup:
-            new_event = event_from_log(event_lookup[topic_sig], event_log)
-            new_event['name'] = event_lookup[topic_sig].get('name')
-            new_event['txhash'] = logs[0]['transactionHash'].hex()
-            new_event['block_number'] = logs[0]['blockNumber']
-            log.info("Received event {}.".format(new_event['name']))
-            events.append(new_event)
-    return events
+def get_validation_options(conf: ConfigParser) -> DictOfAny:
+    """ Read the bid filters from the [validator] section """
+    options: DictOfAny = {}
+    for key in VALIDATION_DEFAULTS.keys():
+        val = config_get(conf, key, section=VALIDATOR_EL)
+        if val:
+            options[key] = int(val)
+    return options
+
 
+def get_sampling_options(conf: ConfigParser) -> AttrDict:
+    """ Read the block sampling settings from the [validator] section """
+    return AttrDict({
+        'confidence': float(config_get(conf, 'sample_confidence', VALIDATION_SAMPLE_CONFIDENCE,
+                                       section=VALIDATOR_EL)),
+        'missing': float(config_get(conf, 'sample_missing', VALIDATION_SAMPLE_MISSING,
+                                    section=VALIDATOR_EL)),
+        'timeout': float(config_get(conf, 'block_timeout', VALIDATION_BLOCK_TIMEOUT,
+                                    section=VALIDATOR_EL)),
+    })
 
-def fetch_events(conn: sqlite3.Connection, web3: Web3, scatter: Contract):
-    """ Retrieve and store all events """
-    log.debug("Getting events for Scatter")
 
-    logs = eth_getLogs(web3, from_block='0x0', address=scatter.address)
+def get_file_blocks(db: ConnectionManager, ipfs: IPFSNode, file_cid: str,
+                    timeout: float = VALIDATION_BLOCK_TIMEOUT) -> DagIndex:
+    """ A file's blocks from the DAG index, walking the DAG the first time the file is seen """
+    with db.reader() as conn:
+        index = get_dag_index(conn, file_cid)
 
-    log.debug("Found {} logs.".format(len(logs)))
+    if index is None:
+        index = DagIndex.from_blocks(file_cid, dag_blocks(ipfs, file_cid, timeout))
+        with db.writer() as conn:
+            with conn:
+                store_dag_index(conn, index)
+        log.debug("Indexed {} blocks of {}".format(len(index), file_cid))
 
-    if logs:
-        events = process_events(scatter, logs)
-        if events:
-            store_events(conn, events)
+    return index
 
 
-def validate_bid(ipfs: ipfsapi.client.Client, scatter: Contract, register: Contract, bid_id: int):
-    """ Perform validation """
-    print('#######################################################################################')
-    print('#######################################################################################')
-    print('#######################################################################################')
+def validate_bid(ipfs: IPFSNode, swarm: SwarmManager, db: ConnectionManager, web3: Web3,
+                 scatter: Contract, register: Contract, bid_id: int, file_cid: str,
+                 sampling: AttrDict) -> Optional[AttrDict]:
+    """ Perform validation by fetching a random sample of the file's blocks from the hoster.
+    Returns the sample's result, or None if the bid can't be validated right now. """
     hoster = scatter.functions.getHoster(bid_id).call()
     assert is_address(hoster), "Invalid address received from Scatter"
     hoster_reg = get_registration(ipfs, register, hoster)
     if hoster_reg is None:
         log.warning("Unable to retrieve hoster's Registration from IPFS. Can not validate bid "
                     "#{}. Will try again later.".format(bid_id))
-        return
+        return None
 
-    # If any check fails, this will turn False
-    valid = True
+    multiaddr = hoster_reg.get('host', {}).get('multiaddr')
+    if not multiaddr:
+        log.warning("Hoster for bid #{} has no IPFS multiaddr.".format(bid_id))
+        return None
 
-    # Get our node to connect to the hoster's
-    conn_status = ipfs.swarm_connect(hoster_reg)
-    assert 'Strings' in conn_status, (
-        "Unexpected response from ipfs swarm connect: {}".format(conn_status)
-    )
-    if (len(conn_status['Strings']) == 0
-            or not any('success' in ln for ln in conn_status['Strings'])):
-        log.warning("Unable to make connection to hoster's IPFS node.")
+    # Get our node to connect to the hoster's, unless it already is
+    if not swarm.connect(ipfs, multiaddr):
+        log.warning("Unable to make connection to hoster's IPFS node. Can not validate bid "
+                    "#{}. Will try again later.".format(bid_id))
+        return None
+
+    block = web3.eth.getBlock('latest')
 
-    # TODO
-    assert False, "break. Not yet implemented"
+    try:
+        blocks = get_file_blocks(db, ipfs, file_cid, sampling.timeout)
+    except ipfsapi.exceptions.ErrorResponse as err:
+        log.warning("Unable to list the blocks of {} for bid #{}: {}".format(file_cid, bid_id,
+                                                                            err))
+        return sample_result(0, [file_cid], 0, sampling.missing)
+
+    result = validate_sample(ipfs, blocks, sample_seed(bid_id, block['hash']),
+                             sampling.confidence, sampling.missing, sampling.timeout)
+
+    log.info("Bid #{} valid: {}.  Sampled {} of {} blocks at block {} ({} skipped as local), "
+             "confidence {:.4f}.".format(bid_id, result.valid, result.proven + len(result.failed),
+                                         len(blocks), block['number'], result.local,
+                                         result.confidence))
+
+    return result
+
+
+def init_validation_worker(conf: ConfigParser, db: ConnectionManager, ipfs: IPFSPool,
+                           swarm: SwarmManager) -> AttrDict:
+    """ Create the web3 handles for a single validation worker.  The DB, IPFS pool and swarm
+    connections are shared, so requests are balanced across endpoints for all workers and a
+    hoster connected by one worker is connected for all of them. """
+    web3 = init_web3(conf)
+    router = init_router_contract(web3, config_get(conf, 'router_address'))
+    return AttrDict({
+        'web3': web3,
+        'scatter': init_scatter_contract(web3, router),
+        'register': init_register_contract(web3, router),
+        'ipfs': ipfs,
+        'swarm': swarm,
+        'db': db,
+        'sampling': get_sampling_options(conf),
+    })
+
+
+def validate_pin(worker: AttrDict, pin: DictOfAny) -> None:
+    """ Validate a pin with a worker's own handles """
+    # Swarm connections belong to one IPFS daemon, so a validation stays on one endpoint
+    with worker.ipfs.checkout() as node:
+        result = validate_bid(node, worker.swarm, worker.db, worker.web3, worker.scatter,
+                              worker.register, pin['bid_id'],
+                              pin['file_cid'] or to_cid(pin['file_hash']), worker.sampling)
+
+    if result is not None and result.valid:
+        with worker.db.writer() as conn:
+            with conn:
+                set_pin_validated(conn, pin['bid_id'])
 
 
 def validate_run(conf: ConfigParser) -> None:
     """ Run a continuous process and validate everything eligible that meets the filters in the
     provided configuration.
+
+    This thread syncs events and hands the best bids to a pool of validation workers, as they
+    have room.  SIGINT and SIGTERM let running validations finish before exiting.
     """
     log.info("Preparing to start validation run...")
 
@@ -109,31 +193,78 @@ def validate_run(conf: ConfigParser) -> None:
 
     router = init_router_contract(web3, router_address)
     scatter = init_scatter_contract(web3, router)
-    register = init_register_contract(web3, router)
-    db_conn = connect(config_get(conf, 'db_file', DEFAULT_DB_FILE))
-    ipfs_conn = ipfsapi.connect('127.0.0.1', 5001)  # TODO: Move to conf!
+    db = open_db_from_config(conf)
+    confirmations = int(config_get(conf, 'confirmations', DEFAULT_CONFIRMATIONS))
+    log_window = int(config_get(conf, 'log_fetch_window', LOG_FETCH_WINDOW))
+    log_workers = int(config_get(conf, 'log_fetch_workers', LOG_FETCH_WORKERS))
+    options = get_validation_options(conf)
+    scheduler = ValidationScheduler(
+        random_tie_break=config_get(conf, 'random_tie_break', 'false',
+                                    section=VALIDATOR_EL).lower() in ('true', 'yes', '1')
+    )
+    swarm = SwarmManager(int(config_get(conf, 'swarm_max_peers', SWARM_MAX_PEERS,
+                                        section=VALIDATOR_EL)))
+    pool = ValidatorPool(
+        partial(init_validation_worker, conf, db, ipfs_pool_from_config(conf, VALIDATOR_EL),
+                swarm),
+        validate_pin,
+        workers=int(config_get(conf, 'workers', VALIDATOR_WORKERS, section=VALIDATOR_EL)),
+        max_per_hoster=int(config_get(conf, 'max_per_hoster', VALIDATOR_MAX_PER_HOSTER,
+                                      section=VALIDATOR_EL)),
+    )
+
+    def handle_signal(signum, frame):
+        log.info("Received signal {}.  Finishing running validations...".format(signum))
+        pool.stop()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    pool.start()
+    last_sync = 0.0
 
-    while True:
-        log.info("Fetching events...")
-        fetch_events(db_conn, web3, scatter)
+    try:
+        while not pool.stopped:
 
-        log.info("Selecting pin to validate...")
+            # Workers finishing wake us up, but the chain only needs checking so often
+            if time.time() - last_sync >= STD_PROCESS_DELAY:
+                log.info("Fetching events...")
+                with db.writer() as db_conn:
+                    touched = fetch_events(db_conn, web3, scatter, confirmations, log_window,
+                                           log_workers, pool.stop_event)
+                    if pool.stopped:
+                        break
+                    fetch_bid_details(db_conn, scatter)
+                last_sync = time.time()
 
-        pins = get_bids_to_validate(db_conn, my_account)
+                with db.reader() as db_conn:
+                    if len(scheduler) < 1:
+                        # Load everything eligible.  This also picks up bids we've given up on
+                        # before.
+                        scheduler.update_many(get_bids_to_validate(db_conn, my_account, options))
+                    elif touched:
+                        scheduler.update_many(
+                            get_bids_to_validate(db_conn, my_account, options, bid_ids=touched),
+                            touched
+                        )
 
-        log.debug("Found {} available pins".format(len(pins)))
+                scheduler.rescore()
+                log.debug("{} pins scheduled for validation".format(len(scheduler)))
 
-        bid_id = select_random_pin_for_validation(scatter, pins, {
-            'max_file_size': config_get(conf, 'max_file_size', section=VALIDATOR_EL),
-        })
+            submitted = 0
+            free_slots = pool.free_slots()
 
-        if bid_id > -1:
-            log.error("VALIDATE_BID")
-            log.info('Validating bid #{}'.format(bid_id))
-            validate_bid(ipfs_conn, scatter, register, bid_id)
+            # Look past the first few, in case their hosters are already busy
+            if free_slots > 0:
+                for pin in scheduler.top(free_slots * VALIDATOR_LOOKAHEAD):
+                    if pool.submit(pin):
+                        scheduler.remove(pin['bid_id'])
+                        submitted += 1
 
-            # Let's not go crazy here
-            time.sleep(STD_PROCESS_DELAY)
-        else:
-            log.info('Nothing to validate')
-            time.sleep(SETTLED_PROCESS_DELAY)
+            if submitted < 1 and len(scheduler) < 1:
+                log.info('Nothing to validate')
+                pool.wait(SETTLED_PROCESS_DELAY)
+            else:
+                pool.wait(STD_PROCESS_DELAY)
+    finally:
+        pool.shutdown()
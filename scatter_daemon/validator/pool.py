@@ -0,0 +1,158 @@
+""" Pool of validation workers, fed by the sync loop in validate_run """
+import queue
+import threading
+from collections import defaultdict
+from ..common.typing import Any, Callable, Dict, List, Set, DictOfAny
+from ..common.logging import getLogger
+
+log = getLogger(__name__)
+
+
+class HosterLimiter:
+    """ Limit how many validations may run against a single hoster at once """
+    def __init__(self, max_per_hoster: int):
+        self.max_per_hoster = max_per_hoster
+        self.active: Dict[str, int] = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def acquire(self, hoster: str) -> bool:
+        """ Take a slot for hoster, if one is free """
+        with self.lock:
+            if self.active[hoster] >= self.max_per_hoster:
+                return False
+            self.active[hoster] += 1
+            return True
+
+    def release(self, hoster: str) -> None:
+        """ Give back a slot taken with acquire() """
+        with self.lock:
+            self.active[hoster] -= 1
+            if self.active[hoster] < 1:
+                del self.active[hoster]
+
+
+class ValidatorPool:
+    """ A fixed number of worker threads validating the pins submitted to the pool.
+
+    init_worker is called once in each worker thread to create its own resources (IPFS and web3
+    handles, contracts), which are passed to validate along with each pin.  Jobs are queued up to
+    the number of workers, so the producer only commits to work that can start soon.
+    """
+    def __init__(self, init_worker: Callable[[], Any], validate: Callable[[Any, DictOfAny], None],
+                 workers: int, max_per_hoster: int):
+        self.init_worker = init_worker
+        self.validate = validate
+        self.workers = workers
+        self.limiter = HosterLimiter(max_per_hoster)
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.jobs: queue.Queue = queue.Queue(maxsize=workers)
+        self.threads: List[threading.Thread] = []
+        self.in_flight: Set[int] = set()
+        self.in_flight_lock = threading.Lock()
+
+    def start(self) -> None:
+        """ Start the worker threads """
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='validator-{}'.format(i),
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        log.info("Started {} validation workers.".format(self.workers))
+
+    @property
+    def stopped(self) -> bool:
+        return self.stop_event.is_set()
+
+    def stop(self) -> None:
+        """ Ask the pool to stop.  Safe to call from a signal handler. """
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def wait(self, timeout: float) -> None:
+        """ Wait until a worker frees up, a stop is requested, or timeout seconds pass """
+        self.wake_event.wait(timeout)
+        self.wake_event.clear()
+
+    def free_slots(self) -> int:
+        """ How many more jobs would be accepted right now """
+        return self.jobs.maxsize - self.jobs.qsize()
+
+    def submit(self, pin: DictOfAny) -> bool:
+        """ Queue a pin for validation.  Returns False if it can't be taken right now, because
+        it's already in progress, its hoster is at its limit, or the queue is full. """
+        bid_id = pin['bid_id']
+        hoster = pin['hoster']
+
+        with self.in_flight_lock:
+            if bid_id in self.in_flight:
+                return False
+            if not self.limiter.acquire(hoster):
+                return False
+
+            try:
+                self.jobs.put_nowait(pin)
+            except queue.Full:
+                self.limiter.release(hoster)
+                return False
+
+            self.in_flight.add(bid_id)
+
+        return True
+
+    def _work(self) -> None:
+        """ Worker thread main loop """
+        try:
+            context = self.init_worker()
+        except Exception:
+            log.exception("Unable to start validation worker.  Stopping.")
+            self.stop()
+            return
+
+        while True:
+            pin = self.jobs.get()
+
+            # Sentinel from shutdown()
+            if pin is None:
+                self.jobs.task_done()
+                return
+
+            try:
+                if not self.stop_event.is_set():
+                    log.info('Validating bid #{}'.format(pin['bid_id']))
+                    self.validate(context, pin)
+            except Exception:
+                log.exception("Validation of bid #{} failed.".format(pin['bid_id']))
+            finally:
+                self.limiter.release(pin['hoster'])
+                with self.in_flight_lock:
+                    self.in_flight.discard(pin['bid_id'])
+                self.jobs.task_done()
+                self.wake_event.set()
+
+    def shutdown(self) -> None:
+        """ Stop taking jobs, let running validations finish and wait for the workers to exit.
+        Jobs that are queued but not started are dropped. """
+        self.stop()
+
+        # Drop what hasn't started, which also makes room for the sentinels
+        while True:
+            try:
+                pin = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            self.limiter.release(pin['hoster'])
+            with self.in_flight_lock:
+                self.in_flight.discard(pin['bid_id'])
+            self.jobs.task_done()
+
+        for thread in self.threads:
+            if thread.is_alive():
+                self.jobs.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+        log.info("Validation workers stopped.")
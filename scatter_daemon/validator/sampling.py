@@ -0,0 +1,302 @@
+""" Proof of pin by sampling a file's blocks.
+
+Instead of downloading a whole file from a hoster, a validator fetches k of its blocks, chosen
+at random with a seed from the bid ID and a recent block hash.  If a hoster is missing a fraction
+f of the file, a validation catches it with probability 1 - (1 - f)^k, whatever the file's size.
+"""
+import math
+import random
+import ipfsapi
+from eth_utils import keccak
+from hexbytes import HexBytes
+from attrdict import AttrDict
+from ..common.const import (
+    VALIDATION_SAMPLE_CONFIDENCE,
+    VALIDATION_SAMPLE_MISSING,
+    VALIDATION_BLOCK_TIMEOUT,
+)
+from ..common.typing import Any, Dict, Generator, List, Optional, Sequence, Tuple, StrOrBytes
+from ..common.logging import getLogger
+
+log = getLogger(__name__)
+
+# (CID, size) for each block of a file, in file order.  A list, or a DagIndex from storage.
+BlockList = Sequence[Tuple[str, int]]
+
+# The most a dag-pb leaf's block adds to the file data it holds, for its protobuf framing.  A
+# node with links adds at least one link, which is 40 bytes or more.
+DAG_PB_LEAF_OVERHEAD = 32
+
+# Blocks removed per block rm request
+BLOCK_RM_BATCH = 64
+
+
+def sample_seed(bid_id: int, block_hash: StrOrBytes) -> int:
+    """ Seed for choosing blocks.  Anyone can reproduce it, but a hoster can't know it before
+    the block is mined. """
+    return int.from_bytes(keccak(bid_id.to_bytes(32, 'big', signed=True)
+                                 + bytes(HexBytes(block_hash))), 'big')
+
+
+def sample_order(block_count: int, seed: int) -> List[int]:
+    """ Block indexes in the order they should be tried """
+    return random.Random(seed).sample(range(block_count), block_count)
+
+
+def sample_size(confidence: float = VALIDATION_SAMPLE_CONFIDENCE,
+                missing: float = VALIDATION_SAMPLE_MISSING) -> int:
+    """ How many blocks to fetch to catch a hoster missing `missing` of a file """
+    return max(1, math.ceil(math.log(1 - confidence) / math.log(1 - missing)))
+
+
+def sample_confidence(sampled: int, missing: float = VALIDATION_SAMPLE_MISSING) -> float:
+    """ Chance that `sampled` blocks would have caught a hoster missing `missing` of a file """
+    return 1 - (1 - missing) ** sampled
+
+
+def is_raw(cid: str) -> bool:
+    """ Whether a CID is a raw leaf (CIDv1, raw codec), which can't have links """
+    return cid.startswith('bafk')
+
+
+def read_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    """ Read a protobuf varint at pos.  Returns the value and the position after it. """
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ValueError("Truncated varint")
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def unixfs_blocksizes(data: bytes) -> List[int]:
+    """ The blocksizes of a UnixFS node's Data, i.e. how much of the file is under each of the
+    node's links """
+    sizes: List[int] = []
+    pos = 0
+
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+            if field == 4:
+                sizes.append(value)
+        elif wire_type == 2:
+            length, pos = read_varint(data, pos)
+            end = pos + length
+            # Packed, from encoders that pack repeated fields
+            while field == 4 and pos < end:
+                value, pos = read_varint(data, pos)
+                sizes.append(value)
+            pos = end
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError("Unknown protobuf wire type {}".format(wire_type))
+
+    return sizes
+
+
+def link_is_leaf(link: Dict[str, Any], file_size: Optional[int]) -> bool:
+    """ Whether a link points at a leaf, without fetching it.  A link's Size is the cumulative
+    size of the block and everything under it, so a dag-pb leaf's is the file data it holds
+    (file_size, from the parent's blocksizes) plus a few bytes of framing.  A node with links
+    adds the links of every node under it. """
+    if is_raw(link['Hash']):
+        return True
+    if file_size is None:
+        return False
+    return link['Size'] - file_size < DAG_PB_LEAF_OVERHEAD
+
+
+def daemon_timeout(timeout: float) -> str:
+    """ Timeout for the IPFS daemon itself.  Giving up is then an error response from a healthy
+    daemon, not a request timeout that counts against the endpoint. """
+    return '{}s'.format(timeout)
+
+
+def request_options(timeout: float) -> Dict[str, Any]:
+    """ Options for a request the daemon should give up on after timeout seconds.  The HTTP
+    request waits longer, so it doesn't time out first. """
+    return {'opts': {'timeout': daemon_timeout(timeout)}, 'timeout': timeout * 2}
+
+
+# What walk_dag() and sample_steps() ask of an IPFS node, answered by run_steps() or an async
+# equivalent, so both validator engines share the same logic.  LOCAL comes before anything else
+# is asked of a block, and the blocks our node didn't have are removed again once the steps are
+# done.  Otherwise they'd be on our node next time and prove nothing about the hoster.
+LINKS = 'links'  # The links of a block, fetching it if needed
+DATA = 'data'  # The UnixFS Data of a block, fetching it if needed
+SIZE = 'size'  # The size of a block, fetching it if needed
+FETCH = 'fetch'  # Like SIZE, but None if it can't be had in time
+LOCAL = 'local'  # Whether our own node already has a block, without fetching it
+
+Step = Tuple[str, str]
+
+
+def walk_dag(root: str) -> Generator[Step, Any, List[Tuple[str, int]]]:
+    """ List a file's blocks, in file order.  Only nodes with links are fetched, and each one
+    tells which of its links are leaves, so with the default chunker about one block in 170 is
+    fetched whatever the leaves' codec.  The result is kept in the DAG index. """
+    blocks: List[Tuple[str, int]] = []
+    stack: List[Tuple[str, Optional[int], bool]] = [(root, None, is_raw(root))]
+
+    while stack:
+        cid, size, leaf = stack.pop()
+
+        if not leaf or size is None:
+            yield (LOCAL, cid)
+
+        if not leaf:
+            links = yield (LINKS, cid)
+            if len(links) > 0:
+                data = yield (DATA, cid)
+                try:
+                    file_sizes: List[Optional[int]] = list(unixfs_blocksizes(data))
+                except ValueError:
+                    file_sizes = []
+                # Not a UnixFS file node, so its links have to be fetched to know
+                if len(file_sizes) != len(links):
+                    file_sizes = [None] * len(links)
+                stack.extend((link['Hash'], link['Size'], link_is_leaf(link, file_size))
+                             for link, file_size in reversed(list(zip(links, file_sizes))))
+                continue
+
+        # A leaf's cumulative size is its own
+        if size is None:
+            size = yield (SIZE, cid)
+        blocks.append((cid, size))
+
+    return blocks
+
+
+def sample_steps(blocks: BlockList, seed: int,
+                 confidence: float = VALIDATION_SAMPLE_CONFIDENCE,
+                 missing: float = VALIDATION_SAMPLE_MISSING) -> Generator[Step, Any, AttrDict]:
+    """ Fetch a random sample of a file's blocks.  Blocks we already have are skipped for the
+    next one in the seeded order, and the first block that can't be fetched fails the sample. """
+    target = min(len(blocks), sample_size(confidence, missing))
+    proven = 0
+    local = 0
+
+    for idx in sample_order(len(blocks), seed):
+        if proven >= target:
+            break
+
+        cid, size = blocks[idx]
+
+        if (yield (LOCAL, cid)):
+            local += 1
+            continue
+
+        fetched = yield (FETCH, cid)
+        if fetched != size:
+            if fetched is not None:
+                log.warning("Block {} is {} bytes, expected {}".format(cid, fetched, size))
+            return sample_result(proven, [cid], local, missing)
+
+        proven += 1
+
+    return sample_result(proven, [], local, missing)
+
+
+def block_is_local(ipfs: Any, cid: str) -> bool:
+    """ Whether our own node already has a block, in which case fetching it proves nothing """
+    try:
+        ipfs.block_stat(cid, offline=True)
+        return True
+    except ipfsapi.exceptions.ErrorResponse:
+        return False
+
+
+def fetch_block(ipfs: Any, cid: str, timeout: float = VALIDATION_BLOCK_TIMEOUT) -> Optional[int]:
+    """ Fetch a block from the network and return its size, or None if it can't be had in
+    time """
+    try:
+        return ipfs.block_stat(cid, **request_options(timeout)).get('Size')
+    except ipfsapi.exceptions.ErrorResponse as err:
+        log.debug("Unable to fetch block {}: {}".format(cid, err))
+        return None
+
+
+def remove_blocks(ipfs: Any, cids: List[str]) -> None:
+    """ Remove the blocks our node fetched to validate someone else's pin """
+    for i in range(0, len(cids), BLOCK_RM_BATCH):
+        try:
+            ipfs.block_rm(*cids[i:i + BLOCK_RM_BATCH])
+        except ipfsapi.exceptions.Error as err:
+            log.debug("Unable to remove fetched blocks: {}".format(err))
+
+
+def run_steps(ipfs: Any, steps: Generator[Step, Any, Any],
+              timeout: float = VALIDATION_BLOCK_TIMEOUT) -> Any:
+    """ Answer walk_dag() or sample_steps() with an ipfsapi client """
+    options = request_options(timeout)
+    answer = None
+    fetched: List[str] = []
+
+    try:
+        while True:
+            try:
+                kind, cid = steps.send(answer)
+            except StopIteration as stop:
+                return stop.value
+
+            if kind == LINKS:
+                answer = ipfs.object_links(cid, **options).get('Links') or []
+            elif kind == DATA:
+                answer = ipfs.object_data(cid, **options)
+            elif kind == SIZE:
+                answer = ipfs.block_stat(cid, **options)['Size']
+            elif kind == FETCH:
+                answer = fetch_block(ipfs, cid, timeout)
+            elif kind == LOCAL:
+                answer = block_is_local(ipfs, cid)
+                if not answer:
+                    fetched.append(cid)
+            else:
+                raise ValueError("Unknown step {}".format(kind))
+    finally:
+        remove_blocks(ipfs, fetched)
+
+
+def dag_blocks(ipfs: Any, root: str,
+               timeout: float = VALIDATION_BLOCK_TIMEOUT) -> List[Tuple[str, int]]:
+    """ walk_dag() with an ipfsapi client """
+    return run_steps(ipfs, walk_dag(root), timeout)
+
+
+def sample_result(proven: int, failed: List[str], local: int,
+                  missing: float = VALIDATION_SAMPLE_MISSING) -> AttrDict:
+    """ The outcome of a sampled validation.  valid is None if nothing could be sampled. """
+    if failed:
+        valid: Optional[bool] = False
+    elif proven > 0:
+        valid = True
+    else:
+        valid = None
+
+    return AttrDict({
+        'valid': valid,
+        'confidence': sample_confidence(proven, missing) if valid else 0.0,
+        'proven': proven,
+        'failed': failed,
+        'local': local,
+    })
+
+
+def validate_sample(ipfs: Any, blocks: BlockList, seed: int,
+                    confidence: float = VALIDATION_SAMPLE_CONFIDENCE,
+                    missing: float = VALIDATION_SAMPLE_MISSING,
+                    timeout: float = VALIDATION_BLOCK_TIMEOUT) -> AttrDict:
+    """ sample_steps() with an ipfsapi client """
+    return run_steps(ipfs, sample_steps(blocks, seed, confidence, missing), timeout)